@@ -17,12 +17,17 @@
 #    initial 10ns
 
 import matplotlib.pyplot as plt
+import fit_PSEC as fit
+import analysis_PSEC as analysis
+import parallel_PSEC as parallel
+import hist_PSEC as hist
+import position_PSEC
 
 import numpy as np
 import os
-from Tkinter import *
-import tkFileDialog
-import tkMessageBox
+from tkinter import *
+from tkinter import filedialog
+from tkinter import messagebox
 import bokeh.plotting as bkh
 from scipy import optimize
 from bokeh.models import Span
@@ -67,49 +72,15 @@ guess = [1750, 17.1, 0.1,
 ]
 
 
-def get_laser_pulse(sample):
-    # The laser is on channel 5
-    volts = sample[4,:]
-    ts = np.arange(0.0, 25.6, 0.1) #ns
-
-    # Threshold crossing, laser pulses are < -60mv
-    risetime = np.argmax(volts < -0.100)
-    risetime = ts[risetime]
-
-    # If the risetime is within the first 10ns, we want to continue
-    if risetime < 5.0 and risetime > 0.0:
-        return risetime
-    else:
-        # print("Laser too late; %.2lf" % risetime)
-        return None
-
 def analyse(sample, ch):
     ## Fit a double gaussian to the data ##
     volts = sample[ch,:]
     #Make a maller version of ts to use for individual samples
     ts = np.arange(0.0, 25.6, 0.1)
 
-    # Chisq error function
-    errfunc = lambda p, x, y: (two_gaussians(x, *p) - y)**2
-
-    # Guess the locations of the gaussians
-    halfmax_volt = 0.5 * np.amin(volts)
-    halfmax_t1 = np.argmax(volts<halfmax_volt)
-    halfmax_t1 = ts[halfmax_t1]
-
-    halfmax_t2 = np.argmax(volts[::-1] < halfmax_volt)
-    halfmax_t2 = ts[-1*halfmax_t2]
-
-    # Initial solution guesses two peaks at the leading abd trailing edges
-           #   h1,   c1,   w1]
-    guess = [halfmax_volt, halfmax_t1, 0.1,
-            halfmax_volt, halfmax_t2, 0.1,
-            np.mean(sample[2,:]) ] # y offset
-
-    # Optimise gaussian fit
-    optim, success = optimize.leastsq(errfunc, guess[:], args=(ts, volts))
-
-    chisq = chisquare(volts, two_gaussians(ts, *optim))
+    # Fit two gaussians around the pulses, with a y offset
+    optim, status, chisq = fit.fit_double_gaussian(volts,
+        offset=np.mean(sample[2,:]), ts=ts)
     
     # Pulse arrival time
     arrival_time = min([optim[4], optim[1]])
@@ -118,7 +89,8 @@ def analyse(sample, ch):
     time_difference = abs(optim[4]-optim[1])*1e-9 # Convert to ns
 
     # Calculate the position
-    position = 0.06 - (.5*time_difference * electronVelocity)
+    position, error, flags = position_PSEC.reflection(
+        abs(optim[4]-optim[1]), ch, calibration)
 
     ## Integrate the pulse, where it crosses the threshold
     # Establish the noise level from channel 6
@@ -148,102 +120,75 @@ fnames = ['20ksamples2.5kV.txt']
 ts = np.arange(0.0, 25.6, 0.1)
 
 # position = float(raw_input("What position on the tile are we at (cm): "))/100
-electronVelocity = 6e7
+# Strip length and signal velocity of the laser tile. Its signals are slower,
+#  6e7 m/s, than the tile.json default.
+calibration = position_PSEC.load(os.path.join(
+    os.path.dirname(position_PSEC.DEFAULT), 'laser_tile.json'))
 dt = 100e-12 # 100ps time resolution
 # Detection threshold
 threshold = -0.007
 
-# Initialise data storage
-transit_times = [[],[],[],[],[],[]]
-positions = [[],[],[],[],[],[]]
-gains = [[],[],[],[],[],[]]
-
-y = 0
-d = 0
-flag = 0
-
-for fname in fnames:
-    # Open the file and read in a sample at a time
-    with open(fname, 'r') as f:
-        sample = np.zeros((6, 256))
-        i = 0
-        for line in f:
-            if line[0] == '#':
-                continue
-            if i == 256:
-                # Where is the laser pulse?
-                laser_time = get_laser_pulse(sample)
-                if laser_time != None:
-                    y += 1
-                    flag = 0
-                    for ch in [0,1,2,3,4,5]:
-                        # Get if/when the pulse crosses the threshold
-                        arrival_time = np.argmax(sample[ch,:] < threshold)
-                        # Returns 0 if the threshold isnt reached
-                        if arrival_time > 0:
-                            # Get timestamp
-                            arrival_time = ts[arrival_time]
-                            # Get delat between laser and pulse
-                            tts = arrival_time - laser_time
-
-                            if tts > 0:
-                                if flag == 0:
-                                    flag = 1
-                                    d += 1
-                                transit_times[ch].append(tts)
-
-
-                # Reset array
-                sample = np.zeros((6,256))
-                i = 0
-
-            # Read the data into array
-            sample[:,i] = np.array([float(x) for x in line.split()])[:6]
-            i += 1
-
-
-
-junctions = [
-    'J31',
-    'J29',
-    'J27',
-    'J25'
-    ]
-
-fig, axs = plt.subplots(4, 1, sharex=True, figsize=[8.27, 11.69])
-
-for ch, ax in zip([0,1,2,3], axs.reshape(-1)):
-    # Get the channel
-    if len(transit_times[ch]) > 0:
-        tts = np.array(transit_times[ch])
-    else:
-        tts = np.array([0])
-    xmin, xmax = np.min(tts), np.max(tts)
-
-    # Plot the observations
-    N, bins, patches = ax.hist(tts, range=[15, 20.], facecolor='green', 
-        edgecolor='black', bins=50, label='Data')
-    ax.set_ylabel('Frequency')
-
-    # Optimise gaussian fit
-    bins = np.array(bins[:-1]) + 0.05
-    optim, success = optimize.leastsq(errfunc, guess[:], args=(bins, N))
-
-    print("For %s" % (junctions[ch]))
-    print("First gaussian:\nHeight - %d\nCentre - %.3lf\nWidth - %.3lf\n" % 
-        (optim[0], optim[1], optim[2]))
-
-    # Plot the fit
-    # ax.plot(bins, two_gaussians(bins, *optim), color='black', label='Normal Distribution')
-    ax.plot(bins, gaussian(bins, *optim), color='black', label='Normal Distribution')
-
-
-    ax.set_xlim(15, 20)
-    ax.set_title("%s. Mean: %.3lf, Standard deviation: %.3lf" % 
-        (junctions[ch], optim[1], optim[2]))
-
-
-axs[-1].set_xlabel('Transit time, ns')
-plt.tight_layout()
-plt.savefig('TTS_for_each_channel')
-plt.show()
\ No newline at end of file
+if __name__ == '__main__':
+    args = parallel.arguments("Get the transit time spread of each "
+        "channel").parse_args()
+
+    # Initialise data storage. The transit times are binned as they come in,
+    #  50 bins over 15-20ns, so memory doesn't grow with the number of events.
+    transit_times = [hist.Histogram(50, (15., 20.)) for ch in range(6)]
+    y = 0
+    d = 0
+
+    # Go through the files a chunk of samples at a time, spread over the
+    #  workers. The chunks come back in order, and each brings back its own
+    #  histograms, which are added up.
+    results = parallel.map_events(analysis.transit_time_histograms, fnames,
+        workers=args.workers, args=(threshold, 50, (15., 20.)))
+    for chunks in results:
+        for chunk_hists, chunk_y, chunk_d in chunks:
+            for ch in range(6):
+                transit_times[ch] += chunk_hists[ch]
+            y += chunk_y
+            d += chunk_d
+
+    junctions = [
+        'J31',
+        'J29',
+        'J27',
+        'J25'
+        ]
+
+    fig, axs = plt.subplots(4, 1, sharex=True, figsize=[8.27, 11.69])
+
+    for ch, ax in zip([0,1,2,3], axs.reshape(-1)):
+        # Get the channel
+        tts = transit_times[ch]
+
+        # Plot the observations
+        N, bins, patches = ax.hist(tts.centres, bins=tts.edges,
+            weights=tts.counts, facecolor='green', edgecolor='black',
+            label='Data')
+        ax.set_ylabel('Frequency')
+
+        # Optimise gaussian fit, straight to the accumulated bins
+        bins = tts.centres
+        optim, success = optimize.leastsq(errfunc, guess[:],
+            args=(bins, tts.counts))
+
+        print("For %s" % (junctions[ch]))
+        print("First gaussian:\nHeight - %d\nCentre - %.3lf\nWidth - %.3lf\n" % 
+            (optim[0], optim[1], optim[2]))
+
+        # Plot the fit
+        # ax.plot(bins, two_gaussians(bins, *optim), color='black', label='Normal Distribution')
+        ax.plot(bins, gaussian(bins, *optim), color='black', label='Normal Distribution')
+
+
+        ax.set_xlim(15, 20)
+        ax.set_title("%s. Mean: %.3lf, Standard deviation: %.3lf" % 
+            (junctions[ch], optim[1], optim[2]))
+
+
+    axs[-1].set_xlabel('Transit time, ns')
+    plt.tight_layout()
+    plt.savefig('TTS_for_each_channel')
+    plt.show()
@@ -8,6 +8,7 @@ import subprocess
 import tkFileDialog
 import tkMessageBox
 import plot_PSEC4 as plt
+import monitor_PSEC
 
 ### FILEPATH TO PSEC4 CODE DIRECTORY!!! SET THIS!!!!!! ###
 DIR = '/home/wizenedchimp/Documents/LAPPD-Project/run-psec4-master/'
@@ -70,6 +71,9 @@ while type(N) != int:
 # Ask the PSEC to read the thing, and store it in DATA with the name we want
 command = ['./bin/LogData', oname, str(N), '0']
 psec = subprocess.Popen(command)
+# Print the rates and gain as the events come in, so a bad run shows up
+#  straight away rather than when it's finished
+monitor_PSEC.watch(oname+'.txt', until=lambda: psec.poll() is not None)
 psec.wait()
 
 # If we can't find the file after the PSEC is done, exit
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import matplotlib.pyplot as plt
 import read_PSEC as psec
+import charge_PSEC
+import timing_PSEC as timing
 import os
 from Tkinter import *
 import tkFileDialog
@@ -37,79 +39,36 @@ gain    = (15400. * voltage) - 34097909.
 print("Voltage: %.2lf\nGain: %.2lf" % (voltage, gain))
 
 # Read in the data
-t, samples = psec.read(fname)
-dt = (t[1]-t[0]) * 1e-9
-N_samples = len(samples)
+data, header = psec.load(fname)
 
-# Get the sample keys
-keys = samples.keys()
+# Integrate the voltages, using channel 5 as the noise reference and
+#  summing data more than 3 sigma below its mean. <signals> is 1 where the
+#  voltage is above threshold, and 0 where it isn't.
+charge, gains, signals = charge_PSEC.integrate(data, noise_ch=4, nsigma=3)
+signals = signals.astype(float)
+sums = charge * charge_PSEC.RESISTANCE
 
-# Get the arrival times
-signals = {}
-
-# Integrate the voltages. Construct an array indicating the number of P.E.
-sums = np.zeros((6, N_samples))
-
-# Loop over the data
-for k in keys:
-    sample = samples[k]
-
-    # Establish the noise level from channel 6
-    zeropoint = np.mean(sample[-2])
-    # Get the standard deviation of the noise
-    scatter = np.std(sample[-2])
-    # Sum data that are more than 3.5 sigma from the mean
-    lowerlim = zeropoint - (3*scatter)
-
-    # i is the channel number
-    i = 0
-    # l is datapoint index
-    l = 0
-    # Voltage sum
-    Vsum = 0.0
-    # Initialise signal array
-    signals[k] = np.zeros((6, 256))
-    # Loop over channels
-    for channel in sample:
-        # Reset datapoint idex counter
-        l = 0
-        # Loop over datapoints in the channel
-        for point in channel:
-            if point < lowerlim:
-                # Divide by 1000 to convert back from mV to V
-                Vsum += point*dt/1000
-                # If above threshold, flag the signal
-                signals[k][i][l] = 1
-            l += 1
-        sums[i][int(k)] = Vsum
-        i += 1
-        Vsum = 0.0
 # Sum the channels to get the total charge detected
-sums = np.sum(sums, axis=0)
+sums = np.sum(sums, axis=1)
 
 # Use the gain relation to get the number of photoelectrons
 photoelectrons = sums / (-1.6e-19* 50 * gain)
 
-def first_nonzero(arr, axis, invalid_val=-1):
-    mask = arr!=0
-    return np.where(mask.any(axis=axis), mask.argmax(axis=axis), invalid_val)
-
-def last_nonzero(arr, axis, invalid_val=-1):
-    mask = arr!=0
-    val = arr.shape[axis] - np.flip(mask, axis=axis).argmax(axis=axis) - 1
-    return np.where(mask.any(axis=axis), val, invalid_val)
+# Time each channel first crosses the noise threshold, interpolated between
+#  samples. NaN where it never does.
+arrivals = timing.leading_edge(data,
+    charge_PSEC.noise_level(data, 4, 3)[:, np.newaxis])
 
 # Crawl over <signals> and get the arrival time differences between each
 #  pulse
-for k in keys:
-    sample = samples[k]
+for k in range(len(data)):
+    # voltage is stored in Volts, convert to mV.
+    sample = data[k]*1000.
     signal = signals[k]
 
 
-    # Get first non-zero signals for each channel
-    arrivals = first_nonzero(signal, 1, invalid_val=None)
     print ("\nFor sample %s, the arrivals were as follows:" % (k))
-    print(arrivals)
+    print(arrivals[k])
 
     plt.plot(sample[0])
     plt.plot(signal[0])
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+import numpy as np
+import charge_PSEC
+import fit_PSEC as fit
+import hist_PSEC as hist
+import position_PSEC
+import results_PSEC as results
+import timing_PSEC as timing
+
+# The analyses the scripts and lappd.py do on each chunk of events. They all
+#  take the (n, 6, 256) voltages of a chunk, in V, and its metadata as the
+#  first two arguments, so they can be given straight to
+#  parallel_PSEC.map_events(). None of them need anything heavier than
+#  numpy and scipy.
+
+# Time axis of a single sample, in ns
+TS = fit.TS
+
+def laser_times(data, laser_ch=4, threshold=-0.100):
+    '''Gets the rise time of the laser pulse in each event.
+     <data>      = (n, 6, 256) array of the voltages, in V
+     <laser_ch>  = index of the channel the laser trigger is on
+     <threshold> = voltage the laser pulse crosses
+    Returns: risetime
+     <risetime> = (n,) array of the interpolated times the laser crossed the
+            threshold, in ns. NaN if it wasn't within the first 5ns.'''
+    # The laser is on channel 5. Laser pulses are < -60mv
+    risetime = timing.leading_edge(data[:, laser_ch], threshold, ts=TS)
+
+    # If the risetime is within the first 5ns, we want to continue
+    with np.errstate(invalid='ignore'):
+        late = ~((risetime < 5.0) & (risetime > 0.0))
+    risetime[late] = np.nan
+    return risetime
+
+def transit_times(data, meta, threshold=-0.007):
+    '''Gets the time from the laser pulse to the signal on each channel. Both
+    are timed where they cross a threshold, interpolated between samples.
+     <threshold> = voltage a signal has to cross, in V
+    Returns: times, n_laser, n_detected
+     <times>      = list of the transit times on each channel, in ns
+     <n_laser>    = number of events with a laser pulse in time
+     <n_detected> = how many of those had a signal on any channel'''
+    laser = laser_times(data)
+    arrival = timing.leading_edge(data, threshold, ts=TS)
+
+    # Channels that see a signal after the laser. Anything that didn't cross
+    #  either threshold is NaN, and never counts.
+    tts = arrival - laser[:, np.newaxis]
+    with np.errstate(invalid='ignore'):
+        hit = tts > 0
+    times = [tts[hit[:, ch], ch].tolist() for ch in range(6)]
+    n_laser = int(np.sum(~np.isnan(laser)))
+    n_detected = int(np.sum(np.any(hit, axis=1)))
+    return times, n_laser, n_detected
+
+def transit_time_histograms(data, meta, threshold=-0.007, bins=50,
+        range=(15., 20.)):
+    '''transit_times(), binned, so that the chunks of a long run can be added
+    up without keeping every transit time.
+     <threshold> = voltage a signal has to cross, in V
+     <bins>      = number of bins
+     <range>     = (low, high) transit times to bin, in ns
+    Returns: hists, n_laser, n_detected
+     <hists>      = list of a hist_PSEC.Histogram of the transit times on each
+            channel
+     <n_laser>, <n_detected> = as from transit_times()'''
+    times, n_laser, n_detected = transit_times(data, meta, threshold)
+    hists = [hist.Histogram(bins, range) for ch in times]
+    for h, tts in zip(hists, times):
+        h.fill(tts)
+    return hists, n_laser, n_detected
+
+def time_difference(sample, ch, noise_ch=3, nsigma=3.5):
+    '''Gets the time between the direct and reflected pulses on a channel of
+    one event, from a double gaussian fit.
+     <sample>   = (6, 256) array of the event's voltages, in V
+     <ch>       = index of the channel
+     <noise_ch> = index of the channel with only noise on it
+     <nsigma>   = how far below the noise a pulse has to go, in standard
+            deviations
+    Returns: delta_t
+     <delta_t> = time between the pulses in s, or None if there was no pulse
+            or the fit failed'''
+    volts = sample[ch,:]
+
+    ## Is there a pulse in this channel?
+    # Establish the noise level, and look for data more than <nsigma> sigma
+    #  below the mean
+    zeropoint = np.mean(sample[noise_ch])
+    scatter = np.std(sample[noise_ch])
+    lowerlim = zeropoint - (nsigma*scatter)
+    if not np.any(volts < lowerlim):
+        return None
+
+    # Fit two gaussians around the pulses
+    optim, status, chisq = fit.fit_double_gaussian(volts, ts=TS)
+    if status not in fit.CONVERGED:
+        return None
+
+    # Get the time differences
+    return abs(optim[4]-optim[1])*1e-9 # Convert to s
+
+def velocities(data, meta, channels=(0,1,2,4,5), length=None):
+    '''Gets the signal velocity from every pulse in the chunk.
+     <channels> = indices of the channels to look at
+     <length>   = distance the reflected pulse travels further than the
+            direct one, in m. Twice the strip length in tile.json if None.
+    Returns: velocities
+     <velocities> = list of the velocities, in m/s'''
+    if length is None:
+        length = 2*position_PSEC.load().get('length')
+    found = []
+    for sample in data:
+        for ch in channels:
+            delta_t = time_difference(sample, ch)
+            if delta_t is not None:
+                found.append(length/delta_t)
+    return found
+
+def positions(data, ch, calibration=None):
+    '''Gets where on the strip each pulse came from, from the time between
+    the direct and reflected pulses. All the events are fitted together.
+     <data>        = (n, 6, 256) array of the voltages, in V
+     <ch>          = index of the channel
+     <calibration> = position_PSEC.Calibration of the tile, for the strip
+            length and signal velocity. tile.json's if None.
+    Returns: position, error, flags, status
+     <position> = (n,) array of the positions, in m
+     <error>    = (n,) array of their uncertainties, in m
+     <flags>    = (n,) array of the position_PSEC validity flags
+     <status>   = (n,) array of the fit status codes, see fit_PSEC'''
+    # Fit two gaussians around the pulses, with a y offset
+    optim, status, chisq = fit.fit_double_gaussian_batch(data[:, ch, :],
+        offset=np.mean(data[:, 2, :], axis=1), ts=TS)
+
+    delta_t = abs(optim[:, 4]-optim[:, 1])
+    position, error, flags = position_PSEC.reflection(delta_t, ch,
+        calibration)
+    return position, error, flags, status
+
+def gain_positions(data, meta, ch, noise_ch=5, nsigma=3.5, calibration=None,
+        dt=charge_PSEC.DT):
+    '''Gets the position and gain of each pulse on a channel, for a gain map.
+     <ch>          = index of the channel
+     <noise_ch>    = index of the channel with only noise on it
+     <nsigma>      = integration threshold, in standard deviations of the
+            noise
+     <calibration> = position_PSEC.Calibration of the tile, or None for
+            tile.json's
+     <dt>          = time between samples, in s
+    Returns: position, gain
+     <position> = array of the position of each pulse whose fit worked and
+            was on the tile, in m
+     <gain>     = array of the gains of the same pulses'''
+    charge, gain, mask = charge_PSEC.integrate(data, noise_ch=noise_ch,
+        nsigma=nsigma, dt=dt)
+    position, error, flags, status = positions(data, ch, calibration)
+
+    # If its a signal, and the fit worked, keep it
+    good = np.isin(status, fit.CONVERGED) & (flags == position_PSEC.OK)
+    return position[good], gain[good, ch]
+
+def pulse_results(data, meta, ch, noise_ch=5, nsigma=3.5, calibration=None,
+        dt=charge_PSEC.DT, pedestal=None):
+    '''Like gain_positions(), but with everything else worked out about each
+    pulse too, as records for results_PSEC.
+     <ch>, <noise_ch>, <nsigma>, <calibration>, <dt> = as for
+            gain_positions()
+     <pedestal> = pedestal_PSEC.Pedestal to subtract first, in place of the
+            noise channel, or None
+    Returns: records
+     <records> = results_PSEC.RESULTS array with a record for each pulse whose
+            fit worked and was on the tile'''
+    charge, gain, mask = charge_PSEC.integrate(data, noise_ch=noise_ch,
+        nsigma=nsigma, dt=dt, pedestal=pedestal, meta=meta)
+    if pedestal is not None:
+        data = pedestal.subtract(data, meta)
+    optim, status, chisq = fit.fit_double_gaussian_batch(data[:, ch, :],
+        offset=np.mean(data[:, 2, :], axis=1), ts=TS)
+    delta_t = abs(optim[:, 4]-optim[:, 1])
+    position, error, flags = position_PSEC.reflection(delta_t, ch,
+        calibration)
+
+    good = np.isin(status, fit.CONVERGED) & (flags == position_PSEC.OK)
+    records = results.empty(np.count_nonzero(good))
+    records['event'] = meta['event'][good]
+    records['channel'] = ch
+    records['status'] = status[good]
+    records['arrival'] = np.minimum(optim[good, 1], optim[good, 4])
+    records['delta_t'] = delta_t[good]
+    records['position'] = position[good]
+    records['charge'] = charge[good, ch]
+    records['gain'] = gain[good, ch]
+    records['chisq'] = chisq[good]
+    return records
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import os
+import json
+import numpy as np
+
+# Binary sidecar cache for PSEC4 log files, so that a log only has to be
+#  parsed once. The cache is written next to the log as <name>.psec, and
+#  holds:
+#   - a magic line, identifying the file
+#   - one line of JSON describing the source log it came from (size and
+#      modification time, to tell if it's stale), the log's '#' header, and
+#      the dtype, shape and offset of every array stored
+#   - the raw arrays themselves, each aligned to ALIGN bytes so that they
+#      can be memory mapped straight back out of the file.
+
+MAGIC = b'PSEC4 CACHE\n'
+VERSION = 1
+ALIGN = 64
+# Extension of the cache of the waveforms. Other sidecars in the same format,
+#  like the event index, have their own.
+EXT = '.psec'
+
+def cache_name(fname, ext=EXT):
+    '''Returns the name of the cache file that goes with the log <fname>'''
+    return os.path.splitext(fname)[0] + ext
+
+def _stamp(fname):
+    # What we know about the source file, to check the cache against
+    st = os.stat(fname)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+def stamp(f):
+    '''Gets the size and modification time of an open log file, to give to
+    save(). This has to be taken before the log is read, and no more than
+    <size> bytes read, or a log that's still being written could grow in
+    between, and the cache be taken as up to date with events missing.
+     <f> = the open log file
+    Returns: source
+     <source> = dict of the 'size' and 'mtime' of the log'''
+    st = os.fstat(f.fileno())
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+def _dtype_to_json(dtype):
+    if dtype.names:
+        return [[name, dtype.fields[name][0].str] for name in dtype.names]
+    return dtype.str
+
+def _dtype_from_json(descr):
+    if isinstance(descr, list):
+        return np.dtype([(str(name), str(t)) for name, t in descr])
+    return np.dtype(str(descr))
+
+def _pad(n):
+    return (-n) % ALIGN
+
+def save(fname, arrays, header, ext=EXT, source=None):
+    '''Writes a cache for the log file <fname>.
+     <fname>  = the log file that the arrays were read from
+     <arrays> = dict of the numpy arrays to store, by name
+     <header> = list of the '#' header lines of the log
+     <ext>    = extension of the cache file
+     <source> = stamp() of the log from before it was read. The log as it is
+            now if None, which is only right if it can't have changed since.
+    Returns: cname
+     <cname> = the name of the cache file written, or None if it couldn't
+            be written (e.g. a read only data directory)'''
+    cname = cache_name(fname, ext)
+
+    # Lay out the arrays one after the other, relative to the end of the
+    #  description
+    names = sorted(arrays)
+    arrays = dict((name, np.ascontiguousarray(arrays[name])) for name in names)
+    if source is None:
+        source = _stamp(fname)
+    desc = {'version': VERSION, 'source': source, 'header': header,
+        'arrays': {}}
+    offset = 0
+    for name in names:
+        arr = arrays[name]
+        desc['arrays'][name] = {'dtype': _dtype_to_json(arr.dtype),
+            'shape': list(arr.shape), 'offset': offset}
+        offset += arr.nbytes + _pad(arr.nbytes)
+
+    text = MAGIC + json.dumps(desc).encode() + b'\n'
+    text += b' '*_pad(len(text))
+
+    # Write to a temporary file first, so that nobody can open a half
+    #  written cache
+    tmpname = cname + '.tmp'
+    try:
+        with open(tmpname, 'wb') as f:
+            f.write(text)
+            for name in names:
+                arr = arrays[name]
+                arr.tofile(f)
+                f.write(b'\0'*_pad(arr.nbytes))
+        os.rename(tmpname, cname)
+    except (IOError, OSError) as e:
+        print("WARNING: Could not write cache %s (%s)" % (cname, e))
+        return None
+    return cname
+
+def load(fname, ext=EXT):
+    '''Opens the cache for the log file <fname>, if there is an up to date one.
+    The arrays are memory mapped, so nothing is read from disk until it's
+    used. They are copy-on-write, so changing them doesn't touch the cache.
+     <fname> = the log file that the cache was made from
+     <ext>   = extension of the cache file
+    Returns: arrays, header
+     <arrays> = dict of the arrays in the cache, by name
+     <header> = list of the '#' header lines of the log
+    Returns None if there's no cache, or it's out of date.'''
+    cname = cache_name(fname, ext)
+    if not os.path.isfile(cname) or not os.path.isfile(fname):
+        return None
+
+    with open(cname, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        line = f.readline()
+    try:
+        desc = json.loads(line.decode())
+    except ValueError:
+        return None
+
+    # Is the cache still describing the same log?
+    if desc.get('version') != VERSION or desc['source'] != _stamp(fname):
+        return None
+
+    start = len(MAGIC) + len(line)
+    start += _pad(start)
+    arrays = {}
+    for name, info in desc['arrays'].items():
+        dtype = _dtype_from_json(info['dtype'])
+        shape = tuple(info['shape'])
+        if 0 in shape:
+            # Can't map an empty region of a file
+            arrays[str(name)] = np.zeros(shape, dtype=dtype)
+            continue
+        arrays[str(name)] = np.memmap(cname, dtype=dtype, mode='c',
+            offset=start + info['offset'], shape=shape)
+    return arrays, [str(h) for h in desc['header']]
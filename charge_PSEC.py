@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import numpy as np
+
+# Integrates the pulses in blocks of PSEC4 events, to get their charge and
+#  the gain of the tube. A pulse is anything that dips below the noise level,
+#  measured from a channel that only has noise on it. Everything is done for
+#  every event and channel in the block at once, so it works the same on a
+#  whole run from read_PSEC.load() or on the chunks from
+#  read_PSEC.iter_events().
+
+ELECTRON_CHARGE = 1.6e-19 # C
+RESISTANCE = 50. # Ohms, the termination of the readout
+DT = 100e-12 # 100ps time resolution
+
+def noise_level(data, noise_ch, nsigma):
+    '''Gets the threshold below which a sample counts as signal, for each event.
+     <data>     = (n_events, 6, 256) array of channel voltages
+     <noise_ch> = index of the channel with only noise on it
+     <nsigma>   = how many standard deviations of the noise below its mean
+            the threshold is
+    Returns: lowerlim
+     <lowerlim> = (n_events,) array of the threshold of each event'''
+    noise = data[:, noise_ch, :]
+    # Establish the noise level, and get the standard deviation of the noise
+    zeropoint = np.mean(noise, axis=1, dtype=np.float64)
+    scatter = np.std(noise, axis=1, dtype=np.float64)
+    return zeropoint - (nsigma*scatter)
+
+def integrate(data, noise_ch=3, nsigma=3., dt=DT, resistance=RESISTANCE,
+        pedestal=None, meta=None):
+    '''Integrates the voltage of every channel of every event where it crosses
+    the noise threshold.
+     <data>       = (n_events, 6, 256) array of channel voltages, in V
+     <noise_ch>   = index of the channel with only noise on it
+     <nsigma>     = threshold, in standard deviations of the noise
+     <dt>         = time between samples, in s
+     <resistance> = termination resistance, in Ohms
+     <pedestal>   = pedestal_PSEC.Pedestal to subtract from the voltages
+            first. The threshold is then from the noise of each storage cell,
+            and <noise_ch> isn't used.
+     <meta>       = metadata of the events, for the pedestals
+    Returns: charge, gain, mask
+     <charge> = (n_events, 6) array of the integrated charge, in C. Pulses
+            are negative, so this is too.
+     <gain>   = (n_events, 6) array of the gain, assuming each pulse is from
+            a single photoelectron
+     <mask>   = (n_events, 6, 256) boolean array, True where the voltage is
+            below the threshold'''
+    data = np.asarray(data)
+    if pedestal is not None:
+        data = pedestal.subtract(data, meta)
+        mask = data < pedestal.threshold(meta, nsigma)
+    else:
+        lowerlim = noise_level(data, noise_ch, nsigma)
+        mask = data < lowerlim[:, np.newaxis, np.newaxis].astype(data.dtype)
+
+    # Sum the voltages that exceed our computed noise level
+    integrated_voltage = np.where(mask, data, 0).sum(axis=2,
+        dtype=np.float64)*dt
+    charge = integrated_voltage / resistance
+
+    # Calculate the gain, assuming a single PE.
+    #  (integrated V)/(electron charge * resistance)
+    gain = charge / -ELECTRON_CHARGE
+
+    return charge, gain, mask
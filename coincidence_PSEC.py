@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+import numpy as np
+import charge_PSEC
+import fit_PSEC as fit
+import hits_PSEC
+import position_PSEC
+
+# Builds what each photon did across the whole tile from the hits on the
+#  separate strips. A photoelectron's charge cloud lands on a strip or two
+#  next to each other, and each of those sees a pulse, and then its
+#  reflection off the open end of the strip. So, for a block of events:
+#   - each hit is timed, at its peak, refined between samples by a parabola
+#      through the peak and the samples either side
+#   - a pulse from near the open end runs into its reflection, and they're
+#      one hit with two minima, which are timed the same way
+#   - otherwise a hit followed on the same strip, sooner than the signal can
+#      get to the open end and back, by another is paired with it as its
+#      reflection
+#   - the time between a pulse and its reflection gives where along the
+#      strip it came from (position_PSEC). Where they've run together too
+#      much to see two minima, there's no position, unless <fit_merged>
+#      fits a double gaussian to them, as the older scripts did.
+#   - the pulses of each event are sorted by time, and a gap of more than
+#      <window> between one and the next starts a new coincidence
+#   - the strips in a coincidence are sorted across the tile, and a gap of
+#      more than <max_gap> strips splits it into clusters of neighbours
+#   - each cluster is one hit on the tile. Across the strips it's at the
+#      charge weighted mean of where the strips are, and along them at the
+#      charge weighted mean of the positions of the strips with a reflection
+#      and a pulse well clear of the noise
+# All of it goes through every hit in the block at once, with sorting and
+#  reduceat, as for hits_PSEC, so it keeps up with the high rates of imaging
+#  the whole tile.
+#
+#   hits = hits_PSEC.event_hits(data, meta)
+#   clusters = coincidence_PSEC.build_clusters(hits, data, meta=meta)
+
+# One cluster of neighbouring strips, hit together. Times are in ns,
+#  positions in m and charges in C.
+CLUSTERS = np.dtype([
+    ('index', '<u4'),       # index of the event in the block
+    ('event', '<u4'),       # event counter, from read_PSEC.decode_meta()
+    ('n_strips', '<u1'),    # number of strips in the cluster
+    ('peak', '<u1'),        # index of the channel with the most charge
+    ('time', '<f4'),        # arrival of the pulse on the <peak> strip
+    ('charge', '<f4'),      # total charge, with the reflections. Negative.
+    ('cross', '<f4'),       # position across the strips
+    ('along', '<f4'),       # position along the strips, from the read-out end
+    ('along_error', '<f4'), # uncertainty on <along>
+    ('flags', '<i1'),       # position_PSEC flags of <along>. OK if any of
+                            #  the strips had a position on the strip.
+    ])
+
+def _refine(flat, pos, sample, n_samples):
+    # Offset of the minimum from each sample, from a parabola through it and
+    #  the samples either side, 0 at the ends of a trace
+    inner = (sample > 0) & (sample < n_samples - 1)
+    pos = np.where(inner, pos, 1)
+    y0, y1, y2 = flat[pos - 1], flat[pos], flat[pos + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        step = 0.5*(y0 - y2)/(y0 - 2*y1 + y2)
+    return np.where(inner & np.isfinite(step), np.clip(step, -0.5, 0.5), 0.)
+
+def hit_times(hits, data=None, dt=charge_PSEC.DT):
+    '''Gets the time of each hit, at its peak.
+     <hits> = hits_PSEC.HITS array
+     <data> = the (n_events, 6, 256) voltages the hits were found in, with
+            the hits' 'index' into it, to find the peaks between samples. The
+            peak samples are used if None.
+     <dt>   = time between samples, in s
+    Returns: times
+     <times> = array of the time of each hit, in ns'''
+    times = hits['peak'].astype(np.float64)
+    if data is not None and len(hits):
+        n_channels, n_samples = data.shape[1:]
+        flat = np.asarray(data, dtype=np.float64).ravel()
+        trace = (hits['index'].astype(np.intp)*n_channels +
+            hits['channel'])*n_samples
+        times += _refine(flat, trace + hits['peak'], hits['peak'], n_samples)
+    return times*dt*1e9
+
+def double_peaks(hits, data, noise=0., nsigma=3., fraction=0.5, dip=0.2,
+        min_sep=3, dt=charge_PSEC.DT):
+    '''Looks for a reflection inside each hit, for when a pulse from near the
+    open end runs into its reflection. A hit has one if it has two minima, at
+    least <min_sep> samples apart and both below <fraction> of its
+    amplitude, and comes back up between them by <dip> of the shallower one,
+    and by <nsigma> standard deviations of the noise. The first and last
+    such minima are taken.
+     <hits>  = hits_PSEC.HITS array
+     <data>  = the (n_events, 6, 256) voltages the hits were found in
+     <noise> = standard deviation of the noise, in V, or an array of it for
+            each event
+     <dt>    = time between samples, in s
+    Returns: first, delta_t
+     <first>   = array of the time of the first minimum of each hit, in ns,
+            or its peak if it hasn't got two
+     <delta_t> = array of the time from the first to the last, in ns, NaN
+            if the hit hasn't got two'''
+    first = hit_times(hits, data, dt)
+    delta_t = np.full(len(hits), np.nan)
+    if len(hits) == 0:
+        return first, delta_t
+    n_channels, n_samples = data.shape[1:]
+    flat = np.append(np.asarray(data, dtype=np.float64).ravel(), 0.)
+    trace = (hits['index'].astype(np.intp)*n_channels +
+        hits['channel'])*n_samples
+    start = hits['start'].astype(np.intp)
+    widths = hits['end'].astype(np.intp) - start
+
+    # Every sample of every hit, one after the other
+    run = np.repeat(np.arange(len(hits)), widths)
+    sample = start[run] + np.arange(len(run)) - np.repeat(np.cumsum(widths) -
+        widths, widths)
+    pos = trace[run] + sample
+    y = flat[pos]
+    minimum = ((y < flat[np.maximum(pos - 1, 0)]) & (y <= flat[pos + 1]) &
+        (sample > 0) & (sample < n_samples - 1) &
+        (y < fraction*hits['amplitude'][run]))
+    candidates = np.flatnonzero(minimum)
+    hit, a = np.unique(run[candidates], return_index=True)
+    b = len(candidates) - 1 - np.unique(run[candidates][::-1],
+        return_index=True)[1]
+    a, b = candidates[a], candidates[b]
+
+    # Highest sample between them
+    bounds = np.empty(2*len(a), dtype=np.intp)
+    bounds[0::2] = a
+    bounds[1::2] = b + 1
+    between = np.maximum.reduceat(np.append(y, 0.), bounds)[0::2] \
+        if len(a) else np.zeros(0)
+    shallower = np.maximum(y[a], y[b])
+    noise = np.asarray(noise, dtype=np.float64)
+    if noise.ndim:
+        noise = noise[hits['index'][hit]]
+    two = ((b - a >= min_sep) & (between >= shallower*(1 - dip)) &
+        (between - shallower >= nsigma*noise))
+    hit, a, b = hit[two], a[two], b[two]
+
+    t_a = sample[a] + _refine(flat, pos[a], sample[a], n_samples)
+    t_b = sample[b] + _refine(flat, pos[b], sample[b], n_samples)
+    first[hit] = t_a*dt*1e9
+    delta_t[hit] = (t_b - t_a)*dt*1e9
+    return first, delta_t
+
+def pair_reflections(hits, times, inner=None, calibration=None, slack=0.2):
+    '''Pairs each pulse with its reflection, the next hit on the same channel
+    of the same event if it's soon enough after. A run of hits each close
+    enough to the next is paired off from the start.
+     <hits>        = hits_PSEC.HITS array, in event, channel and time order,
+            as from hits_PSEC.find_hits()
+     <times>       = array of the time of each hit, in ns
+     <inner>       = array of the time to a reflection inside each hit, from
+            double_peaks(). The hits with one aren't paired with another.
+     <calibration> = position_PSEC.Calibration of the tile, for the longest
+            a reflection can take. tile.json's if None.
+     <slack>       = how much longer than that it can be, in ns
+    Returns: direct, delta_t
+     <direct>  = bool array, True for the hits that aren't a reflection
+     <delta_t> = array of the time from each hit to its reflection, in ns,
+            NaN if it hasn't got one or is one'''
+    cal = position_PSEC._calibration(calibration)
+    n = len(hits)
+    channel = hits['channel'].astype(np.intp)
+    longest = 2e9*cal.lookup('length', channel)/cal.lookup('velocity',
+        channel) + slack
+
+    # Whether each hit could be paired with the next
+    link = np.zeros(n, dtype=bool)
+    link[:-1] = ((hits['index'][1:] == hits['index'][:-1]) &
+        (channel[1:] == channel[:-1]) &
+        (times[1:] - times[:-1] <= longest[:-1]))
+    if inner is not None:
+        single = ~np.isfinite(inner)
+        link[:-1] &= single[:-1] & single[1:]
+    # Going along a run of links, every other one is a pair
+    start = link.copy()
+    start[1:] &= ~link[:-1]
+    i = np.arange(n)
+    run_start = np.maximum.accumulate(np.where(start, i, 0)) if n else i
+    paired = link & ((i - run_start) % 2 == 0)
+
+    direct = np.ones(n, dtype=bool)
+    direct[1:] = ~paired[:-1]
+    delta_t = np.full(n, np.nan) if inner is None else \
+        np.array(inner, dtype=np.float64)
+    delta_t[:-1][paired[:-1]] = (times[1:] - times[:-1])[paired[:-1]]
+    return direct, delta_t
+
+def build_clusters(hits, data=None, noise=0., window=0.5, max_gap=1.5,
+        min_snr=10., calibration=None, meta=None, fit_merged=False,
+        dt=charge_PSEC.DT):
+    '''Builds the clusters of neighbouring strips hit at the same time.
+     <hits>        = hits_PSEC.HITS array, in event, channel and time order
+     <data>        = the (n_events, 6, 256) voltages the hits were found in,
+            to time them between samples and find the reflections inside
+            them with double_peaks(). Only the peak samples and the pairs of
+            hits are used if None.
+     <noise>       = standard deviation of the noise in <data>, in V, or an
+            array of it for each event
+     <window>      = longest gap in time between the pulses of a
+            coincidence, in ns
+     <max_gap>     = furthest apart, in strip pitches, neighbouring strips of
+            a cluster can be
+     <min_snr>     = only strips whose pulse is at least this many times the
+            <noise> go into the position along the strips, since the time
+            of a small pulse's reflection is mostly noise
+     <calibration> = position_PSEC.Calibration of the tile, for where the
+            strips are, and the positions along them. tile.json's if None.
+     <meta>        = metadata of the events, for the event counters. The
+            'event' of each hit is used if None.
+     <fit_merged>  = if True, and there's <data>, the clusters without a
+            reflection that could be picked out get their position along the
+            strips from a double gaussian fit to the strip with the most
+            charge instead, as analysis_PSEC.positions() does. Far slower.
+     <dt>          = time between samples, in s
+    Returns: clusters
+     <clusters> = CLUSTERS array with a record for each cluster, in event and
+            time order'''
+    cal = position_PSEC._calibration(calibration)
+    # Pulses are put together by the times of their peaks, but the time of
+    #  a cluster is when the pulse on its biggest strip arrived
+    times = hit_times(hits, data, dt)
+    if data is None:
+        arrival, inner = times, None
+    else:
+        arrival, inner = double_peaks(hits, data, noise, dt=dt)
+    direct, delta_t = pair_reflections(hits, times, inner, cal)
+
+    # Each pulse, with its reflection's charge added on
+    charge = hits['charge'].astype(np.float64)
+    reflected = np.zeros(len(hits), dtype=bool)
+    reflected[:-1] = ~direct[1:]
+    charge[:-1][reflected[:-1]] += charge[1:][reflected[:-1]]
+    pulses = hits[direct]
+    time, arrival = times[direct], arrival[direct]
+    charge, delta_t = charge[direct], delta_t[direct]
+    channel = pulses['channel'].astype(np.intp)
+    along, error, flags = position_PSEC.reflection(delta_t, channel, cal)
+    noise = np.asarray(noise, dtype=np.float64)
+    if noise.ndim:
+        noise = noise[pulses['index']]
+    large = pulses['amplitude'] <= -min_snr*noise
+    cross = cal.lookup('cross', channel)
+
+    # Coincidences in time within each event, and then neighbours across the
+    #  tile within each coincidence
+    index = pulses['index'].astype(np.int64)
+    order = np.lexsort((time, index))
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = ((index[order][1:] != index[order][:-1]) |
+        (np.diff(time[order]) > window))
+    coincidence = np.empty(len(order), dtype=np.int64)
+    coincidence[order] = np.cumsum(new) - 1
+    order = np.lexsort((cross, coincidence))
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = ((coincidence[order][1:] != coincidence[order][:-1]) |
+        (np.diff(cross[order]) > max_gap*cal.get('pitch')))
+    first = np.flatnonzero(new)
+
+    index, arrival, charge, channel = index[order], arrival[order], \
+        charge[order], channel[order]
+    along, error, flags, cross = along[order], error[order], flags[order], \
+        cross[order]
+    large = large[order]
+    clusters = np.zeros(len(first), dtype=CLUSTERS)
+    if len(first) == 0:
+        return clusters
+    n_strips = np.diff(np.append(first, len(order)))
+    cluster = np.repeat(np.arange(len(first)), n_strips)
+
+    # Charge weighted means, the charges being negative
+    weight = np.maximum(-charge, 0.)
+    total = np.add.reduceat(weight, first)
+    valid = (flags == position_PSEC.OK) & large
+    along_weight = np.where(valid, weight, 0.)
+    along_total = np.add.reduceat(along_weight, first)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clusters['cross'] = np.add.reduceat(weight*cross, first)/total
+        clusters['along'] = np.add.reduceat(along_weight*np.where(valid,
+            along, 0.), first)/along_total
+        clusters['along_error'] = np.sqrt(np.add.reduceat(np.square(
+            along_weight*np.where(valid, error, 0.)), first))/along_total
+
+    # The strip with the most charge, the first if they're equal
+    most = np.flatnonzero(weight == np.maximum.reduceat(weight,
+        first)[cluster])
+    most = most[np.unique(cluster[most], return_index=True)[1]]
+
+    clusters['index'] = index[first]
+    clusters['event'] = pulses['event'][order][first] if meta is None else \
+        meta['event'][index[first]]
+    clusters['n_strips'] = np.minimum(n_strips, 255)
+    clusters['peak'] = channel[most]
+    clusters['time'] = arrival[most]
+    clusters['charge'] = np.add.reduceat(charge, first)
+    clusters['flags'] = np.where(along_total > 0, position_PSEC.OK,
+        np.bitwise_or.reduceat(np.where(large, flags, flags |
+        position_PSEC.NO_TIME), first))
+
+    if fit_merged and data is not None:
+        merged = np.flatnonzero(clusters['flags'] != position_PSEC.OK)
+        traces = np.asarray(data)[index[first][merged], channel[most][merged]]
+        optim, status, chisq = fit.fit_double_gaussian_batch(traces,
+            offset=np.median(traces, axis=1), ts=fit.TS)
+        along, error, flags = position_PSEC.reflection(
+            abs(optim[:, 4]-optim[:, 1]), channel[most][merged], cal)
+        flags[~np.isin(status, fit.CONVERGED)] |= position_PSEC.NO_TIME
+        clusters['along'][merged] = along
+        clusters['along_error'][merged] = error
+        clusters['flags'][merged] = flags
+    # In time order within each event
+    return clusters[np.lexsort((clusters['time'], clusters['index']))]
+
+def event_clusters(data, meta, noise_ch=5, nsigma=3.5, release=1.5,
+        min_width=2, pedestal=None, notch=None, window=0.5, max_gap=1.5,
+        min_snr=10., calibration=None, fit_merged=False, dt=charge_PSEC.DT):
+    '''Finds the hits in a block of events, as hits_PSEC.event_hits() does,
+    and builds them into clusters.
+     <noise_ch>, <nsigma>, <release>, <min_width>, <pedestal>, <notch> = as
+            for hits_PSEC.event_hits()
+     <window>, <max_gap>, <min_snr>, <calibration>, <fit_merged> = as for
+            build_clusters()
+     <dt>        = time between samples, in s
+    Returns: clusters
+     <clusters> = CLUSTERS array, as from build_clusters()'''
+    data = hits_PSEC.prepare(data, meta, pedestal, notch)
+    hits = hits_PSEC.event_hits(data, meta, noise_ch, nsigma, release,
+        min_width, pedestal, dt=dt, prepared=True)
+    if pedestal is not None:
+        noise = np.mean(pedestal.noise)
+    else:
+        noise = np.std(data[:, noise_ch, :], axis=1, dtype=np.float64)
+    return build_clusters(hits, data, noise, window, max_gap, min_snr,
+        calibration, meta, fit_merged, dt)
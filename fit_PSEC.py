@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+import numpy as np
+from scipy import optimize
+
+# Fits a double gaussian to the pulses on a PSEC4 channel, to get the time of
+#  the direct and reflected signals. Like the fits this replaced, it
+#  minimises the sum of the squared residuals squared, from the same first
+#  guess, over the whole trace, but it's given the analytic Jacobian of that
+#  rather than leaving leastsq to work it out numerically.
+
+# Time axis of a single sample, in ns
+TS = np.arange(0.0, 25.6, 0.1)
+
+# Status codes from scipy.optimize.leastsq that mean the fit converged
+CONVERGED = (1, 2, 3, 4)
+
+def gaussian(x, height, center, width):
+    return height*np.exp(-(x - center)**2/(2*width**2))
+
+def two_gaussians(x, h1, c1, w1, h2, c2, w2, offset=0):
+    return (gaussian(x, h1, c1, w1) +
+        gaussian(x, h2, c2, w2) + offset)
+
+def chisquare(fobs, fgen):
+    '''Reduced chi square of a fit, skipping any points that are exactly 0.
+     <fobs> = the observed data
+     <fgen> = the model evaluated at the same points'''
+    fobs = np.asarray(fobs, dtype=float)
+    fgen = np.asarray(fgen, dtype=float)
+    good = (fobs != 0) & (fgen != 0)
+    if not np.any(good):
+        return np.nan
+    chi = (fobs[good] - fgen[good])**2/np.abs(fobs[good])
+    return np.sum(chi)/np.sum(good)
+
+def initial_guess(ts, volts, offset=None):
+    '''Guesses the parameters of a double gaussian, with peaks at the first
+    and last times the pulse crosses half its maximum.
+     <ts>     = time of each sample, in ns
+     <volts>  = the channel's voltages
+     <offset> = the baseline to include in the guess. If None, the guess has
+            no offset
+    Returns: guess
+     <guess> = list of [h1, c1, w1, h2, c2, w2(, offset)]'''
+    # Guess the locations of the gaussians
+    halfmax_volt = 0.5 * np.amin(volts)
+    halfmax_t1 = np.argmax(volts<halfmax_volt)
+    halfmax_t1 = ts[halfmax_t1]
+
+    halfmax_t2 = np.argmax(volts[::-1] < halfmax_volt)
+    halfmax_t2 = ts[-1*halfmax_t2]
+
+    # Initial solution guesses two peaks at the leading and trailing edges
+           #   h1,   c1,   w1]
+    guess = [halfmax_volt, halfmax_t1, 0.1,
+            halfmax_volt, halfmax_t2, 0.1]
+    if offset is not None:
+        guess.append(offset)
+    return guess
+
+class _Model(object):
+    # Residuals and Jacobian of two_gaussians() against some data, for
+    #  leastsq. The residuals are squared, as the old error function's were.
+    #  The fit asks for both at the same parameters one after the other, so
+    #  the exponentials are kept from one call to the next. Both gaussians
+    #  are worked out together, as rows of the same arrays.
+    def __init__(self, ts, volts):
+        self.ts = ts
+        self.volts = volts
+        self.key = None
+
+    def _update(self, p):
+        key = p.tobytes()
+        if key == self.key:
+            return
+        self.key = key
+        # The fit can reuse the memory of <p>, so don't keep views of it
+        p = p.copy()
+        self.h = p[0:6:3, np.newaxis]
+        self.w = p[2:6:3, np.newaxis]
+        self.dx = self.ts - p[1:6:3, np.newaxis]
+        self.g = np.exp(-0.5*(self.dx/self.w)**2)
+        self.r = np.dot(p[0:6:3], self.g) - self.volts
+        if len(p) > 6:
+            self.r += p[6]
+
+    def residuals(self, p):
+        self._update(p)
+        return self.r**2
+
+    def jacobian(self, p):
+        # One row per parameter (col_deriv=1)
+        self._update(p)
+        jac = np.empty((len(p), len(self.ts)))
+        rows = jac[:6].reshape(2, 3, len(self.ts))
+        rows[:, 0] = self.g
+        rows[:, 1] = self.h*self.g*self.dx/self.w**2
+        rows[:, 2] = rows[:, 1]*self.dx/self.w
+        if len(p) > 6:
+            jac[6] = 1.
+        return 2*self.r*jac
+
+def fit_double_gaussian(volts, offset=None, ts=TS, guess=None, maxfev=None):
+    '''Fits a double gaussian to the pulses in one channel of one event.
+     <volts>  = the channel's voltages
+     <offset> = initial guess of the baseline. If None, the model is fitted
+            without an offset
+     <ts>     = time of each sample, in ns
+     <guess>  = initial parameters, to use instead of initial_guess()
+     <maxfev> = give up on the fit after this many evaluations of the model.
+            leastsq's own limit, 100*(n_params+1), if None.
+    Returns: optim, status, chisq
+     <optim>  = the fitted [h1, c1, w1, h2, c2, w2(, offset)]
+     <status> = status code of the fit; it converged if this is in CONVERGED
+     <chisq>  = reduced chi square of the fit'''
+    volts = np.asarray(volts, dtype=float)
+    if guess is None:
+        guess = initial_guess(ts, volts, offset)
+    if maxfev is None:
+        maxfev = 100*(len(guess) + 1)
+
+    model = _Model(ts, volts)
+    optim, cov, info, msg, status = optimize.leastsq(model.residuals,
+        guess[:], Dfun=model.jacobian, col_deriv=1, full_output=True,
+        maxfev=maxfev)
+
+    chisq = chisquare(volts, two_gaussians(ts, *optim))
+    return optim, status, chisq
+
+
+# The batch fit below does the same Levenberg-Marquardt fit as leastsq (MINPACK
+#  lmder), but in numpy for a whole block of events at once. Every event keeps
+#  its own damping and trust region, and is dropped from the arrays being
+#  worked on once it has finished.
+
+EPS = np.finfo(float).eps
+
+# Fits whose scaled normal equations get this badly conditioned are too
+#  sensitive to rounding for where they end up to mean much: leastsq itself
+#  can land somewhere else with the last bit of the data changed. The batch
+#  fit gives them the status ILL_CONDITIONED, which isn't in CONVERGED.
+COND_LIMIT = 1e10
+ILL_CONDITIONED = 9
+
+def initial_guesses(ts, volts, offset=None):
+    '''initial_guess() for a block of events at once.
+     <ts>     = time of each sample, in ns
+     <volts>  = (n_events, n_samples) array of the channel's voltages
+     <offset> = (n_events,) array of baselines to include in the guess, or
+            None for no offset
+    Returns: guess
+     <guess> = (n_events, 6 or 7) array of [h1, c1, w1, h2, c2, w2(, offset)]'''
+    volts = np.asarray(volts, dtype=float)
+    n, n_samples = volts.shape
+    halfmax_volt = 0.5 * np.amin(volts, axis=1)
+    below = volts < halfmax_volt[:, np.newaxis]
+    halfmax_t1 = ts[np.argmax(below, axis=1)]
+    # The same as ts[-1*i] in initial_guess(), including ts[0] when i is 0
+    halfmax_t2 = ts[(-np.argmax(below[:, ::-1], axis=1)) % n_samples]
+
+    guess = np.empty((n, 6 if offset is None else 7))
+    guess[:, 0] = halfmax_volt
+    guess[:, 1] = halfmax_t1
+    guess[:, 2] = 0.1
+    guess[:, 3] = halfmax_volt
+    guess[:, 4] = halfmax_t2
+    guess[:, 5] = 0.1
+    if offset is not None:
+        guess[:, 6] = offset
+    return guess
+
+def _batch_model(ts, p):
+    # two_gaussians() for each row of <p>, along with the pieces the
+    #  Jacobian is made from. Those are (n_events, 2, n_samples), with a row
+    #  for each gaussian like in _Model.
+    dx = ts - p[:, 1:6:3, np.newaxis]
+    g = np.exp(-0.5*(dx/p[:, 2:6:3, np.newaxis])**2)
+    f = np.einsum('ij,ijk->ik', p[:, 0:6:3], g)
+    if p.shape[1] > 6:
+        f += p[:, 6:7]
+    return f, dx, g
+
+def _batch_jacobian(p, dx, g, scale):
+    # (n_events, n_params, n_samples), one row per parameter like _Model,
+    #  with each sample's derivatives multiplied by <scale>, (n_events,
+    #  n_samples), as the chain rule for the squared residuals needs
+    n, m = p.shape
+    h = p[:, 0:6:3, np.newaxis]
+    w = p[:, 2:6:3, np.newaxis]
+    jac = np.empty((n, m, dx.shape[2]))
+    rows = jac[:, :6].reshape(n, 2, 3, dx.shape[2])
+    np.multiply(g, scale[:, np.newaxis], out=rows[:, :, 0])
+    rows[:, :, 1] = rows[:, :, 0]*dx*(h/w**2)
+    rows[:, :, 2] = rows[:, :, 1]*dx/w
+    if m > 6:
+        jac[:, 6] = scale
+    return jac
+
+def _batch_residuals(ts, v, p):
+    # Residuals of each event at <p>, before they're squared, and the norm of
+    #  the squared ones. The pieces of the Jacobian come back too, so that
+    #  they needn't be worked out again if the fit moves to <p>.
+    f, dx, g = _batch_model(ts, p)
+    r = f - v
+    r2 = r*r
+    return r, np.sqrt(np.sum(r2*r2, axis=1)), dx, g
+
+def _condition(a):
+    # Condition number of each of a stack of symmetric matrices, or inf if
+    #  it has anything that isn't finite in it
+    cond = np.full(len(a), np.inf)
+    ok = np.all(np.isfinite(a), axis=(1, 2))
+    if np.any(ok):
+        e = np.abs(np.linalg.eigvalsh(a[ok]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cond[ok] = np.amax(e, axis=1)/np.amin(e, axis=1)
+    cond[np.isnan(cond)] = np.inf
+    return cond
+
+def _lmpar(jtj, jtr, delta, par):
+    # Finds the damping of each event that keeps its step inside its trust
+    #  region, as lmpar does in MINPACK. The normal equations are already
+    #  scaled, so the step length is just its norm. If the undamped step fits
+    #  the damping is 0, otherwise it is found to within 10% of <delta> by
+    #  Newton's method, starting from the damping of the last step.
+    n, m = jtr.shape
+    eye = np.eye(m)
+    # Just enough on the diagonal that singular systems can still be solved
+    reg = EPS*m*np.maximum(np.amax(np.einsum('ijj->ij', jtj), axis=1), EPS)
+
+    def solve(rows, damping):
+        a = jtj[rows] + (damping + reg[rows])[:, np.newaxis, np.newaxis]*eye
+        q = np.linalg.solve(a, jtr[rows, :, np.newaxis])
+        # Also (jtj + damping)^-1 q, for the derivative of the step length
+        dq = np.linalg.solve(a, q)
+        return q[:, :, 0], dq[:, :, 0]
+
+    q, dq = solve(slice(None), np.zeros(n))
+    qnorm = np.sqrt(np.sum(q**2, axis=1))
+    fp = qnorm - delta
+    active = fp > 0.1*delta
+    par = np.where(active, par, 0.)
+    if not np.any(active):
+        return par, q
+
+    # Bounds on the damping
+    with np.errstate(divide='ignore', invalid='ignore'):
+        parl = fp/(np.sum(q*dq, axis=1)/qnorm)*qnorm/delta
+    parl = np.where(np.isfinite(parl) & (parl > 0), parl, 0.)
+    gnorm = np.sqrt(np.sum(jtr**2, axis=1))
+    paru = gnorm/delta
+    paru[paru == 0] = np.finfo(float).tiny/np.minimum(delta[paru == 0], 0.1)
+    par = np.minimum(np.maximum(par, parl), paru)
+    par = np.where(par == 0, gnorm/np.where(qnorm > 0, qnorm, 1.), par)
+    par[~active] = 0.
+
+    for i in range(10):
+        a = np.nonzero(active)[0]
+        par[a] = np.where(par[a] == 0,
+            np.maximum(np.finfo(float).tiny, 0.001*paru[a]), par[a])
+        qa, dqa = solve(a, par[a])
+        q[a] = qa
+        qnorm = np.sqrt(np.sum(qa**2, axis=1))
+        last = fp[a]
+        fp[a] = qnorm - delta[a]
+        done = ((np.abs(fp[a]) <= 0.1*delta[a]) |
+            ((parl[a] == 0) & (fp[a] <= last) & (last < 0)))
+        if i == 9:
+            break
+        going = a[~done]
+        active[a[done]] = False
+        if len(going) == 0:
+            break
+        # Newton's step towards the trust region boundary
+        qa, dqa, qnorm = qa[~done], dqa[~done], qnorm[~done]
+        parc = fp[going]/(np.sum(qa*dqa, axis=1)/qnorm)*qnorm/delta[going]
+        parl[going] = np.where(fp[going] > 0,
+            np.maximum(parl[going], par[going]), parl[going])
+        paru[going] = np.where(fp[going] < 0,
+            np.minimum(paru[going], par[going]), paru[going])
+        par[going] = np.maximum(parl[going], par[going] + parc)
+    return par, q
+
+def fit_double_gaussian_batch(volts, offset=None, ts=TS, guess=None,
+        maxfev=None, ftol=1.49012e-8, xtol=1.49012e-8, factor=100.):
+    '''Fits a double gaussian to one channel of a whole block of events at
+    once. It's the same fit as fit_double_gaussian() on each event, without
+    going back to python for every step of every fit. Where that fit is too
+    badly conditioned to end up in the same place twice, it is given the
+    status ILL_CONDITIONED rather than reported as converged.
+     <volts>  = (n_events, n_samples) array of the channel's voltages
+     <offset> = (n_events,) array of initial guesses of the baselines. If
+            None, the model is fitted without an offset
+     <ts>     = time of each sample, in ns
+     <guess>  = (n_events, n_params) array of initial parameters, to use
+            instead of initial_guesses()
+     <maxfev> = give up on an event after this many evaluations of its model.
+            leastsq's own limit, 100*(n_params+1), if None.
+     <ftol>   = converged when the sum of squares changes by less than this
+            fraction
+     <xtol>   = converged when the parameters change by less than this
+            fraction
+     <factor> = initial size of the trust region, relative to the parameters
+    Returns: optim, status, chisq
+     <optim>  = (n_events, n_params) array of the fitted parameters
+     <status> = (n_events,) array of the status code of each fit, as from
+            leastsq, or ILL_CONDITIONED. The fit converged if this is in
+            CONVERGED.
+     <chisq>  = (n_events,) array of the reduced chi square of each fit'''
+    volts = np.asarray(volts, dtype=float)
+    n = len(volts)
+    if offset is not None:
+        offset = np.broadcast_to(np.asarray(offset, dtype=float), (n,))
+    if guess is None:
+        guess = initial_guesses(ts, volts, offset)
+    guess = np.array(guess, dtype=float)
+    optim = guess.copy()
+    m = optim.shape[1]
+    if maxfev is None:
+        maxfev = 100*(m + 1)
+    status = np.zeros(n, dtype=int)
+    if n == 0:
+        return optim, status, np.zeros(0)
+
+    # Events are worked on until they finish, when they're taken out of all
+    #  of these arrays
+    idx = np.arange(n)
+    v = volts
+    p = guess.copy()
+    r, fnorm, dx, g = _batch_residuals(ts, v, p)
+    nfev = np.ones(n, dtype=int)
+    par = np.zeros(n)
+    delta = np.zeros(n)
+    diag = np.zeros((n, m))
+    first = np.ones(n, dtype=bool)
+    stale = np.ones(n, dtype=bool)
+    jtj = np.zeros((n, m, m))
+    jtr = np.zeros((n, m))
+    # Worst condition of each event's scaled normal equations so far
+    cond = np.ones(n)
+    worst = np.ones(n)
+
+    while len(idx):
+        # Normal equations, wherever the last step moved the parameters
+        j = np.nonzero(stale)[0]
+        if len(j):
+            # Squared residuals, like _Model
+            jac = _batch_jacobian(p[j], dx[j], g[j], 2*r[j])
+            jtj[j] = np.matmul(jac, jac.transpose(0, 2, 1))
+            jtr[j] = np.matmul(jac, (r[j]*r[j])[:, :, np.newaxis])[:, :, 0]
+            norms = np.sqrt(np.einsum('ijj->ij', jtj[j]))
+            # Each parameter is scaled by the largest its derivative has been.
+            #  On the first step this also sets the size of the trust region.
+            start = j[first[j]]
+            diag[start] = np.where(norms[first[j]] == 0, 1., norms[first[j]])
+            xnorm = np.sqrt(np.sum((diag[start]*p[start])**2, axis=1))
+            delta[start] = np.where(xnorm == 0, factor, factor*xnorm)
+            diag[j] = np.maximum(diag[j], norms)
+            stale[j] = False
+            cond[j] = np.maximum(cond[j], _condition(
+                jtj[j]/diag[j, :, np.newaxis]/diag[j, np.newaxis, :]))
+
+        # Damped step, in the scaled parameters
+        scaled_jtj = jtj/diag[:, :, np.newaxis]/diag[:, np.newaxis, :]
+        scaled_jtr = jtr/diag
+        bad = ~(np.all(np.isfinite(scaled_jtj), axis=(1, 2)) &
+            np.all(np.isfinite(scaled_jtr), axis=1))
+        scaled_jtj[bad] = np.eye(m)
+        scaled_jtr[bad] = 0.
+        par, q = _lmpar(scaled_jtj, scaled_jtr, delta, par)
+        step = -q/diag
+        pnorm = np.sqrt(np.sum(q**2, axis=1))
+        delta[first] = np.minimum(delta[first], pnorm[first])
+
+        trial = p + step
+        r1, fnorm1, dx1, g1 = _batch_residuals(ts, v, trial)
+        nfev += 1
+
+        # Compare the actual and predicted reductions in the sum of squares,
+        #  and grow or shrink each trust region to suit
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            actred = np.where(0.1*fnorm1 < fnorm, 1 - (fnorm1/fnorm)**2, -1.)
+            temp1 = np.sqrt(np.einsum('ij,ijk,ik->i', step, jtj, step))/fnorm
+            temp2 = np.sqrt(par)*pnorm/fnorm
+            prered = temp1**2 + 2*temp2**2
+            dirder = -(temp1**2 + temp2**2)
+            ratio = np.where(prered != 0, actred/prered, 0.)
+            temp = np.where(actred >= 0, 0.5,
+                0.5*dirder/(dirder + 0.5*actred))
+        actred[~np.isfinite(actred)] = -1.
+        ratio[~np.isfinite(ratio)] = 0.
+        temp[(0.1*fnorm1 >= fnorm) | ~(temp >= 0.1)] = 0.1
+        shrink = ratio <= 0.25
+        grow = ~shrink & ((par == 0) | (ratio >= 0.75))
+        delta[shrink] = (temp*np.minimum(delta, pnorm/0.1))[shrink]
+        par[shrink] = (par/temp)[shrink]
+        delta[grow] = pnorm[grow]/0.5
+        par[grow] = 0.5*par[grow]
+
+        accept = (ratio >= 1e-4) & ~bad
+        p[accept] = trial[accept]
+        fnorm[accept] = fnorm1[accept]
+        r[accept] = r1[accept]
+        dx[accept] = dx1[accept]
+        g[accept] = g1[accept]
+        stale[accept] = True
+        first[accept] = False
+        xnorm = np.sqrt(np.sum((diag*p)**2, axis=1))
+
+        # Same tests as leastsq
+        code = (((np.abs(actred) <= ftol) & (prered <= ftol) &
+            (0.5*ratio <= 1))*1 + (delta <= xtol*xnorm)*2)
+        tests = [(nfev >= maxfev) | bad,
+            (np.abs(actred) <= EPS) & (prered <= EPS) & (0.5*ratio <= 1),
+            delta <= EPS*xnorm]
+        for c, test in zip([5, 6, 7], tests):
+            code[(code == 0) & test] = c
+
+        finished = code != 0
+        if np.any(finished):
+            optim[idx[finished]] = p[finished]
+            status[idx[finished]] = code[finished]
+            worst[idx[finished]] = cond[finished]
+            going = ~finished
+            (idx, v, p, r, fnorm, dx, g, nfev, par, delta, diag, first, stale,
+                jtj, jtr, cond) = [a[going] for a in (idx, v, p, r, fnorm, dx,
+                g, nfev, par, delta, diag, first, stale, jtj, jtr, cond)]
+
+    # Reduced chi square, skipping zeros like chisquare()
+    fgen = _batch_model(ts, optim)[0]
+    good = (volts != 0) & (fgen != 0)
+    chi = np.where(good, (volts - fgen)**2, 0.)/np.where(good, np.abs(volts), 1.)
+    n_good = np.sum(good, axis=1)
+    chisq = np.where(n_good > 0, np.sum(chi, axis=1)/np.maximum(n_good, 1),
+        np.nan)
+
+    status[np.isin(status, CONVERGED) & (worst > COND_LIMIT)] = ILL_CONDITIONED
+    return optim, status, chisq
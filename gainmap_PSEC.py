@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+import os
+import numpy as np
+import hist_PSEC as hist
+import parallel_PSEC as parallel
+import position_PSEC
+import results_PSEC as results
+
+# Builds a gain map of the tile, strip by position along the strip, from the
+#  <name>_gains.psres files that gain_map_PSEC.py and lappd.py gain-map write
+#  for each channel, or the <name>_gains.txt files they used to, with the
+#  position of a pulse, in m, and its gain on each line. Every strip is binned
+#  with a hist_PSEC.Histogram, weighted by the gains, so the whole map is one
+#  pass over the pulses, and maps from several runs can be added together.
+
+# Length of a strip, in cm, from tile.json
+LENGTH = position_PSEC.load().get('length')*100
+# Width of the position bins, in cm
+STEP = 0.2
+# Pulses with less gain than this are left out of the map
+MIN_GAIN = 1e5
+
+def read_gains(fname):
+    '''Reads the pulses from a _gains.psres or _gains.txt file.
+     <fname> = file to read
+    Returns: position, gain
+     <position> = array of the position of each pulse, in m
+     <gain>     = array of their gains'''
+    if results.is_results(fname):
+        records = results.read(fname)
+        return records['position'], records['gain']
+
+    with open(fname, 'rb') as f:
+        text = f.read().decode()
+    values = np.fromstring(text.replace(',', ' '), dtype=float, sep=' ')
+    if len(values) % 2:
+        raise ValueError("%s doesn't have a position and gain on every line"
+            % fname)
+    values = values.reshape(-1, 2)
+    return values[:, 0], values[:, 1]
+
+def strip_histogram(position, gain, step=STEP, length=LENGTH,
+        min_gain=MIN_GAIN):
+    '''Bins the pulses on one strip by position, weighted by their gains.
+     <position> = array of the position of each pulse, in m
+     <gain>     = array of their gains
+     <step>     = width of the position bins, in cm
+     <length>   = length of the strip, in cm
+     <min_gain> = pulses with less gain than this are left out
+    Returns: h
+     <h> = hist_PSEC.Histogram of the positions, in cm, with the gains as the
+            weights'''
+    h = hist.Histogram(int(round(length/step)), (0., length))
+    position = np.asarray(position, dtype=float)
+    gain = np.asarray(gain, dtype=float)
+    keep = gain > min_gain
+    h.fill(position[keep]*100, weights=gain[keep])
+    return h
+
+def _read_strip(fname, step, length, min_gain):
+    # strip_histogram() of a _gains file, or an empty one if it's missing
+    if not os.path.isfile(fname):
+        print("WARNING: %s not found, leaving its strip empty" % fname)
+        return strip_histogram([], [], step, length, min_gain)
+    position, gain = read_gains(fname)
+    return strip_histogram(position, gain, step, length, min_gain)
+
+def gain_map(hists):
+    '''Turns the histogram of each strip into a map.
+     <hists> = list of the hist_PSEC.Histogram of each strip, as from
+            strip_histogram(), all with the same bins
+    Returns: edges, mean, count, var
+     <edges> = the position bin edges, in cm
+     <mean>  = (n_strips, n_bins) array of the mean gain in each bin, NaN
+            where there were no pulses
+     <count> = (n_strips, n_bins) array of the number of pulses in each bin
+     <var>   = (n_strips, n_bins) array of the variance of the gains'''
+    for h in hists[1:]:
+        if not h.compatible(hists[0]):
+            raise ValueError("Every strip has to have the same bins")
+    count = np.array([h.counts for h in hists])
+    sums = np.array([h.sums for h in hists])
+    sums2 = np.array([h.sums2 for h in hists])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums/count
+        var = np.maximum(sums2/count - mean*mean, 0.)
+    return hists[0].edges, mean, count, var
+
+def load_map(fnames, step=STEP, length=LENGTH, min_gain=MIN_GAIN,
+        workers=1):
+    '''Builds the gain map from the _gains file of each strip.
+     <fnames>   = list of the file of each strip, in order across the tile. A
+            missing file leaves its strip empty.
+     <step>, <length>, <min_gain> = as for strip_histogram()
+     <workers>  = number of processes to read the files with. None uses
+            every core.
+    Returns: edges, mean, count, var, as from gain_map()'''
+    hists = parallel.map_files(_read_strip, fnames, workers,
+        args=(step, length, min_gain))
+    return gain_map(hists)
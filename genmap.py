@@ -1,109 +1,77 @@
+import argparse
 import matplotlib.pyplot as plt
 import numpy as np
-
-fnames = [
-'FullMap/Trial1Channel1_gains.txt',
-'FullMap/Trial1Channel2_gains.txt',
-'FullMap/Trial1Channel3_gains.txt',
-'FullMap/Trial1Channel5_gains.txt',
-'FullMap/Trial1Channel6_gains.txt',
-'FullMap/Trial2Channel1_gains.txt',
-'FullMap/Trial2Channel2_gains.txt',
-'FullMap/Trial2Channel3_gains.txt',
-'FullMap/Trial2Channel5_gains.txt',
+import gainmap_PSEC as gainmap
+import parallel_PSEC as parallel
+import position_PSEC
+
+# Draws the gain map of the tile from the _gains.psres (or older _gains.txt)
+#  file of each strip. The strips are given on the command line as
+#  FILE:JUNCTION, in order across the tile, e.g.
+#
+#   python genmap.py FullMap/Trial1Channel1_gains.psres:J35 \
+#       FullMap/Trial1Channel2_gains.psres:J33
+#
+# Without any, it draws the full map below.
+
+strips = [
+('FullMap/Trial1Channel1_gains.txt', 'J35'),
+('FullMap/Trial1Channel2_gains.txt', 'J33'),
+('FullMap/Trial1Channel3_gains.txt', 'J31'),
+('FullMap/Trial1Channel5_gains.txt', 'J29'),
+('FullMap/Trial1Channel6_gains.txt', 'J27'),
+('FullMap/Trial2Channel1_gains.txt', 'J25'),
+('FullMap/Trial2Channel2_gains.txt', 'J23'),
+('FullMap/Trial2Channel3_gains.txt', 'J21'),
+('FullMap/Trial2Channel5_gains.txt', 'J19'),
         ]
 
-labels = [
-'J35',
-'J33',
-'J31',
-'J29',
-'J27',
-'J25',
-'J23',
-'J21',
-'J19'
-    ]
-
-i = 0
-lanes = [1,2,3,4,5]
-
-gains = []
-x = []
-y = []
-
-gains = []
-
-for fname in fnames:
-    x.append([])
-    y.append([])
-    gains.append([])
-    try:
-        with open(fname, 'r') as f:
-            for data in f:
-                data = [float(d) for d in data.split(',')]
-                if data[1] > 1e5:
-                    x[i].append(data[0]*100)
-                    y[i].append(i)
-                    gains[i].append(data[1])
-    except:
-        pass
-    i += 1
-
-
-for i in range(len(fnames)):
-    x_row = x[i]
-    gain_row = gains[i]
-
-    step = 0.2
-    xout    = np.arange(0, 6, step)
-    gainout = np.zeros(xout.shape)
-    Ns      = np.zeros(xout.shape)
-
-    for xi, gi in zip(x_row, gain_row):
-        xi = np.floor(xi/step)*step
-        gainout[np.where(xout==xi)] += gi
-        Ns[np.where(xout==xi)] += 1
-    for j in range(len(xout)):
-        if Ns[j]:
-            gainout[j]/= Ns[j]*1e6
-        else:
-            gainout[j] = None
-
-    x[i] = xout[:-1]
-    gains[i] = gainout[:-1]
-
-x_init = x
-gains_init = gains
-
-fig, axs = plt.subplots(nrows=len(x_init), sharex=True)
-colormap = 'viridis'
-
-
-for i in range(len(x_init)):
-
-    x = np.array(x_init[i])
-    y = np.array(gains_init[i])
-
-    extent = [x[0]-(x[1]-x[0])/2., x[-1]+(x[1]-x[0])/2.,0,1]
-    im = axs[i].imshow(y[np.newaxis,:], cmap=colormap, aspect="auto", 
-        extent=extent, interpolation='hanning')
-    axs[i].set_yticks([])
-    h = axs[i].set_ylabel(labels[i])
-    axs[i].set_xlim(extent[0], extent[1])
-
-axs[0].set_xlabel("Anode Position, cm")
-axs[0].xaxis.tick_top()
-axs[0].xaxis.set_label_position('top')
-
-fig.text(0.03, 0.53, 'Anode Strip', ha='center', va='center', rotation='vertical')
-
-plt.tight_layout()
-
-fig.subplots_adjust(left=0.08, bottom=0.25, hspace=0.0)
-cbar_ax = fig.add_axes([0.08, 0.1, 0.9, 0.05])
-fig.colorbar(im, cax=cbar_ax, orientation='horizontal')
-cbar_ax.set_xlabel('Gain, 1e6')
-
-
-plt.show()
\ No newline at end of file
+def _strip(text):
+    if ':' not in text:
+        raise argparse.ArgumentTypeError("strips are given as FILE:JUNCTION")
+    return tuple(text.rsplit(':', 1))
+
+if __name__ == '__main__':
+    parser = parallel.arguments("Draw the gain map of the tile")
+    parser.add_argument('strips', nargs='*', type=_strip,
+        metavar='FILE:JUNCTION', help='_gains file of each strip, and '
+        'its junction')
+    parser.add_argument('--step', type=float, default=gainmap.STEP,
+        help='width of the position bins, in cm (default: %(default)s)')
+    parser.add_argument('--calibration', metavar='FILE',
+        help='tile calibration with the strip length (default: tile.json)')
+    args = parser.parse_args()
+    fnames, labels = zip(*(args.strips or strips))
+    length = position_PSEC.load(args.calibration).get('length')*100
+
+    edges, mean, count, var = gainmap.load_map(fnames, step=args.step,
+        length=length, workers=args.workers)
+
+    fig, axs = plt.subplots(nrows=len(fnames), sharex=True, squeeze=False)
+    axs = axs[:, 0]
+    colormap = 'viridis'
+    extent = [edges[0], edges[-1], 0, 1]
+
+    for i in range(len(fnames)):
+        im = axs[i].imshow(mean[i][np.newaxis,:]/1e6, cmap=colormap,
+            aspect="auto", extent=extent, interpolation='hanning')
+        axs[i].set_yticks([])
+        h = axs[i].set_ylabel(labels[i])
+        axs[i].set_xlim(extent[0], extent[1])
+
+    axs[0].set_xlabel("Anode Position, cm")
+    axs[0].xaxis.tick_top()
+    axs[0].xaxis.set_label_position('top')
+
+    fig.text(0.03, 0.53, 'Anode Strip', ha='center', va='center',
+        rotation='vertical')
+
+    plt.tight_layout()
+
+    fig.subplots_adjust(left=0.08, bottom=0.25, hspace=0.0)
+    cbar_ax = fig.add_axes([0.08, 0.1, 0.9, 0.05])
+    fig.colorbar(im, cax=cbar_ax, orientation='horizontal')
+    cbar_ax.set_xlabel('Gain, 1e6')
+
+
+    plt.show()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+import numpy as np
+
+# Fixed binning histograms, for filling as the events go by rather than
+#  keeping every value until the end. Memory doesn't grow with the number of
+#  events, and histograms of the same binning from different workers, files
+#  or runs can be added together, so a run can be split up or picked up
+#  again later.
+#
+# As well as the counts, each bin keeps the sum and sum of squares of a
+#  weight. That's the value itself, unless other weights are given, so by
+#  default mean() and std() are those of everything in range. Filling the
+#  positions with the gains as the weights gives the mean gain at each
+#  position from profile().
+
+class Histogram(object):
+    '''Histogram with evenly spaced bins.
+     <bins>  = number of bins
+     <range> = (low, high) edges of the first and last bins. Like
+            np.histogram(), the last bin includes its high edge.'''
+    def __init__(self, bins, range):
+        low, high = float(range[0]), float(range[1])
+        if bins < 1 or not high > low:
+            raise ValueError("Need at least one bin, and high > low")
+        self.edges = np.linspace(low, high, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.sums = np.zeros(bins)
+        self.sums2 = np.zeros(bins)
+        # Number of values below and above the range. NaNs aren't counted.
+        self.underflow = 0
+        self.overflow = 0
+        self._scale = bins/(high - low)
+
+    @property
+    def range(self):
+        return self.edges[0], self.edges[-1]
+
+    @property
+    def centres(self):
+        return 0.5*(self.edges[1:] + self.edges[:-1])
+
+    def _index(self, x):
+        # Bin of each value, -1 below the range and len(counts) above it.
+        #  Rounding is corrected against the edges, as in np.histogram().
+        bins = len(self.counts)
+        low, high = self.range
+        index = np.floor((x - low)*self._scale).astype(np.int64)
+        np.clip(index, -1, bins, out=index)
+        index[x == high] = bins - 1
+        inside = (index >= 0) & (index < bins)
+        lower = inside.copy()
+        lower[inside] = x[inside] < self.edges[index[inside]]
+        index[lower] -= 1
+        upper = (index >= 0) & (index < bins - 1)
+        upper[upper] = x[upper] >= self.edges[index[upper] + 1]
+        index[upper] += 1
+        return index
+
+    def fill(self, x, weights=None):
+        '''Adds values to the histogram.
+         <x>       = one value, or an array of them. NaNs are left out.
+         <weights> = weight of each value, for profile(). The values
+                themselves if None.'''
+        if np.ndim(x) == 0 and weights is None:
+            # One value, without going through numpy
+            x = float(x)
+            low, high = self.edges[0], self.edges[-1]
+            if x < low:
+                self.underflow += 1
+            elif x > high:
+                self.overflow += 1
+            elif x == x:
+                i = min(int((x - low)*self._scale), len(self.counts) - 1)
+                if x < self.edges[i]:
+                    i -= 1
+                elif i < len(self.counts) - 1 and x >= self.edges[i + 1]:
+                    i += 1
+                self.counts[i] += 1
+                self.sums[i] += x
+                self.sums2[i] += x*x
+            return
+
+        x = np.asarray(x, dtype=np.float64).ravel()
+        if weights is None:
+            weights = x
+        else:
+            weights = np.broadcast_to(np.asarray(weights, dtype=np.float64),
+                np.shape(x)).ravel()
+        good = ~np.isnan(x)
+        if not good.all():
+            x, weights = x[good], weights[good]
+        bins = len(self.counts)
+        index = self._index(x)
+        self.underflow += int(np.count_nonzero(index < 0))
+        self.overflow += int(np.count_nonzero(index >= bins))
+        inside = (index >= 0) & (index < bins)
+        index, weights = index[inside], weights[inside]
+        self.counts += np.bincount(index, minlength=bins)
+        self.sums += np.bincount(index, weights, minlength=bins)
+        self.sums2 += np.bincount(index, weights*weights, minlength=bins)
+
+    def compatible(self, other):
+        '''Whether <other> has the same bins as this one'''
+        return (len(self.edges) == len(other.edges) and
+            np.array_equal(self.edges, other.edges))
+
+    def __iadd__(self, other):
+        if not self.compatible(other):
+            raise ValueError("Can't add histograms with different bins")
+        self.counts += other.counts
+        self.sums += other.sums
+        self.sums2 += other.sums2
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    def __add__(self, other):
+        return self.copy().__iadd__(other)
+
+    def copy(self):
+        '''Returns a new histogram with the same bins and contents'''
+        out = Histogram(len(self.counts), self.range)
+        out += self
+        return out
+
+    @property
+    def n(self):
+        '''Number of values in range'''
+        return int(self.counts.sum())
+
+    def mean(self):
+        '''Mean of the weights of everything in range'''
+        return self.sums.sum()/self.n if self.n else np.nan
+
+    def std(self):
+        '''Standard deviation of the weights of everything in range'''
+        if not self.n:
+            return np.nan
+        mean = self.mean()
+        return np.sqrt(max(self.sums2.sum()/self.n - mean*mean, 0.))
+
+    def profile(self):
+        '''Gets the mean and standard deviation of the weights in each bin.
+        Returns: mean, std
+         <mean> = array of the mean weight in each bin, NaN where it's empty
+         <std>  = array of the standard deviations'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.sums/self.counts
+            var = self.sums2/self.counts - mean*mean
+        return mean, np.sqrt(np.maximum(var, 0.))
+
+    def state(self):
+        '''Returns the histogram as a dict of plain lists and numbers, e.g. to
+        store as JSON. from_state() makes it back into a histogram.'''
+        return {'bins': len(self.counts), 'range': list(self.range),
+            'counts': self.counts.tolist(), 'sums': self.sums.tolist(),
+            'sums2': self.sums2.tolist(), 'underflow': self.underflow,
+            'overflow': self.overflow}
+
+FIELDS = ('edges', 'counts', 'sums', 'sums2', 'underflow', 'overflow')
+
+def from_state(state):
+    '''Makes a histogram from the dict given by Histogram.state()'''
+    h = Histogram(state['bins'], state['range'])
+    h.counts += np.array(state['counts'], dtype=np.int64)
+    h.sums += state['sums']
+    h.sums2 += state['sums2']
+    h.underflow = int(state['underflow'])
+    h.overflow = int(state['overflow'])
+    return h
+
+def merge(hists):
+    '''Adds up a list of histograms with the same bins, e.g. one from each
+    worker or file. Returns the total, or None if the list is empty.'''
+    total = None
+    for h in hists:
+        if total is None:
+            total = h.copy()
+        else:
+            total += h
+    return total
+
+def save(fname, hists):
+    '''Writes histograms to a .npz file.
+     <fname> = file to write
+     <hists> = dict of the histograms, by name'''
+    arrays = {}
+    for name in hists:
+        for field in FIELDS:
+            arrays['%s.%s' % (name, field)] = getattr(hists[name], field)
+    with open(fname, 'wb') as f:
+        np.savez(f, **arrays)
+
+def load(fname):
+    '''Reads histograms written by save().
+     <fname> = file to read
+    Returns: hists
+     <hists> = dict of the histograms, by name'''
+    fields = {}
+    with np.load(fname) as arrays:
+        for key in arrays.files:
+            name, field = key.rsplit('.', 1)
+            fields.setdefault(name, {})[field] = arrays[key]
+
+    hists = {}
+    for name in fields:
+        edges = fields[name]['edges']
+        h = Histogram(len(edges) - 1, (edges[0], edges[-1]))
+        h.edges = edges
+        h.counts = fields[name]['counts']
+        h.sums = fields[name]['sums']
+        h.sums2 = fields[name]['sums2']
+        h.underflow = int(fields[name]['underflow'])
+        h.overflow = int(fields[name]['overflow'])
+        hists[name] = h
+    return hists
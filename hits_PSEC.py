@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+import numpy as np
+import charge_PSEC
+import read_PSEC as psec
+
+# Finds every pulse on every channel of a block of PSEC4 events, rather than
+#  taking each trace to hold one pulse and its reflection. A hit is a run of
+#  consecutive samples below the release level, with at least one of them
+#  below the (lower) trigger threshold, so noise wiggling about a single
+#  threshold doesn't split one pulse into several, and a pulse is followed
+#  all the way back to the baseline. Runs shorter than <min_width> samples
+#  are dropped.
+#
+# The runs are found for the whole block at once, from where the mask of
+#  samples below the release level switches on and off along each trace, and
+#  everything about them is added up with reduceat over the runs, so the
+#  cost goes with the number of samples once and then with the number of
+#  hits. The hits come back as a flat table, one record per hit, in event,
+#  channel and time order, ready for results_PSEC.
+
+# One pulse on one channel of one event. Samples are numbered 0-255 along the
+#  trace, and <end> is one past the last sample, like a slice.
+HITS = np.dtype([
+    ('index', '<u4'),     # index of the event in the block
+    ('event', '<u4'),     # event counter, from read_PSEC.decode_meta()
+    ('channel', '<u1'),   # index of the channel, 0-5
+    ('start', '<u2'),     # first sample of the hit
+    ('peak', '<u2'),      # lowest sample
+    ('end', '<u2'),       # one past the last sample
+    ('amplitude', '<f4'), # voltage at the peak, in V. Negative.
+    ('charge', '<f4'),    # integrated charge, in C. Negative.
+    ])
+
+def find_hits(data, threshold, release=None, min_width=2, meta=None,
+        channels=None, dt=charge_PSEC.DT, resistance=charge_PSEC.RESISTANCE):
+    '''Finds every pulse on every channel of a block of events.
+     <data>       = (n_events, 6, 256) array of voltages, in V
+     <threshold>  = a hit has to go below this. Anything that broadcasts
+            against <data>, e.g. one number, a threshold per event from
+            charge_PSEC.noise_level()[:, np.newaxis, np.newaxis], or one per
+            sample from pedestal_PSEC.Pedestal.threshold()
+     <release>    = a hit carries on until the voltage comes back above this.
+            The same as <threshold> if None.
+     <min_width>  = fewest samples below <release> a hit can have
+     <meta>       = metadata of the events, for the event counters. The
+            'event' of each hit is its index in the block if None.
+     <channels>   = indices of the channels to look at, e.g. to leave out a
+            noise channel. All of them if None.
+     <dt>         = time between samples, in s
+     <resistance> = termination resistance, in Ohms
+    Returns: hits
+     <hits> = HITS array with a record for each hit'''
+    data = np.asarray(data)
+    if release is None:
+        release = threshold
+    inside = (data < release) | (data < threshold)
+    if channels is not None:
+        channels = np.asarray(channels, dtype=np.intp)
+        keep = np.zeros(data.shape[1], dtype=bool)
+        keep[channels] = True
+        inside &= keep[:, np.newaxis]
+
+    # Where each run of samples below the release level starts and ends
+    n_samples = data.shape[-1]
+    edges = np.diff(inside.astype(np.int8), axis=-1, prepend=np.int8(0),
+        append=np.int8(0))
+    event, channel, start = np.nonzero(edges == 1)
+    end = np.nonzero(edges == -1)[2]
+    trace = (event*data.shape[1] + channel)*n_samples
+    first = trace + start
+    last = trace + end
+
+    # The flattened voltages, with one more on the end so every run has a
+    #  sample after it for reduceat
+    flat = np.append(data.ravel(), 0).astype(np.float64)
+    bounds = np.empty(2*len(first), dtype=np.intp)
+    bounds[0::2] = first
+    bounds[1::2] = last
+    if len(first):
+        triggered = np.add.reduceat(
+            np.append((data < threshold).ravel(), False), bounds)[0::2] > 0
+        amplitude = np.minimum.reduceat(flat, bounds)[0::2]
+        charge = np.add.reduceat(flat, bounds)[0::2]*dt/resistance
+    else:
+        triggered = np.zeros(0, dtype=bool)
+        amplitude = charge = np.zeros(0)
+
+    good = triggered & (end - start >= min_width)
+    event, channel, start, end = event[good], channel[good], start[good], \
+        end[good]
+    first, amplitude, charge = first[good], amplitude[good], charge[good]
+
+    # The peak is the first sample of each run at its minimum
+    widths = end - start
+    run = np.repeat(np.arange(len(first)), widths)
+    samples = np.arange(len(run)) - np.repeat(np.cumsum(widths) - widths,
+        widths)
+    at_min = np.flatnonzero(
+        flat[np.repeat(first, widths) + samples] == amplitude[run])
+    firsts = np.ones(len(at_min), dtype=bool)
+    firsts[1:] = run[at_min][1:] != run[at_min][:-1]
+    peak = np.zeros(len(first), dtype=np.intp)
+    peak[run[at_min[firsts]]] = samples[at_min[firsts]]
+
+    hits = np.zeros(len(first), dtype=HITS)
+    hits['index'] = event
+    hits['event'] = event if meta is None else meta['event'][event]
+    hits['channel'] = channel
+    hits['start'] = start
+    hits['peak'] = start + peak
+    hits['end'] = end
+    hits['amplitude'] = amplitude
+    hits['charge'] = charge
+    return hits
+
+def prepare(data, meta, pedestal=None, notch=None):
+    '''Subtracts the pedestals from a block of events and filters it, as
+    event_hits() does before looking for hits.
+     <pedestal> = pedestal_PSEC.Pedestal, or None
+     <notch>    = spectrum_PSEC.Notch, or None
+    Returns: data
+     <data> = the voltages, in V. <data> itself if there's neither.'''
+    if pedestal is not None:
+        data = pedestal.subtract(data, meta)
+    if notch is not None:
+        data = notch.apply(data)
+    return data
+
+def event_hits(data, meta, noise_ch=5, nsigma=3.5, release=1.5, min_width=2,
+        pedestal=None, notch=None, dt=charge_PSEC.DT, prepared=False):
+    '''Finds the hits on every channel but the noise channel, with the
+    thresholds from the noise, like charge_PSEC.integrate(). With a pedestal,
+    every channel is looked at.
+     <data>      = (n_events, 6, 256) array of voltages, in V
+     <meta>      = their metadata
+     <noise_ch>  = index of the channel with only noise on it
+     <nsigma>    = trigger threshold, in standard deviations of the noise
+     <release>   = release level, in standard deviations of the noise
+     <min_width> = fewest samples a hit can have
+     <pedestal>  = pedestal_PSEC.Pedestal to subtract first, and take the
+            noise from instead of <noise_ch>, or None
+     <notch>     = spectrum_PSEC.Notch to filter the events with, after the
+            pedestals, or None
+     <dt>        = time between samples, in s
+     <prepared>  = True if <data> has already been through prepare(), so
+            the pedestal is only used for the noise
+    Returns: hits
+     <hits> = HITS array, as from find_hits(). The voltages are above the
+            pedestal, and filtered, if there is one.'''
+    channels = np.arange(psec.N_CHANNELS)
+    if not prepared:
+        data = prepare(data, meta, pedestal, notch)
+    if pedestal is not None:
+        threshold = pedestal.threshold(meta, nsigma)
+        level = pedestal.threshold(meta, release)
+    else:
+        threshold = charge_PSEC.noise_level(data, noise_ch, nsigma)
+        threshold = threshold[:, np.newaxis, np.newaxis]
+        level = charge_PSEC.noise_level(data, noise_ch, release)
+        level = level[:, np.newaxis, np.newaxis]
+        channels = channels[channels != noise_ch]
+    return find_hits(data, threshold, level, min_width, meta, channels, dt)
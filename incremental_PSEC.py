@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import os
+import json
+import numpy as np
+import hist_PSEC as hist
+import read_PSEC as psec
+import results_PSEC as results
+
+# Checkpoints for analysing a log that's still being written, e.g. while
+#  PSEC4.py has LogData running. A checkpoint remembers how far through the
+#  log an analysis got, and what it had added up by then, so the next run only
+#  has to go through the events added since. It's kept next to the log as
+#  <name>_<tag>.ckpt, a line of JSON, with one for each analysis (tag).
+#
+# What's added up can be numbers, in <values>, hist_PSEC histograms, in
+#  <hists>, and records in results files, through writer(). Results files are
+#  cut back to what they held at the last save(), so nothing is counted twice
+#  if a run is stopped between chunks.
+#
+#   ck = incremental.Checkpoint(fname, 'tts')
+#   for data, meta in ck.new_events():
+#       ...
+#       ck.save()
+
+VERSION = 1
+EXT = '.ckpt'
+
+class Checkpoint(object):
+    '''How far an analysis got through a log, and what it had found.
+     <fname> = log file
+     <tag>   = name of the analysis, so that each has its own checkpoint
+    If the log has been started again since, e.g. it was written over, the
+    checkpoint starts again from the top.'''
+    def __init__(self, fname, tag):
+        self.fname = fname
+        self.tag = tag
+        self.cname = os.path.splitext(fname)[0] + '_' + tag + EXT
+        with open(fname, 'rb') as f:
+            self._header = psec.read_header(f)
+        self.reset()
+
+        if not os.path.isfile(self.cname):
+            return
+        try:
+            with open(self.cname, 'r') as f:
+                state = json.load(f)
+        except ValueError:
+            return
+        if (state.get('version') != VERSION or
+                state['header'] != self._header or
+                state['offset'] > os.path.getsize(fname)):
+            return
+        self.offset = state['offset']
+        self.events = state['events']
+        self.values = state['values']
+        self.hists = dict((name, hist.from_state(h))
+            for name, h in state['hists'].items())
+        self._records = state['records']
+
+    def reset(self):
+        '''Forgets everything, to go through the log from the start'''
+        # Byte offset in the log to carry on from, None for the top
+        self.offset = None
+        # Number of events gone through
+        self.events = 0
+        self.values = {}
+        self.hists = {}
+        # Number of records in each results file, at the last save
+        self._records = {}
+        self._writers = {}
+
+    def new_events(self, chunk_size=1024, dtype=np.float32):
+        '''Goes through the events added to the log since the checkpoint. The
+        checkpoint is moved past each chunk as it's given, so save() after
+        dealing with each one. An event that's still being written is left
+        for next time.
+         <chunk_size> = most events to give at a time
+         <dtype>      = numpy type to store the voltages as
+        Yields: data, meta, as from read_PSEC.iter_events()'''
+        for data, meta, stop in psec.iter_from(self.fname, self.offset,
+                chunk_size, dtype):
+            self.offset = stop
+            self.events += len(data)
+            yield data, meta
+
+    def writer(self, rname, dtype=results.RESULTS):
+        '''Opens a results file to add records to, cut back to what it held at
+        the last save().
+         <rname> = results file
+         <dtype> = dtype of the records
+        Returns: writer
+         <writer> = results_PSEC.Writer. It's closed by close().'''
+        if rname not in self._writers:
+            self._writers[rname] = results.Writer(rname, dtype,
+                keep=self._records.get(rname, 0))
+        return self._writers[rname]
+
+    def save(self):
+        '''Writes the checkpoint, after making sure the results files have
+        everything added to them so far'''
+        for rname, w in self._writers.items():
+            w.flush()
+            self._records[rname] = w.n
+        state = {'version': VERSION, 'header': self._header,
+            'offset': self.offset, 'events': self.events,
+            'values': self.values, 'records': self._records,
+            'hists': dict((name, h.state()) for name, h in self.hists.items())}
+
+        # Write to a temporary file first, so a checkpoint is never half
+        #  written
+        tmpname = self.cname + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmpname, self.cname)
+
+    def close(self):
+        '''Closes any results files opened with writer()'''
+        for w in self._writers.values():
+            w.close()
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
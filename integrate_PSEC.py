@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import matplotlib.pyplot as plt
 import read_PSEC as psec
+import charge_PSEC
+import hist_PSEC as hist
 import os
 from Tkinter import *
 import tkFileDialog
@@ -34,63 +36,39 @@ except:
     exit()
 f.close()
 
-t, samples = psec.read(fname)
-dt = (t[1]-t[0]) * 1e-9
+# Gains are binned as they're worked out, a chunk of events at a time, so
+#  memory doesn't grow with the length of the run. Gains over 2e7 are left out.
+gains = hist.Histogram(100, (0., 2e7))
+n_sums = 0
+total = 0.
 
+for data, meta in psec.iter_events(fname):
+    # For each sample, integrate the voltage while it's above the noise
+    #   background. Channel 4 is used as the noise reference, and data more
+    #   than 3 sigma below its mean are summed.
+    charge, gain, mask = charge_PSEC.integrate(data, noise_ch=3, nsigma=3)
 
-# For each sample, integrate the voltage while it's above the noise
-#   background.
-keys = samples.keys()
+    # Sum the total recieved voltage in each sample
+    sums = np.sum(charge, axis=1) * charge_PSEC.RESISTANCE
+    n_sums += len(sums)
+    total += np.sum(sums)
 
+    # For each sum, calculate the gain assuming the event was from a single 
+    #  photoelectron
+    gains.fill(sums / (-1.6e-19 * 50))
 
-sums = np.zeros((6, len(samples)))
-for k in keys:
-    sample = samples[k]
-
-    # Establish the noise level from channel 5
-    zeropoint = np.mean(sample[3])
-    # Get the standard deviation of the noise
-    scatter = np.std(sample[3])
-    # Sum data that are more than 3.5 sigma from the mean
-    lowerlim = zeropoint - (3*scatter)
-
-    # i is the channel number
-    i = 0
-    Vsum = 0.0
-
-    # Integrate the voltages in all samples that rise above the threshold. 
-    for channel in sample:
-    #     plt.plot(np.arange(0.0, 25.6, 0.1), channel, color='red')
-    #     plt.plot(np.arange(0.0, 25.6, 0.1), sample[-2], color='black')
-    #     plt.axhline(lowerlim, color='blue', alpha=0.5)
-    #     plt.axhline(zeropoint, color='green')
-        for point in channel:
-            if point < lowerlim:
-                # Divide by 1000 to convert back from mV to V
-                Vsum += point*dt/1000
-        sums[i][int(k)] = Vsum
-        i += 1
-        Vsum = 0.0
-
-# Sum the total recieved voltage in each sample
-sums = np.sum(sums, axis=0)
 print("Filename: %s" % fname.split('/')[-1])
 print("The mean integrated voltage from this file is %.2g Vs" % 
-    np.mean(sums))
-
-# For each sum, calculate the gain assuming the event was from a single 
-#  photoelectron
-gains = sums / (-1.6e-19 * 50)
-
-gains = gains[np.where(gains < 2e7)]
+    (total/n_sums))
 
 # Assume gains is one half of a normal distribution?
-dev = np.std(gains)
+dev = gains.std()
 
 print("The mean gain from this file is %.4g +/- %.4g" %
-        (np.mean(gains), dev))
+        (gains.mean(), dev))
 
-plt.hist(gains/1e6, facecolor='green', edgecolor='black', bins=25)
+plt.hist(gains.centres/1e6, bins=gains.edges/1e6, weights=gains.counts,
+    facecolor='green', edgecolor='black')
 plt.xlabel("Gain, 1e6")
 plt.ylabel("Frequency")
 # plt.title("The distribution of gains for test\n%s" % fname.split('/')[-1])
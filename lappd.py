@@ -0,0 +1,737 @@
+#!/usr/bin/env python
+import argparse
+import glob
+import os
+import sys
+
+# Command line entry point for the analysis scripts, for running them without
+#  any file dialogues or prompts, e.g. on a headless analysis node:
+#
+#   ./lappd.py integrate DATA/*.txt --noise-ch 4
+#   ./lappd.py gain-map 'DATA/Trial1Channel*.txt' --channel 3 --workers 16
+#
+# Everything the scripts asked for is an option instead. Channels are
+#  numbered 1-6, as on the PSEC. Only argparse is imported to start with;
+#  numpy and the analysis modules are imported by the subcommands, and
+#  matplotlib and bokeh only when something is actually plotted.
+
+def _expand(patterns):
+    # Expands any globs the shell didn't, keeping the order they were given in
+    fnames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise SystemExit("No files match %s" % pattern)
+        fnames.extend(matches)
+    return fnames
+
+def _pyplot():
+    # matplotlib, without needing a display
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def _channel(text):
+    ch = int(text)
+    if ch < 1 or ch > 6:
+        raise argparse.ArgumentTypeError("channels are numbered 1-6")
+    return ch - 1
+
+def _pedestal(args):
+    # The pedestals from --pedestal, measuring them if they aren't cached
+    if not args.pedestal:
+        return None
+    import pedestal_PSEC
+    return pedestal_PSEC.load(args.pedestal, workers=args.workers)
+
+def _sums(data, meta, noise_ch, nsigma, pedestal):
+    # Total integrated voltage of each event in a chunk
+    import numpy as np
+    import charge_PSEC
+    charge, gain, mask = charge_PSEC.integrate(data, noise_ch=noise_ch,
+        nsigma=nsigma, pedestal=pedestal, meta=meta)
+    return np.sum(charge, axis=1) * charge_PSEC.RESISTANCE
+
+def _calibration(args):
+    # The tile calibration from --calibration, or tile.json
+    import position_PSEC
+    return position_PSEC.load(args.calibration)
+
+def _pulse_results(data, meta, ch, noise_ch, nsigma, calibration, pedestal):
+    # Records of the pulses on a channel in a chunk
+    import analysis_PSEC as analysis
+    return analysis.pulse_results(data, meta, ch, noise_ch=noise_ch,
+        nsigma=nsigma, calibration=calibration, pedestal=pedestal)
+
+def _positions(data, meta, ch, calibration):
+    # Positions, validity flags and fit status of each event in a chunk
+    import analysis_PSEC as analysis
+    position, error, flags, status = analysis.positions(data, ch,
+        calibration)
+    return position, flags, status
+
+def _tts_incremental(fname, threshold):
+    # Transit time histograms of a log, carrying on from where the last run
+    #  got to. Returns them as a single chunk, like map_events() would.
+    import analysis_PSEC as analysis
+    import hist_PSEC as hist
+    import incremental_PSEC as incremental
+    with incremental.Checkpoint(fname, 'tts') as ck:
+        if ck.values.get('threshold', threshold) != threshold:
+            ck.reset()
+        ck.values['threshold'] = threshold
+        hists = [ck.hists.setdefault('ch%d' % (ch+1),
+            hist.Histogram(50, (15., 20.))) for ch in range(6)]
+        for key in ('n_laser', 'n_detected'):
+            ck.values.setdefault(key, 0)
+        for data, meta in ck.new_events():
+            chunk_hists, n_laser, n_detected = \
+                analysis.transit_time_histograms(data, meta, threshold, 50,
+                (15., 20.))
+            for h, chunk in zip(hists, chunk_hists):
+                h += chunk
+            ck.values['n_laser'] += n_laser
+            ck.values['n_detected'] += n_detected
+            ck.save()
+        return [(hists, ck.values['n_laser'], ck.values['n_detected'])]
+
+def _gain_map_incremental(fname, oname, ch, noise_ch, nsigma, calibration,
+        pedestal, ped_name):
+    # Adds the pulses in the events added to a log since the last run to its
+    #  results file. Returns every record in the file.
+    import incremental_PSEC as incremental
+    import results_PSEC as results
+    settings = [ch, noise_ch, nsigma, calibration.to_dict(), ped_name]
+    with incremental.Checkpoint(fname, 'gain-map') as ck:
+        if ck.values.get('settings', settings) != settings:
+            ck.reset()
+        ck.values['settings'] = settings
+        out = ck.writer(oname)
+        for data, meta in ck.new_events():
+            out.append(_pulse_results(data, meta, ch, noise_ch, nsigma,
+                calibration, pedestal))
+            ck.save()
+    return results.read(oname)
+
+def integrate(args):
+    '''Reports the mean integrated voltage and gain of each file.
+    Assumes the signal is all from dark noise.'''
+    import numpy as np
+    import parallel_PSEC as parallel
+
+    fnames = _expand(args.files)
+    results = parallel.map_events(_sums, fnames, workers=args.workers,
+        args=(args.noise_ch, args.nsigma, _pedestal(args)))
+    for fname, chunks in zip(fnames, results):
+        sums = np.concatenate(chunks) if chunks else np.zeros(0)
+        print("Filename: %s" % os.path.basename(fname))
+        if len(sums) == 0:
+            print("No pulses")
+            continue
+        print("The mean integrated voltage from this file is %.2g Vs" %
+            np.mean(sums))
+
+        # For each sum, calculate the gain assuming the event was from a
+        #  single photoelectron
+        gains = sums / (-1.6e-19 * 50)
+        gains = gains[gains < args.max_gain]
+        if len(gains) == 0:
+            print("No gains below %.2g" % args.max_gain)
+            continue
+        print("The mean gain from this file is %.4g +/- %.4g" %
+            (np.mean(gains), np.std(gains)))
+
+        if args.plot:
+            plt = _pyplot()
+            plt.hist(gains/1e6, facecolor='green', edgecolor='black', bins=25)
+            plt.xlabel("Gain, 1e6")
+            plt.ylabel("Frequency")
+            plt.tight_layout()
+            plt.savefig(os.path.splitext(fname)[0]+'_gains')
+            plt.clf()
+
+def gain_map(args):
+    '''Writes the position, gain and fit of every pulse on a channel.
+    They go to <name>_gains.psres, for genmap.py and results_PSEC.'''
+    import numpy as np
+    import parallel_PSEC as parallel
+    import results_PSEC as results
+
+    fnames = _expand(args.files)
+    settings = (args.channel, args.noise_ch, args.nsigma, _calibration(args),
+        _pedestal(args))
+    if not args.incremental:
+        found = parallel.map_events(_pulse_results, fnames,
+            workers=args.workers, args=settings)
+    for i, fname in enumerate(fnames):
+        oname = os.path.splitext(fname)[0]+'_gains'+results.EXT
+        if args.incremental:
+            records = _gain_map_incremental(fname, oname,
+                *(settings + (args.pedestal,)))
+        else:
+            records = np.concatenate(found[i] + [results.empty(0)])
+            results.write(oname, records)
+        positions = records['position'].astype(float)
+        gains = records['gain'].astype(float)
+
+        gains = gains[gains > 1e6]
+        print("%s: %d pulses, written to %s" %
+            (os.path.basename(fname), len(positions), oname))
+        if len(gains) == 0:
+            print("No gains above 1e6")
+            continue
+        print("Mean: %.3g\nstd.dev: %.3g" % (np.mean(gains), np.std(gains)))
+
+        if args.plot:
+            plt = _pyplot()
+            plt.hist(positions*100, facecolor='green', edgecolor='black',
+                bins=24)
+            plt.title("Positions of signals")
+            plt.ylabel('Frequency')
+            plt.xlabel('Position, cm')
+            plt.tight_layout()
+            plt.savefig(os.path.splitext(fname)[0]+'_pos')
+            plt.clf()
+
+            plt.hist(np.log10(gains), facecolor='green', edgecolor='black',
+                bins=24)
+            plt.ylabel('Frequency')
+            plt.xlabel('log10(Gain)')
+            plt.tight_layout()
+            plt.savefig(os.path.splitext(fname)[0]+'_gains')
+            plt.clf()
+
+def positions(args):
+    '''Reports where on the strip the pulses on a channel came from.'''
+    import numpy as np
+    import fit_PSEC as fit
+    import parallel_PSEC as parallel
+    import position_PSEC
+
+    fnames = _expand(args.files)
+    calibration = _calibration(args)
+    results = parallel.map_events(_positions, fnames, workers=args.workers,
+        args=(args.channel, calibration))
+    length = calibration.get('length', args.channel)*100
+    for fname, chunks in zip(fnames, results):
+        position = np.concatenate([c[0] for c in chunks] + [np.zeros(0)])
+        flags = np.concatenate([c[1] for c in chunks] +
+            [np.zeros(0, np.int8)])
+        status = np.concatenate([c[2] for c in chunks] + [np.zeros(0, int)])
+        converged = np.isin(status, fit.CONVERGED)
+        superluminal = np.sum(converged &
+            ((flags & position_PSEC.BEFORE_START) > 0))
+        position = position[converged & (flags == position_PSEC.OK)]*100
+
+        print("%s:" % os.path.basename(fname))
+        print("I recorded %d superluminal velocities, of %d samples." %
+            (superluminal, len(position)))
+        if len(position) == 0:
+            print("No pulses on the strip")
+            continue
+        print("Position: %.3g +/- %.3g cm" %
+            (np.mean(position), np.std(position)))
+
+        if args.plot:
+            plt = _pyplot()
+            plt.hist(position, facecolor='green', edgecolor='black', bins=30,
+                range=[0, length])
+            plt.title("Positions of signals")
+            plt.ylabel('Frequency')
+            plt.xlabel('Position, cm')
+            plt.savefig(os.path.splitext(fname)[0]+'_positions')
+            plt.clf()
+
+def tts(args):
+    '''Fits the transit time spread of each channel, over all the files.'''
+    import numpy as np
+    from scipy import optimize
+    import analysis_PSEC as analysis
+    import fit_PSEC as fit
+    import hist_PSEC as hist
+    import parallel_PSEC as parallel
+
+    fnames = _expand(args.files)
+    if args.incremental:
+        results = [_tts_incremental(fname, args.threshold)
+            for fname in fnames]
+    else:
+        results = parallel.map_events(analysis.transit_time_histograms,
+            fnames, workers=args.workers, args=(args.threshold, 50,
+            (15., 20.)))
+    transit_times = [hist.Histogram(50, (15., 20.)) for ch in range(6)]
+    n_laser = 0
+    n_detected = 0
+    for chunks in results:
+        for hists, chunk_laser, chunk_detected in chunks:
+            for ch in range(6):
+                transit_times[ch] += hists[ch]
+            n_laser += chunk_laser
+            n_detected += chunk_detected
+    print("%d laser pulses, %d followed by a signal" % (n_laser, n_detected))
+    if args.save:
+        hist.save(args.save, dict(('ch%d' % (ch+1), transit_times[ch])
+            for ch in range(6)))
+
+    errfunc = lambda p, x, y: fit.gaussian(x, *p) - y
+    for ch in args.channels:
+        tts = transit_times[ch]
+        total = tts.n + tts.underflow + tts.overflow
+        if total == 0:
+            print("Channel %d: no transit times" % (ch+1))
+            continue
+        bins, N = tts.centres, tts.counts
+        optim, success = optimize.leastsq(errfunc, [np.amax(N), 17.1, 0.1],
+            args=(bins, N))
+        print("Channel %d: %d transit times. Mean: %.3lf, Standard "
+            "deviation: %.3lf" % (ch+1, total, optim[1], abs(optim[2])))
+
+        if args.plot:
+            plt = _pyplot()
+            plt.hist(bins, bins=tts.edges, weights=N, facecolor='green',
+                edgecolor='black', label='Data')
+            plt.plot(bins, fit.gaussian(bins, *optim), color='black',
+                label='Normal Distribution')
+            plt.xlabel('Transit time, ns')
+            plt.ylabel('Frequency')
+            plt.savefig('TTS_channel%d' % (ch+1))
+            plt.clf()
+
+def velocities(args):
+    '''Gets the maximum signal velocity of each file.'''
+    import numpy as np
+    import analysis_PSEC as analysis
+    import parallel_PSEC as parallel
+    import results_PSEC as results
+
+    fnames = args.files
+    if args.list:
+        with open(args.list, 'r') as f:
+            fnames = fnames + [line.strip() for line in f if line.strip()]
+    fnames = _expand(fnames)
+
+    per_file = parallel.map_events(analysis.velocities, fnames,
+        workers=args.workers)
+    max_velocities = []
+    for fname, chunks in zip(fnames, per_file):
+        found = np.array([v for chunk in chunks for v in chunk])
+        # Remove values that are too large
+        found = found[found < 3e8]
+        if len(found):
+            max_velocities.append(np.max(found))
+    max_velocities = np.array(max_velocities)
+
+    if len(max_velocities) == 0:
+        print("No velocities below 3e8 m/s")
+    else:
+        print("Mean Velocity: %.3g" % np.mean(max_velocities))
+        print("Standard Deviation: %.3g" % np.std(max_velocities))
+        print("Standard error: %.3g" %
+            (np.std(max_velocities)/np.sqrt(len(max_velocities))))
+
+    if args.output:
+        records = results.empty(len(max_velocities), results.VELOCITIES)
+        records['velocity'] = max_velocities
+        results.write(args.output, records)
+
+def plot(args):
+    '''Plots log files to bokeh HTML.'''
+    import bokeh.plotting as bkh
+    import plot_PSEC4
+
+    for fname in _expand(args.files):
+        oname = os.path.splitext(fname)[0]+'.html'
+        if args.output_dir:
+            if not os.path.exists(args.output_dir):
+                os.makedirs(args.output_dir)
+            oname = os.path.join(args.output_dir, os.path.basename(oname))
+        p = plot_PSEC4.plot_PSEC(fname, oname, events=args.events,
+            max_points=args.max_points)
+        bkh.save(p)
+
+def hits(args):
+    '''Finds every pulse on every channel, to <name>_hits.psres.'''
+    import numpy as np
+    import hits_PSEC
+    import parallel_PSEC as parallel
+    import results_PSEC as results
+
+    fnames = _expand(args.files)
+    notch = None
+    if args.notch:
+        import spectrum_PSEC
+        notch = spectrum_PSEC.load(args.notch)
+    chunk_size = 1024
+    found = parallel.map_events(hits_PSEC.event_hits, fnames, chunk_size,
+        workers=args.workers, args=(args.noise_ch, args.nsigma, args.release,
+        args.min_width, _pedestal(args), notch))
+    for fname, chunks in zip(fnames, found):
+        # Number the events through the whole file, not each chunk
+        for i, chunk in enumerate(chunks):
+            chunk['index'] += i*chunk_size
+        records = np.concatenate(chunks + [np.zeros(0, hits_PSEC.HITS)])
+        oname = os.path.splitext(fname)[0]+'_hits'+results.EXT
+        results.write(oname, records)
+        print("%s: %d hits, written to %s" %
+            (os.path.basename(fname), len(records), oname))
+        for ch in np.unique(records['channel']):
+            on = records[records['channel'] == ch]
+            per_event = np.bincount(np.unique(on['index'],
+                return_inverse=True)[1])
+            print("Channel %d: %d hits in %d events, up to %d in one. "
+                "Mean charge %.3g C" % (ch+1, len(on), len(per_event),
+                np.max(per_event), np.mean(on['charge'])))
+
+def template(args):
+    '''Fits an averaged pulse shape to every channel, to <name>_template.psres.'''
+    import numpy as np
+    import charge_PSEC
+    import parallel_PSEC as parallel
+    import results_PSEC as results
+    import template_PSEC
+
+    fnames = _expand(args.files)
+    channels = np.array(args.channels)
+    if args.build or not os.path.isfile(args.template):
+        found = parallel.map_events(template_PSEC.aligned_sum, fnames,
+            workers=args.workers, args=(channels,))
+        sums = [chunk for chunks in found for chunk in chunks]
+        tpl = template_PSEC.from_sum(sum(total for total, n in sums),
+            sum(n for total, n in sums))
+        template_PSEC.save(args.template, tpl)
+        print("Template of %d pulses written to %s" % (tpl.n, args.template))
+    else:
+        tpl = template_PSEC.load(args.template)
+
+    found = parallel.map_events(template_PSEC.template_results, fnames,
+        workers=args.workers, args=(tpl, channels))
+    for fname, chunks in zip(fnames, found):
+        records = np.concatenate(chunks +
+            [np.zeros(0, template_PSEC.TEMPLATE_RESULTS)])
+        oname = os.path.splitext(fname)[0]+'_template'+results.EXT
+        results.write(oname, records)
+        print("%s: written to %s" % (os.path.basename(fname), oname))
+        for ch in channels:
+            on = records[(records['channel'] == ch) &
+                (records['amplitude'] > args.min_amplitude)]
+            gains = on['charge'].astype(float)/-charge_PSEC.ELECTRON_CHARGE
+            print("Channel %d: %d pulses over %.3g V. Mean gain %.4g +/- %.4g"
+                % (ch+1, len(on), args.min_amplitude, np.mean(gains),
+                np.std(gains)))
+
+def spectrum(args):
+    '''Averages the noise spectrum of each channel, and finds pickup lines.'''
+    import numpy as np
+    import parallel_PSEC as parallel
+    import spectrum_PSEC
+
+    fnames = _expand(args.files)
+    found = parallel.map_events(spectrum_PSEC.spectrum_sum, fnames,
+        workers=args.workers)
+    sums = [chunk for chunks in found for chunk in chunks]
+    if not sums:
+        raise SystemExit("No events in %s" % ' '.join(fnames))
+    freqs, power = spectrum_PSEC.average(sums[0][0],
+        sum(total for f, total, n in sums), sum(n for f, total, n in sums))
+
+    lines = []
+    for ch in range(len(power)):
+        found_lines, strength = spectrum_PSEC.find_lines(freqs, power[ch],
+            args.factor, min_freq=args.min_freq*1e6)
+        print("Channel %d: noise %.3g mV rms%s" % (ch+1,
+            np.sqrt(np.sum(power[ch])*(freqs[1] - freqs[0]))*1e3,
+            ''.join(", line at %.0f MHz (x%.1f)" % (f/1e6, r)
+            for f, r in zip(found_lines, strength))))
+        if ch not in args.ignore:
+            lines.extend(found_lines)
+
+    if args.notch:
+        notch = spectrum_PSEC.Notch(lines)
+        spectrum_PSEC.save(args.notch, notch)
+        print("Notch filter for %d lines written to %s" %
+            (len(notch.lines), args.notch))
+
+    if args.plot:
+        plt = _pyplot()
+        for ch in range(len(power)):
+            plt.semilogy(freqs/1e9, power[ch], label='Channel %d' % (ch+1))
+        plt.xlabel('Frequency, GHz')
+        plt.ylabel('Power, V$^2$/Hz')
+        plt.legend()
+        plt.tight_layout()
+        plt.savefig(os.path.splitext(fnames[0])[0]+'_spectrum')
+        plt.clf()
+
+def clusters(args):
+    '''Builds the hits on neighbouring strips into clusters, each a hit on the
+    tile across and along the strips, to <name>_clusters.psres.'''
+    import numpy as np
+    import coincidence_PSEC
+    import parallel_PSEC as parallel
+    import position_PSEC
+    import results_PSEC as results
+
+    fnames = _expand(args.files)
+    notch = None
+    if args.notch:
+        import spectrum_PSEC
+        notch = spectrum_PSEC.load(args.notch)
+    calibration = _calibration(args)
+    chunk_size = 1024
+    found = parallel.map_events(coincidence_PSEC.event_clusters, fnames,
+        chunk_size, workers=args.workers, args=(args.noise_ch, args.nsigma,
+        args.release, args.min_width, _pedestal(args), notch, args.window,
+        args.max_gap, args.min_snr, calibration, args.fit))
+    for fname, chunks in zip(fnames, found):
+        # Number the events through the whole file, not each chunk
+        for i, chunk in enumerate(chunks):
+            chunk['index'] += i*chunk_size
+        records = np.concatenate(chunks +
+            [np.zeros(0, coincidence_PSEC.CLUSTERS)])
+        oname = os.path.splitext(fname)[0]+'_clusters'+results.EXT
+        results.write(oname, records)
+        print("%s: %d clusters, written to %s" %
+            (os.path.basename(fname), len(records), oname))
+        if len(records) == 0:
+            continue
+        per_event = np.bincount(np.unique(records['index'],
+            return_inverse=True)[1])
+        print("%d events with a cluster, up to %d in one" %
+            (len(per_event), np.max(per_event)))
+        print("Strips per cluster: %s" % ' '.join('%d: %d' % (n, count)
+            for n, count in enumerate(np.bincount(records['n_strips']))
+            if count))
+        placed = records[records['flags'] == position_PSEC.OK]
+        if len(placed) == 0:
+            print("None with a position along the strips")
+            continue
+        print("%d with a position along the strips. Mean %.3g +/- %.3g cm "
+            "along, %.3g +/- %.3g cm across" % (len(placed),
+            np.mean(placed['along'])*100, np.std(placed['along'])*100,
+            np.mean(placed['cross'])*100, np.std(placed['cross'])*100))
+
+        if args.plot:
+            plt = _pyplot()
+            plt.hist2d(placed['cross']*100, placed['along']*100, bins=[60, 60],
+                range=[[np.min(records['cross'])*100 - 0.5,
+                np.max(records['cross'])*100 + 0.5],
+                [0, calibration.get('length')*100]])
+            plt.colorbar(label='Clusters')
+            plt.xlabel('Across the strips, cm')
+            plt.ylabel('Along the strips, cm')
+            plt.tight_layout()
+            plt.savefig(os.path.splitext(fname)[0]+'_clusters')
+            plt.clf()
+
+def pedestal(args):
+    '''Measures the pedestals of pedestal runs, for --pedestal.'''
+    import numpy as np
+    import pedestal_PSEC
+
+    for fname in _expand(args.files):
+        ped = pedestal_PSEC.load(fname, workers=args.workers)
+        print("%s: %d events" % (os.path.basename(fname), ped.events))
+        for ch in range(len(ped.mean)):
+            print("Channel %d: pedestal %.3g to %.3g V, noise %.3g V" %
+                (ch+1, np.min(ped.mean[ch]), np.max(ped.mean[ch]),
+                np.mean(ped.noise[ch])))
+
+def monitor(args):
+    '''Watches a log while it's being written, printing rolling statistics.'''
+    import monitor_PSEC
+
+    if len(args.files) != 1:
+        sys.exit("monitor watches one log file")
+    fname = args.files[0]
+    until = None
+    if args.replay:
+        writer = monitor_PSEC.start_replay(args.replay, fname, args.rate)
+        until = lambda: not writer.is_alive()
+    monitor_PSEC.watch(fname, args.interval, until, noise_ch=args.noise_ch,
+        nsigma=args.nsigma, window=args.window, max_events=args.max_events)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless LAPPD analysis")
+    parser.add_argument('--workers', type=int, default=None,
+        help='number of processes to analyse with (default: every core)')
+    # --workers can also go after the subcommand. Its default there is left
+    #  out, or it would replace one given before the subcommand.
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--workers', type=int, default=argparse.SUPPRESS,
+        help='number of processes to analyse with (default: every core)')
+    commands = parser.add_subparsers(dest='command')
+
+    def command(name, func):
+        sub = commands.add_parser(name, help=func.__doc__.split('\n')[0],
+            description=' '.join(func.__doc__.split()), parents=[common])
+        sub.add_argument('files', nargs='*', help='log files, or globs')
+        sub.set_defaults(func=func)
+        return sub
+
+    sub = command('integrate', integrate)
+    sub.add_argument('--noise-ch', type=_channel, default=3,
+        help='noise reference channel (default: 4)')
+    sub.add_argument('--nsigma', type=float, default=3.)
+    sub.add_argument('--max-gain', type=float, default=2e7,
+        help='leave out gains above this')
+    sub.add_argument('--plot', action='store_true',
+        help='save a histogram of the gains')
+    sub.add_argument('--pedestal', metavar='LOG',
+        help='subtract the pedestals measured from this pedestal run, and '
+            'use their noise instead of --noise-ch')
+
+    sub = command('gain-map', gain_map)
+    sub.add_argument('--channel', type=_channel, required=True)
+    sub.add_argument('--noise-ch', type=_channel, default=5,
+        help='noise reference channel (default: 6)')
+    sub.add_argument('--nsigma', type=float, default=3.5)
+    sub.add_argument('--calibration', metavar='FILE',
+        help='tile calibration with the strip length and signal velocity '
+            '(default: tile.json)')
+    sub.add_argument('--plot', action='store_true',
+        help='save histograms of the positions and gains')
+    sub.add_argument('--pedestal', metavar='LOG',
+        help='subtract the pedestals measured from this pedestal run, and '
+            'use their noise instead of --noise-ch')
+    sub.add_argument('--incremental', action='store_true',
+        help='only go through the events added since the last --incremental '
+            'run, e.g. of a log that is still being written')
+
+    sub = command('positions', positions)
+    sub.add_argument('--channel', type=_channel, required=True)
+    sub.add_argument('--calibration', metavar='FILE',
+        help='tile calibration with the strip length and signal velocity '
+            '(default: tile.json)')
+    sub.add_argument('--plot', action='store_true',
+        help='save a histogram of the positions')
+
+    sub = command('tts', tts)
+    sub.add_argument('--threshold', type=float, default=-0.007,
+        help='signal threshold, in V')
+    sub.add_argument('--channels', type=_channel, nargs='+',
+        default=[0, 1, 2, 3], help='channels to fit (default: 1 2 3 4)')
+    sub.add_argument('--plot', action='store_true',
+        help='save a histogram of each channel')
+    sub.add_argument('--save',
+        help='file to save the histograms to, for hist_PSEC.load()')
+    sub.add_argument('--incremental', action='store_true',
+        help='only go through the events added since the last --incremental '
+            'run, e.g. of a log that is still being written')
+
+    sub = command('velocities', velocities)
+    sub.add_argument('--list',
+        help='file with the names of more log files, one per line')
+    sub.add_argument('--output', metavar='FILE',
+        help='results file to write the velocities to, e.g. '
+            'max_velocities.psres')
+
+    sub = command('plot', plot)
+    sub.add_argument('--output-dir', help='directory to save the plots to')
+    sub.add_argument('--events', type=int, nargs=2, metavar=('FIRST', 'LAST'),
+        help='only plot these events, e.g. to see them at full resolution')
+    sub.add_argument('--max-points', type=int, default=20000,
+        help='decimate longer traces to this many points per channel, '
+            '0 never decimates (default: 20000)')
+
+    sub = command('hits', hits)
+    sub.add_argument('--noise-ch', type=_channel, default=5,
+        help='noise reference channel (default: 6)')
+    sub.add_argument('--nsigma', type=float, default=3.5,
+        help='a hit has to go this many sigma of the noise below the '
+            'baseline (default: 3.5)')
+    sub.add_argument('--release', type=float, default=1.5,
+        help='and lasts until it comes back above this many (default: 1.5)')
+    sub.add_argument('--min-width', type=int, default=2,
+        help='fewest samples in a hit (default: 2)')
+    sub.add_argument('--pedestal', metavar='LOG',
+        help='subtract the pedestals measured from this pedestal run, and '
+            'use their noise instead of --noise-ch')
+    sub.add_argument('--notch', metavar='FILE',
+        help='filter the events with the notch filter from spectrum --notch')
+
+    sub = command('template', template)
+    sub.add_argument('--template', default='template.npz',
+        help='pulse template to fit, made from the files if it does not '
+            'exist (default: template.npz)')
+    sub.add_argument('--build', action='store_true',
+        help='make the template from the files even if it exists')
+    sub.add_argument('--channels', type=_channel, nargs='+',
+        default=[0, 1, 2, 3, 4], help='channels to fit (default: 1-5)')
+    sub.add_argument('--min-amplitude', type=float, default=0.002,
+        help='only count pulses higher than this in the gains, in V '
+            '(default: 0.002)')
+
+    sub = command('spectrum', spectrum)
+    sub.add_argument('--factor', type=float, default=4.,
+        help='a line has to be this many times the spectrum around it '
+            '(default: 4)')
+    sub.add_argument('--min-freq', type=float, default=0.,
+        help='ignore lines below this, in MHz (default: 0)')
+    sub.add_argument('--ignore', type=_channel, nargs='+', default=[],
+        help='channels whose lines are left out of the notch filter, e.g. '
+            'the laser')
+    sub.add_argument('--notch', metavar='FILE',
+        help='write a notch filter for the lines to FILE, for hits --notch')
+    sub.add_argument('--plot', action='store_true',
+        help='save a plot of the spectra')
+
+    sub = command('clusters', clusters)
+    sub.add_argument('--noise-ch', type=_channel, default=5,
+        help='noise reference channel (default: 6)')
+    sub.add_argument('--nsigma', type=float, default=3.5,
+        help='a hit has to go this many sigma of the noise below the '
+            'baseline (default: 3.5)')
+    sub.add_argument('--release', type=float, default=1.5,
+        help='and lasts until it comes back above this many (default: 1.5)')
+    sub.add_argument('--min-width', type=int, default=2,
+        help='fewest samples in a hit (default: 2)')
+    sub.add_argument('--pedestal', metavar='LOG',
+        help='subtract the pedestals measured from this pedestal run, and '
+            'use their noise instead of --noise-ch')
+    sub.add_argument('--notch', metavar='FILE',
+        help='filter the events with the notch filter from spectrum --notch')
+    sub.add_argument('--window', type=float, default=0.5,
+        help='longest gap between the pulses of a coincidence, in ns '
+            '(default: 0.5)')
+    sub.add_argument('--max-gap', type=float, default=1.5,
+        help='furthest apart neighbouring strips of a cluster can be, in '
+            'strip pitches (default: 1.5)')
+    sub.add_argument('--min-snr', type=float, default=10.,
+        help='smallest pulse, in sigma of the noise, to time a reflection '
+            'from (default: 10)')
+    sub.add_argument('--calibration', metavar='FILE',
+        help='tile calibration with the strip length, signal velocity and '
+            'where the strips are (default: tile.json)')
+    sub.add_argument('--fit', action='store_true',
+        help='fit a double gaussian to pulses that have run into their '
+            'reflections, for their position along the strips. Far slower.')
+    sub.add_argument('--plot', action='store_true',
+        help='save an image of the clusters on the tile')
+
+    sub = command('pedestal', pedestal)
+
+    sub = command('monitor', monitor)
+    sub.add_argument('--interval', type=float, default=1.,
+        help='seconds between refreshes (default: 1)')
+    sub.add_argument('--window', type=float, default=10.,
+        help='seconds the rates are averaged over (default: 10)')
+    sub.add_argument('--max-events', type=int, default=1024,
+        help='most events to go through each refresh (default: 1024)')
+    sub.add_argument('--noise-ch', type=_channel, default=5,
+        help='noise reference channel (default: 6)')
+    sub.add_argument('--nsigma', type=float, default=3.5)
+    sub.add_argument('--replay', metavar='LOG',
+        help='write out LOG to the file at --rate, instead of LogData')
+    sub.add_argument('--rate', type=float, default=100.,
+        help='events per second to replay (default: 100)')
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    args.func(args)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import threading
+from collections import deque
+import numpy as np
+import charge_PSEC
+import hist_PSEC as hist
+import read_PSEC as psec
+
+# Watches a log while LogData is still writing it, so a bad run shows up
+#  straight away rather than when it's finished. Each refresh goes through the
+#  whole events that have landed since the last one, and keeps:
+#   - the recording and trigger rates, from the event counter in the 7th
+#      column, and how many triggers were missed
+#   - the rate of pulses on each channel, a pulse being anything that
+#      charge_PSEC.integrate() counts
+#   - a histogram of the gains of the pulses
+# Rates are averaged over the last few seconds. At most <max_events> events
+#  are gone through each refresh, and the rest of the interval is slept, so
+#  the monitor never takes more than its share of the CPU. If the events come
+#  in faster than that it falls behind, and the status line says how far.
+#
+# replay() stands in for LogData, writing out an existing log at a set rate,
+#  so all of this can be tried without the PSEC, e.g.
+#
+#   ./lappd.py monitor /tmp/live.txt --replay DATA/sample.txt --rate 200
+
+class Monitor(object):
+    '''Rolling statistics of a log that's being written.
+     <fname>      = log file. It doesn't have to exist yet.
+     <noise_ch>   = index of the channel with only noise on it
+     <nsigma>     = pulse threshold, in standard deviations of the noise
+     <window>     = number of seconds the rates are averaged over
+     <max_events> = most events to go through in each update()'''
+    def __init__(self, fname, noise_ch=5, nsigma=3.5, window=10.,
+            max_events=1024):
+        self.fname = fname
+        self.noise_ch = noise_ch
+        self.nsigma = nsigma
+        self.window = window
+        self.max_events = max_events
+        # Byte offset in the log to carry on from
+        self.offset = None
+        # Number of events recorded, and the first and last event counter
+        self.events = 0
+        self.first_counter = None
+        self.last_counter = None
+        # Number of pulses on each channel
+        self.pulses = np.zeros(psec.N_CHANNELS, dtype=np.int64)
+        # log10 of the gains, weighted by the gains so mean() is the mean gain
+        self.gains = hist.Histogram(60, (3., 9.))
+        # (time, events, triggers, pulses) at each update, for the rates
+        self._history = deque()
+
+    def _add(self, data, meta):
+        # Adds a chunk of events to the statistics
+        self.events += len(data)
+        if len(meta):
+            if self.first_counter is None:
+                self.first_counter = int(meta['event'][0])
+            self.last_counter = int(meta['event'][-1])
+
+        charge, gain, mask = charge_PSEC.integrate(data,
+            noise_ch=self.noise_ch, nsigma=self.nsigma)
+        hit = np.any(mask, axis=2)
+        hit[:, self.noise_ch] = False
+        self.pulses += np.sum(hit, axis=0)
+        gain = gain[hit]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.gains.fill(np.log10(gain), weights=gain)
+
+    def update(self, now=None):
+        '''Goes through the whole events written since the last update, up to
+        <max_events> of them.
+         <now> = the time, in s. time.time() if None.
+        Returns: n
+         <n> = number of events gone through'''
+        n = 0
+        if os.path.isfile(self.fname):
+            for data, meta, stop in psec.iter_from(self.fname, self.offset,
+                    self.max_events):
+                self.offset = stop
+                self._add(data, meta)
+                n += len(data)
+                if n >= self.max_events:
+                    break
+
+        now = time.time() if now is None else now
+        self._history.append((now, self.events, self.triggers(),
+            self.pulses.copy()))
+        # Keep one update from before the window, to measure the rates from
+        while len(self._history) > 2 and \
+                self._history[1][0] <= now - self.window:
+            self._history.popleft()
+        return n
+
+    def triggers(self):
+        '''Number of triggers since the first event, from the event counter'''
+        if self.first_counter is None:
+            return 0
+        return self.last_counter - self.first_counter + 1
+
+    def behind(self):
+        '''Number of bytes of the log not gone through yet'''
+        if not os.path.isfile(self.fname) or self.offset is None:
+            return 0
+        return max(os.path.getsize(self.fname) - self.offset, 0)
+
+    def status(self):
+        '''Gets the statistics so far.
+        Returns: dict of
+         <events>       = number of events recorded
+         <missed>       = number of triggers the event counter skipped
+         <event_rate>   = events recorded per second, over the window
+         <trigger_rate> = triggers per second from the event counter
+         <pulse_rate>   = array of the pulses per second on each channel
+         <occupancy>    = array of the fraction of all the events with a pulse
+                on each channel
+         <gain>, <gain_std> = mean and standard deviation of the gains of the
+                pulses, or NaN if there haven't been any'''
+        event_rate = trigger_rate = 0.
+        pulse_rate = np.zeros(psec.N_CHANNELS)
+        if len(self._history) > 1:
+            t0, events0, triggers0, pulses0 = self._history[0]
+            t1, events1, triggers1, pulses1 = self._history[-1]
+            dt = t1 - t0
+            if dt > 0:
+                event_rate = (events1 - events0)/dt
+                trigger_rate = (triggers1 - triggers0)/dt
+                pulse_rate = (pulses1 - pulses0)/dt
+
+        return dict(events = self.events,
+                    missed = max(self.triggers() - self.events, 0),
+                    event_rate = event_rate,
+                    trigger_rate = trigger_rate,
+                    pulse_rate = pulse_rate,
+                    occupancy = self.pulses/float(max(self.events, 1)),
+                    gain = self.gains.mean(),
+                    gain_std = self.gains.std())
+
+    def summary(self):
+        '''Returns the statistics as one line of text'''
+        s = self.status()
+        line = ("%d events (%d missed), %.1f/s recorded, %.1f/s triggered | "
+            "pulses/s: %s | gain %.3g +/- %.3g" % (s['events'], s['missed'],
+            s['event_rate'], s['trigger_rate'],
+            ' '.join('%.1f' % r for r in s['pulse_rate']), s['gain'],
+            s['gain_std']))
+        behind = self.behind()
+        if behind > psec.EVENT_BYTES:
+            line += " | %d events behind" % (behind // psec.EVENT_BYTES)
+        return line
+
+def watch(fname, interval=1., until=None, out=sys.stdout, **kwargs):
+    '''Watches a log, printing the statistics every refresh.
+     <fname>    = log file
+     <interval> = seconds between refreshes
+     <until>    = function that returns True once the log is finished, e.g.
+            when LogData has exited. None watches until interrupted.
+     <out>      = file to print the statistics to
+     <kwargs>   = anything else to give Monitor
+    Returns: monitor
+     <monitor> = the Monitor, with everything in the log once it finished'''
+    monitor = Monitor(fname, **kwargs)
+    try:
+        while True:
+            start = time.time()
+            finished = until is not None and until()
+            monitor.update()
+            out.write(monitor.summary() + '\n')
+            out.flush()
+            if finished and monitor.behind() < psec.EVENT_BYTES:
+                break
+            time.sleep(max(interval - (time.time() - start), 0.))
+    except KeyboardInterrupt:
+        pass
+    return monitor
+
+def replay(src, dst, rate=100., tick=0.05):
+    '''Writes out an existing log a bit at a time, as LogData would, to test
+    the monitor with. Events, and lines, are left half written between ticks.
+     <src>  = log file to copy
+     <dst>  = file to write it to. Anything already there is replaced.
+     <rate> = events per second to write
+     <tick> = seconds between writes'''
+    starts, stops, header = psec.build_index(src, save=False)
+    with open(src, 'rb') as f:
+        head = f.read(int(starts[0]) if len(starts) else 0)
+        body = f.read(int(stops[-1]) - len(head) if len(stops) else 0)
+    # Byte offset of the end of each event in <body>
+    ends = np.concatenate(([0], stops.astype(np.int64) - len(head)))
+
+    with open(dst, 'wb') as f:
+        f.write(head)
+        f.flush()
+        written = 0
+        start = time.time()
+        while written < len(body):
+            time.sleep(tick)
+            # Where we should be, part way through an event
+            done = (time.time() - start)*rate
+            k = min(int(done), len(ends) - 1)
+            frac = done - k if k < len(ends) - 1 else 0.
+            target = ends[k]
+            if k < len(ends) - 1:
+                target += int(frac*(ends[k + 1] - ends[k]))
+            if target > written:
+                f.write(body[written:target])
+                f.flush()
+                written = target
+
+def start_replay(src, dst, rate=100., tick=0.05):
+    '''Runs replay() in the background.
+    Returns: thread
+     <thread> = the threading.Thread writing the log, which stops being
+            alive once it's all written'''
+    thread = threading.Thread(target=replay, args=(src, dst, rate, tick))
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cache_PSEC
+import read_PSEC as psec
+
+# Spreads an analysis over several processes. Files are the outer unit of
+#  work and chunks of events within a file the inner one. Each log is parsed
+#  once, into its binary cache, and the workers then memory map their chunk
+#  of events straight out of the cache, so only the file name and the range
+#  of events are sent to them rather than pickled arrays. Results always come
+#  back in the order of the files and events they came from, however many
+#  workers there are.
+#
+# The functions handed to map_files() and map_events() are sent to the
+#  workers by name, so they have to be defined at the top level of a module,
+#  and a script using them should keep its own work under
+#  if __name__ == '__main__'.
+
+def cpu_count():
+    '''Number of cores on this machine, the default number of workers'''
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def arguments(description=None):
+    '''Makes an argument parser with the --workers option, for scripts to add
+    their own options to.
+     <description> = description of the script, for --help
+    Returns: parser
+     <parser> = argparse.ArgumentParser'''
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+        help='number of processes to analyse with (default: %(default)s)')
+    return parser
+
+class _Serial(object):
+    # Stands in for the process pool with one worker, so that everything is
+    #  done here and nothing has to be pickled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def map(self, func, *iterables):
+        return map(func, *iterables)
+
+def _pool(workers):
+    if workers is None:
+        workers = cpu_count()
+    if workers <= 1:
+        return _Serial()
+    return ProcessPoolExecutor(max_workers=workers)
+
+def _call(job):
+    func, call_args = job
+    return func(*call_args)
+
+def map_files(func, fnames, workers=None, args=()):
+    '''Calls func(fname, *args) for every file, spread over the workers.
+     <func>    = function to call, defined at the top level of a module
+     <fnames>  = list of files
+     <workers> = number of processes to use. 1 does everything in this
+            process, None uses every core.
+     <args>    = any more arguments to give <func>
+    Returns: results
+     <results> = list of what <func> returned for each file, in the same order
+            as <fnames>'''
+    with _pool(workers) as pool:
+        return list(pool.map(_call, [(func, (fname,) + tuple(args))
+            for fname in fnames]))
+
+# Memory maps of the caches this process has opened, so that each worker
+#  only opens a file once
+_caches = {}
+
+def _events(fname):
+    if fname not in _caches:
+        cached = cache_PSEC.load(fname)
+        if cached is None or 'meta' not in cached[0]:
+            raise IOError("The cache for %s is missing or out of date" % fname)
+        _caches[fname] = cached[0]
+    return _caches[fname]
+
+def _prepare(fname):
+    # Parses a log into its cache if it isn't already. Returns the number of
+    #  events, or None if the cache can't be used.
+    meta = psec.load_meta(fname)
+    if cache_PSEC.load(fname) is None:
+        return None
+    return len(meta)
+
+def _run_chunk(func, fname, start, stop, args):
+    # Runs <func> on a slice of the memory mapped events of a file
+    arrays = _events(fname)
+    return func(arrays['data'][start:stop], arrays['meta'][start:stop],
+        *args)
+
+def _run_file(func, fname, chunk_size, args):
+    # Without a cache, the chunks of a file can't be got at separately, so
+    #  the file is streamed through one worker instead
+    return [func(data, meta, *args)
+        for data, meta in psec.iter_events(fname, chunk_size, cache=False)]
+
+def map_events(func, fnames, chunk_size=1024, workers=None, args=()):
+    '''Calls func(data, meta, *args) for every chunk of events in every file,
+    spread over the workers.
+     <func>       = function to call, defined at the top level of a module.
+            It gets the (n, 6, 256) voltages of a chunk of events, in V, and
+            their metadata, like from read_PSEC.iter_events()
+     <fnames>     = list of log files, or a single file name
+     <chunk_size> = number of events in each chunk
+     <workers>    = number of processes to use. 1 does everything in this
+            process, None uses every core.
+     <args>       = any more arguments to give <func>
+    Returns: results
+     <results> = for each file, the list of what <func> returned for each of
+            its chunks, in order. If <fnames> was a single name, just the list
+            for that file.'''
+    single = isinstance(fnames, str)
+    if single:
+        fnames = [fnames]
+    args = tuple(args)
+
+    with _pool(workers) as pool:
+        # Get every file into its cache first, one file per worker
+        n_events = list(pool.map(_prepare, fnames))
+
+        jobs = []
+        owners = []
+        for i, (fname, n) in enumerate(zip(fnames, n_events)):
+            if n is None:
+                jobs.append((_run_file, (func, fname, chunk_size, args)))
+                owners.append((i, True))
+                continue
+            for start in range(0, n, chunk_size):
+                jobs.append((_run_chunk, (func, fname, start,
+                    min(start + chunk_size, n), args)))
+                owners.append((i, False))
+
+        results = [[] for fname in fnames]
+        for (i, whole), result in zip(owners, pool.map(_call, jobs)):
+            if whole:
+                results[i].extend(result)
+            else:
+                results[i].append(result)
+
+    if single:
+        return results[0]
+    return results
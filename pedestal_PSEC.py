@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+import numpy as np
+import cache_PSEC
+import parallel_PSEC as parallel
+import read_PSEC as psec
+
+# Pedestal calibration of the PSEC4. Every storage cell of the ring buffer
+#  sits at its own voltage with nothing coming in, and has its own noise, so
+#  rather than taking the mean and spread of a noise channel in every event,
+#  these are measured once for every channel and cell from a pedestal run: a
+#  log taken with nothing on the inputs, e.g. straight after TakePed. The
+#  tables are cached next to the run's log as <name>.psped, in the same
+#  format as cache_PSEC, and rebuilt if the log changes.
+#
+# Sample i of an event comes from storage cell (cell + i) % 256, where cell
+#  is the wraparound cell in the event's metadata. The tables are kept rotated
+#  to start from every possible wraparound cell, so the pedestals of a whole
+#  block of events are one lookup, and subtracting them one broadcast.
+#
+#   ped = pedestal_PSEC.load('DATA/pedestal.txt')
+#   for data, meta in read_PSEC.iter_events(fname):
+#       data = ped.subtract(data, meta)
+
+EXT = '.psped'
+
+def storage_cells(meta):
+    '''Gets the storage cell each sample of each event came from.
+     <meta> = metadata of the events, as from read_PSEC.decode_meta()
+    Returns: cells
+     <cells> = (n_events, 256) array of the storage cell of each sample'''
+    start = np.asarray(meta['cell']).astype(np.intp)[:, np.newaxis]
+    return (start + np.arange(psec.N_CELLS)) % psec.N_CELLS
+
+def _rotations(table):
+    # (256, 6, 256) array of <table> rotated to start from each wraparound
+    #  cell, so that rotations[cell][ch, i] is table[ch, (cell + i) % 256]
+    cells = (np.arange(psec.N_CELLS)[:, np.newaxis] +
+        np.arange(psec.N_CELLS)) % psec.N_CELLS
+    return np.ascontiguousarray(table[:, cells].transpose(1, 0, 2))
+
+class Pedestal(object):
+    '''Pedestal and noise of every storage cell of every channel.
+     <mean>   = (6, 256) array of the pedestal of each channel and storage
+            cell, in V
+     <noise>  = (6, 256) array of the standard deviation of each about its
+            pedestal, in V
+     <events> = number of events they were measured from'''
+    def __init__(self, mean, noise, events=0):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.noise = np.asarray(noise, dtype=np.float32)
+        self.events = events
+        self._mean = _rotations(self.mean)
+        self._noise = _rotations(self.noise)
+
+    def __getstate__(self):
+        # Only send the tables to the workers, not all their rotations
+        return {'mean': self.mean, 'noise': self.noise, 'events': self.events}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _cells(self, meta):
+        return np.asarray(meta['cell']).astype(np.intp) % psec.N_CELLS
+
+    def pedestals(self, meta):
+        '''Returns the (n_events, 6, 256) pedestal under each sample of the
+        events in <meta>'''
+        return self._mean[self._cells(meta)]
+
+    def subtract(self, data, meta, out=None):
+        '''Subtracts the pedestals from a block of events.
+         <data> = (n_events, 6, 256) array of the voltages, in V
+         <meta> = their metadata, for the wraparound cells
+         <out>  = array to put the result in, which can be <data> itself.
+                A new one if None.
+        Returns: data
+         <data> = the voltages above the pedestal'''
+        return np.subtract(data, self._mean[self._cells(meta)], out=out,
+            dtype=np.result_type(data, np.float32))
+
+    def threshold(self, meta, nsigma):
+        '''Gets the threshold below which a pedestal subtracted sample counts
+        as signal.
+         <meta>   = metadata of the events
+         <nsigma> = how many standard deviations of the noise below the
+                pedestal the threshold is
+        Returns: lowerlim
+         <lowerlim> = (n_events, 6, 256) array of the threshold of every
+                sample'''
+        return -nsigma*self._noise[self._cells(meta)]
+
+def _sums(data, meta):
+    # Number of events, and the sum and sum of squares of the voltages of
+    #  each channel and storage cell, over a chunk of events
+    start = np.asarray(meta['cell']).astype(np.intp)[:, np.newaxis]
+    # Put each event's samples back in storage cell order
+    samples = (np.arange(psec.N_CELLS) - start) % psec.N_CELLS
+    stored = np.take_along_axis(np.asarray(data, dtype=np.float64),
+        samples[:, np.newaxis, :], axis=2)
+    return len(data), stored.sum(axis=0), (stored*stored).sum(axis=0)
+
+def build(fname, chunk_size=1024, workers=None):
+    '''Measures the pedestals from a pedestal run.
+     <fname>      = log file of the pedestal run
+     <chunk_size> = number of events to go through at a time
+     <workers>    = number of processes to use. None uses every core.
+    Returns: pedestal
+     <pedestal> = Pedestal'''
+    n = 0
+    sums = np.zeros((psec.N_CHANNELS, psec.N_CELLS))
+    sums2 = np.zeros((psec.N_CHANNELS, psec.N_CELLS))
+    for chunk_n, chunk_sums, chunk_sums2 in parallel.map_events(_sums, fname,
+            chunk_size, workers):
+        n += chunk_n
+        sums += chunk_sums
+        sums2 += chunk_sums2
+    if n == 0:
+        raise ValueError("%s has no events to measure the pedestals from" %
+            fname)
+    mean = sums/n
+    noise = np.sqrt(np.maximum(sums2/n - mean*mean, 0.))
+    return Pedestal(mean, noise, n)
+
+def save(fname, pedestal, source=None):
+    '''Caches the pedestals measured from the pedestal run <fname> next to it.
+    <source> is the cache_PSEC.stamp() of the log from before the pedestals
+    were measured, or None for the log as it is now.
+    Returns the name of the file written, or None if it couldn't be.'''
+    with open(fname, 'rb') as f:
+        header = psec.read_header(f)
+    return cache_PSEC.save(fname, {'mean': pedestal.mean,
+        'noise': pedestal.noise, 'events': np.array([pedestal.events])},
+        header, ext=EXT, source=source)
+
+def load(fname, build_missing=True, workers=None):
+    '''Gets the pedestals of a pedestal run, from its cache if it's up to
+    date.
+     <fname>         = log file of the pedestal run
+     <build_missing> = if True, the pedestals are measured and cached if the
+            cache is missing or out of date
+     <workers>       = number of processes to measure them with
+    Returns: pedestal
+     <pedestal> = Pedestal, or None if there's no cache and <build_missing>
+            is False'''
+    cached = cache_PSEC.load(fname, ext=EXT)
+    if cached is not None:
+        arrays = cached[0]
+        return Pedestal(arrays['mean'], arrays['noise'],
+            int(arrays['events'][0]))
+    if not build_missing:
+        return None
+    # Stamped first, so if the run is still being written the cache is out of
+    #  date as soon as it's saved, rather than missing the new events
+    with open(fname, 'rb') as f:
+        source = cache_PSEC.stamp(f)
+    pedestal = build(fname, workers=workers)
+    save(fname, pedestal, source=source)
+    return pedestal
@@ -3,43 +3,84 @@ import matplotlib.pyplot as plt
 import bokeh.plotting as bkh
 from bokeh.models import Range1d
 from bokeh.models import HoverTool
-from bokeh.models import Span
 import os
 import datetime
 import subprocess
 import read_PSEC
 import numpy as np
 
-def plot_PSEC(fname, oname=''):
+# Most points plotted per channel. Anything longer is cut into half as many
+#  bins, and only the lowest and highest point of each bin is kept, so the
+#  HTML stays a few MB however long the run is and the pulses still show.
+MAX_POINTS = 20000
+# Most event boundaries drawn. On a longer run only every few are drawn.
+MAX_BOUNDARIES = 1000
+# Time between samples, in ns
+DT = 0.1
+
+def envelope(y, n_bins):
+	# Decimates the traces in <y> along its last axis to the minimum and
+	#  maximum of each of <n_bins> bins, in the order they come in the bin.
+	#  Returns: index, values
+	#  <index>  = indices of the points kept, with the same leading axes as <y>
+	#  <values> = y at those indices
+	n = y.shape[-1]
+	size = -(-n // n_bins)
+	if size <= 1:
+		index = np.broadcast_to(np.arange(n), y.shape)
+		return index, y
+	n_bins = -(-n // size)
+
+	# Pad the last bin out with its last point, which can't change its
+	#  minimum or maximum
+	pad = np.repeat(y[..., -1:], n_bins*size - n, axis=-1)
+	bins = np.concatenate((y, pad), axis=-1)
+	bins = bins.reshape(y.shape[:-1] + (n_bins, size))
+	lo = np.argmin(bins, axis=-1)
+	hi = np.argmax(bins, axis=-1)
+	start = np.arange(n_bins)*size
+	index = np.stack((np.minimum(lo, hi) + start, np.maximum(lo, hi) + start),
+		axis=-1)
+	index = np.minimum(index.reshape(y.shape[:-1] + (2*n_bins,)), n - 1)
+	return index, np.take_along_axis(y, index, axis=-1)
+
+def plot_PSEC(fname, oname='', events=None, max_points=MAX_POINTS):
 	# takes a PSEC4 log file, reads it and plots it to a bokeh file. 
-	#  <fname> = file to open and read. Include .txt extension.
-	#  <oname> = filename to write to. will be appended with '.html'
+	#  <fname>      = file to open and read. Include .txt extension.
+	#  <oname>      = filename to write to. will be appended with '.html'
+	#  <events>     = (first, last) events to plot, as for a slice. None plots the
+	#                 whole run. A short enough range is plotted at full resolution.
+	#  <max_points> = most points to plot per channel. Longer traces are decimated to
+	#                 the min and max of each bin. None never decimates.
 	# Returns:
 	#  <p>     = bokeh plot object for further manipulation, if desired.
 	if oname == '':
 		oname = fname[:-4]
 
-	# Read in the data
-	t, samples = read_PSEC.read(fname)
+	# Read in the data, voltage is stored in Volts
+	data, header = read_PSEC.load(fname)
+	first, last = slice(*(events or (None,))).indices(len(data))[:2]
+	data = data[first:last]
+	n = len(data)
 
 	#recover the user inputted name so it can be applied to graphs
 	stamp = oname.split('/')[-1]
 	oname = oname
 
 	# output graph to a static HTML file
-	print "saving to %s" % (oname)
+	print("saving to %s" % (oname))
 	bkh.output_file(oname, title=stamp)
 
 	#create plot object
 	p = bkh.figure(plot_width=1000, title=stamp, x_axis_label='t-t0, ns', 
 			y_axis_label='Voltage, mV')
 
-	# Read the channels from each sample into long lists for plotting
-	channels = np.zeros((6, 0))
-	for S in samples:
-		channels = np.concatenate((channels, samples[S]), axis=1)
+	# Lay the events end to end for each channel, in mV
+	channels = data.transpose(1, 0, 2).reshape(read_PSEC.N_CHANNELS, -1)*1000.
+	index, volts = envelope(channels, max((max_points or channels.size)//2, 1))
+	t = (index + first*read_PSEC.N_CELLS)*DT
 
-	print 'Plotting...'
+	print('Plotting...')
 	# Plot the data
 	cols = ['red', 'blue', 'orange', 'green', 'purple', 'black']
 	i = 0
@@ -47,31 +88,31 @@ def plot_PSEC(fname, oname=''):
 	for i in range(6):
 		# Plot the lines for each channel
 		p.line(
-				y = channels[i],
-				x = t,
+				y = volts[i],
+				x = t[i],
 				line_width = 2,
 				legend=("Channel "+str(i+1)),
 				line_color = cols[i],
 				# alpha = 0.3
 				)
 
-	vlines = []
-	for i in range(len(samples)):
-		vlines.append(Span(location=25.6*i,
-							dimension='height',
-							line_color='cyan',
-							line_width=2,
-							line_alpha=0.3
-							))
-	p.renderers.extend(vlines)
+	# set ranges
+	vmin = np.amin(channels) if n else -1.
+	vmax = np.amax(channels) if n else 1.
+	p.y_range = Range1d(1.1*vmin, 1.1*vmax)
+
+	# Mark where each event starts, all as one glyph
+	step = -(-n // MAX_BOUNDARIES) or 1
+	starts = (np.arange(first, last, step)*read_PSEC.N_CELLS)*DT
+	p.segment(x0=starts, y0=np.full(len(starts), 1.1*vmin), 
+			x1=starts, y1=np.full(len(starts), 1.1*vmax),
+			line_color='cyan',
+			line_width=2,
+			line_alpha=0.3
+			)
 
 	# Make data toggleable
 	p.legend.location = "top_left"
 	p.legend.click_policy="hide"
 
-	# set ranges
-	vmin = np.amin(channels)
-	vmax = np.amax(channels)
-	p.y_range = Range1d(1.1*vmin, 1.1*vmax)
-
 	return p
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+import os
+import json
+import numpy as np
+import read_PSEC as psec
+
+# Where along an anode strip each pulse came from, from its arrival times.
+#  The strips can be read out two ways:
+#   - reflection: one end of the strip goes to the PSEC and the other is left
+#      open, so each pulse arrives once directly and again after running to
+#      the open end and back. With the strip <length> long and the signal
+#      going at <velocity>, a pulse from <x> along the strip, measured from
+#      the read-out end, is followed by its reflection
+#      2*(length - x)/velocity later, so x = length - velocity*delta_t/2
+#   - both ends: each end of the strip goes to its own channel, so the pulse
+#      reaches end A, at 0, after x/velocity and end B after
+#      (length - x)/velocity, and x = (length + velocity*(t_a - t_b))/2
+# Both work on whole arrays of times at once, e.g. every event and channel of
+#  a block, and give back the position, its uncertainty and a flag saying
+#  whether it's on the strip.
+#
+# The strip length, signal velocity and timing of each tile come from its
+#  calibration file, a JSON object like tile.json, which is what's used if no
+#  other is given:
+#   {"length": 0.06, "velocity": 1.2e8, "velocity_error": 0.0,
+#    "time_error": 0.05, "margin": 0.002, "pitch": 0.0069,
+#    "channels": {"3": {"velocity": 1.1e8, "offset": 0.02, "cross": 0.03}}}
+#  Anything under "channels", keyed by the index of the channel (0-5),
+#  overrides the values for the whole tile for that channel's strip.
+#
+#   cal = position_PSEC.load('DATA/tile7.json')
+#   position, error, flags = position_PSEC.reflection(delta_t, ch, cal)
+#   position = position[flags == position_PSEC.OK]
+
+DEFAULT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'tile.json')
+
+# Validity flags. A position can have more than one.
+OK = 0
+NO_TIME = 1       # a time was missing, i.e. NaN
+BEFORE_START = 2  # before the start of the strip. The pulses were further
+                  #  apart than the strip allows, which the scripts used to
+                  #  count as superluminal.
+PAST_END = 4      # past the far end of the strip, or within the margin of
+                  #  the open end for a reflection
+
+# What each constant is, and its value if the calibration file leaves it out
+FIELDS = [
+    ('length', 0.06),         # length of the strip, in m
+    ('velocity', 1.2e8),      # signal velocity along the strip, in m/s
+    ('velocity_error', 0.),   # uncertainty on the velocity, in m/s
+    ('time_error', 0.05),     # resolution of each arrival time, in ns
+    ('offset', 0.),           # delay of the channel, in ns, taken off its
+                              #  times, or off delta_t for a reflection
+    ('margin', 0.002),        # pulses this close to the open end, in m, are
+                              #  flagged, since the direct and reflected
+                              #  pulses run together there
+    ('pitch', 0.0069),        # distance between neighbouring strips, in m
+    ('cross', None),          # where the strip is across the tile, in m. Set
+                              #  for each channel, or ch*pitch if it isn't.
+    ]
+
+class Calibration(object):
+    '''Strip length, signal velocity, timing and layout of a tile. Any of the
+    constants in FIELDS can be given, and the rest are the defaults.
+     <channels> = dict of the index of a channel to a dict of constants for
+            that channel's strip, overriding the ones for the tile
+     <name>     = file it was read from, or None'''
+    def __init__(self, channels=None, name=None, **values):
+        unknown = set(values) - set(key for key, default in FIELDS)
+        if unknown:
+            raise ValueError("Unknown calibration constants: %s" %
+                ', '.join(sorted(unknown)))
+        self.name = name
+        self.values = dict(FIELDS)
+        self.values.update(values)
+        self.channels = dict((int(ch), dict(overrides))
+            for ch, overrides in (channels or {}).items())
+        # The value of each constant for each channel, to look up a whole
+        #  array of channels at once
+        self._tables = dict((key, np.array([self.get(key, ch)
+            for ch in range(psec.N_CHANNELS)], dtype=np.float64))
+            for key, default in FIELDS)
+
+    def get(self, key, ch=None):
+        '''Gets one constant.
+         <key> = name of the constant, e.g. 'velocity'
+         <ch>  = index of the channel, or None for the whole tile
+        Returns: value'''
+        if ch is not None and key in self.channels.get(ch, {}):
+            return float(self.channels[ch][key])
+        if self.values[key] is None:
+            # Strips without a 'cross' are in channel order, <pitch> apart
+            return (0 if ch is None else ch)*self.get('pitch')
+        return float(self.values[key])
+
+    def lookup(self, key, ch=None):
+        '''Gets one constant for an array of channels.
+         <ch> = index, or array of indices, of the channels, which the result
+                broadcasts like. The whole tile's if None.
+        Returns: value
+         <value> = array of the constant for each channel'''
+        if ch is None:
+            return np.float64(self.get(key))
+        return self._tables[key][np.asarray(ch, dtype=np.intp)]
+
+    def to_dict(self):
+        '''Returns the calibration as it's written to a file'''
+        values = dict((key, value) for key, value in self.values.items()
+            if value is not None)
+        if self.channels:
+            values['channels'] = dict((str(ch), overrides)
+                for ch, overrides in sorted(self.channels.items()))
+        return values
+
+def load(fname=None):
+    '''Reads a tile's calibration file.
+     <fname> = the file, or None for tile.json next to this module
+    Returns: calibration
+     <calibration> = Calibration'''
+    fname = DEFAULT if fname is None else fname
+    with open(fname, 'r') as f:
+        values = json.load(f)
+    return Calibration(name=fname, **values)
+
+def save(fname, calibration):
+    '''Writes a calibration to a file'''
+    with open(fname, 'w') as f:
+        json.dump(calibration.to_dict(), f, indent=4, sort_keys=True)
+        f.write('\n')
+
+def _calibration(calibration):
+    # The calibration to use, reading the default file if there isn't one
+    return load() if calibration is None else calibration
+
+def _flags(position, length, margin, times):
+    # Validity flag of each position
+    flags = np.where(np.isfinite(times), OK, NO_TIME).astype(np.int8)
+    with np.errstate(invalid='ignore'):
+        flags[position <= 0.] |= BEFORE_START
+        flags[position >= length - margin] |= PAST_END
+    return flags
+
+def reflection(delta_t, ch=None, calibration=None):
+    '''Gets the position of each pulse from the time between it and its
+    reflection off the open end of the strip.
+     <delta_t>     = array of the times between the direct and reflected
+            pulses, in ns, e.g. (n_events,) for one channel, or
+            (n_events, 6) for every channel
+     <ch>          = index of the channel, or array of indices broadcasting
+            against <delta_t>, e.g. np.arange(6), for each one's own
+            calibration. The whole tile's if None.
+     <calibration> = Calibration of the tile. tile.json's if None.
+    Returns: position, error, flags
+     <position> = array of the distance of each pulse from the read-out
+            end of the strip, in m. Its reflection arrives
+            2*(length - position)/velocity after it.
+     <error>    = array of the uncertainty on each, in m
+     <flags>    = array of the validity flags of each, OK if it's on the
+            strip'''
+    cal = _calibration(calibration)
+    delta_t = np.asarray(delta_t, dtype=np.float64) - cal.lookup('offset', ch)
+    length = cal.lookup('length', ch)
+    velocity = cal.lookup('velocity', ch)
+
+    position = length - 0.5*velocity*delta_t*1e-9
+    # Both times have the resolution, so the difference is sqrt(2) worse
+    error = 0.5*np.hypot(velocity*np.sqrt(2)*cal.lookup('time_error', ch),
+        delta_t*cal.lookup('velocity_error', ch))*1e-9
+    margin = cal.lookup('margin', ch)
+    return position, error, _flags(position, length, margin, delta_t)
+
+def both_ends(t_a, t_b, ch_a=None, ch_b=None, calibration=None):
+    '''Gets the position of each pulse from when it reached each end of the
+    strip.
+     <t_a>, <t_b>   = arrays of the arrival times at end A and end B, in ns,
+            e.g. (n_events, 3) for three strips read out at both ends
+     <ch_a>, <ch_b> = index, or array of indices, of the channel at each end,
+            for their offsets. The strip's length and velocity are ch_a's.
+            The whole tile's if None.
+     <calibration>  = Calibration of the tile. tile.json's if None.
+    Returns: position, error, flags
+     <position> = array of the distance of each pulse from end A, in m
+     <error>    = array of the uncertainty on each, in m
+     <flags>    = array of the validity flags of each, OK if it's on the
+            strip'''
+    cal = _calibration(calibration)
+    delta_t = (np.asarray(t_a, dtype=np.float64) - cal.lookup('offset', ch_a))\
+        - (np.asarray(t_b, dtype=np.float64) - cal.lookup('offset', ch_b))
+    length = cal.lookup('length', ch_a)
+    velocity = cal.lookup('velocity', ch_a)
+
+    position = 0.5*(length + velocity*delta_t*1e-9)
+    error = 0.5*np.hypot(velocity*np.sqrt(2)*cal.lookup('time_error', ch_a),
+        delta_t*cal.lookup('velocity_error', ch_a))*1e-9
+    # Either end can be reached first, so there's no margin
+    return position, error, _flags(position, length, 0., delta_t)
@@ -3,60 +3,547 @@ import os
 import datetime
 import subprocess
 import numpy as np
+import cache_PSEC
+
+# Layout of a PSEC4 log file. Each event is a block of 256 lines, one per
+#  storage cell, with 6 tab separated channel voltages (in V) on each line.
+#  The first 4 lines of each block carry an extra 7th column of metadata.
+N_CHANNELS = 6
+N_CELLS = 256
+N_META = 4
+# Number of values in one event block
+EVENT_SIZE = N_CELLS*N_CHANNELS + N_META
+
+# The 7th column holds, in order: the event counter, the ring buffer cell the
+#  readout started from (the wraparound cell), and two 16 bit words of the
+#  timestamp, low word first.
+META_DTYPE = np.dtype([('event', '<u4'), ('cell', '<u2'), ('timestamp', '<u8')])
+
+def decode_meta(columns):
+    '''Decodes the 7th column metadata of a block of events.
+     <columns> = (n_events, 4) array of the 7th column values of each event
+    Returns: meta
+     <meta> = structured array with an 'event', 'cell' and 'timestamp' for
+            each event'''
+    columns = np.asarray(columns).astype(np.int64)
+    meta = np.zeros(len(columns), dtype=META_DTYPE)
+    meta['event'] = columns[:, 0]
+    meta['cell'] = columns[:, 1]
+    meta['timestamp'] = (columns[:, 3] << 16) | columns[:, 2]
+    return meta
+
+def read_header(f):
+    '''Reads the '#' header block from the top of a log file.
+     <f> = log file, opened in binary mode. This is left positioned at the
+            first line of data
+    Returns: header
+     <header> = list of the header lines, with the leading '#'s stripped'''
+    header = []
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if line[:1] != b'#':
+            f.seek(offset)
+            return header
+        header.append(line.lstrip(b'#').strip().decode())
+
+# Size of the pieces the data are parsed in, to bound temporary memory
+CHUNK_BYTES = 1 << 20
+
+def _parse_fixed(chunk):
+    # Parses the whitespace separated numbers in <chunk>, which must hold
+    #  whole lines. LogData writes voltages as '%f' ('-0.002158'), so the
+    #  last 8 bytes of each of those tokens are loaded as one 64 bit word and
+    #  all of their digits decoded at once with integer arithmetic. The odd
+    #  token in any other format (the metadata column) is converted on its
+    #  own. Returns None if the text isn't in the format we expect.
+    U = np.uint64
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    if len(buf) < 16:
+        return None
+    stops = np.flatnonzero(buf <= 32)
+
+    # Unaligned view of every 8 bytes in the chunk
+    words = np.ndarray(shape=(len(buf)-7,), dtype='<u8', buffer=chunk,
+        strides=(1,))
+    idx = stops - 8
+    np.maximum(idx, 0, out=idx)
+    word = words[idx]
+    idx -= 1
+    np.maximum(idx, 0, out=idx)
+    sign = buf[idx]
+
+    # Check the token is '[-]d.dddddd', then swap the '.' for a '0'
+    fixed = (word & U(0xFF00)) == U(0x2E00)
+    neg = sign == 45
+    fixed &= neg | (sign <= 32)
+    word &= U(0xFFFFFFFFFFFF00FF)
+    word |= U(0x3000)
+    fixed &= (word & U(0xF0F0F0F0F0F0F0F0)) == U(0x3030303030303030)
+    fixed &= ((word + U(0x0606060606060606)) & U(0xF0F0F0F0F0F0F0F0)) == \
+        U(0x3030303030303030)
+
+    # Combine pairs of digits, then pairs of pairs, then the two halves
+    word -= U(0x3030303030303030)
+    x = word*U(10) + (word >> U(8))
+    x = (((x & U(0x000000FF000000FF))*U(100 + (1000000 << 32))) +
+        (((x >> U(16)) & U(0x000000FF000000FF))*U(1 + (10000 << 32)))) >> U(32)
+    # The units digit was counted as 10^7 instead of 10^6
+    x -= (word & U(0xFF))*U(9000000)
+
+    values = x.astype(np.float64)
+    values /= 1e6
+    np.negative(values, out=values, where=neg)
+
+    others = np.flatnonzero(~fixed)
+    if len(others) > 0.01*len(stops) + 16:
+        return None
+    try:
+        values[others] = [float(chunk[stops[i-1]+1 if i else 0:stops[i]])
+            for i in others]
+    except ValueError:
+        return None
+    return values
+
+def parse_values(body, out=None, dtype=np.float32):
+    '''Parses all of the whitespace separated numbers in a block of text.
+     <body>  = bytes to parse
+     <out>   = optional 1D array to write the values into. Anything that
+            doesn't fit is dropped
+     <dtype> = numpy type of the returned array, if <out> isn't given
+    Returns: values, n
+     <values> = array of the parsed values
+     <n>      = the number of values found in <body>'''
+    chunks = []
+    n = 0
+    offset = 0
+    while offset < len(body):
+        # Cut the data into pieces at line boundaries
+        stop = body.find(b'\n', offset + CHUNK_BYTES)
+        stop = len(body) if stop == -1 else stop + 1
+        chunk = body[offset:stop]
+        values = _parse_fixed(chunk)
+        if values is None:
+            values = np.fromstring(chunk, dtype=float, sep=' ')
+        if out is None:
+            chunks.append(values.astype(dtype))
+        else:
+            out[n:n+len(values)] = values[:max(len(out)-n, 0)]
+        n += len(values)
+        offset = stop
+
+    if out is None:
+        if chunks:
+            out = np.concatenate(chunks)
+        else:
+            out = np.zeros(0, dtype=dtype)
+    return out, n
+
+def _parse_lines(lines, dtype):
+    # Slow path, used when the file doesn't have the regular layout
+    #  (truncated lines, stray headers...). Parses one line at a time,
+    #  the same way the original reader did.
+    data = []
+    columns = []
+    channels = np.zeros((N_CHANNELS, N_CELLS), dtype=dtype)
+    column = np.zeros(N_META)
+    j = 0
+    for line in lines:
+        # Skip over headers
+        if line[:1] == b'#':
+            continue
+        line = line.split()
+        try:
+            channels[:, j] = [float(x) for x in line[:N_CHANNELS]]
+            if j < N_META and len(line) > N_CHANNELS:
+                column[j] = float(line[N_CHANNELS])
+        except:
+            # Catch if the file's line is incomplete
+            print("ERROR: bad line")
+            print(line)
+            continue
+        j += 1
+        if j == N_CELLS:
+            data.append(channels)
+            columns.append(column)
+            channels = np.zeros((N_CHANNELS, N_CELLS), dtype=dtype)
+            column = np.zeros(N_META)
+            j = 0
+
+    if not data:
+        return (np.zeros((0, N_CHANNELS, N_CELLS), dtype=dtype),
+            np.zeros(0, dtype=META_DTYPE))
+    return np.array(data, dtype=dtype), decode_meta(columns)
+
+def parse(body, dtype=np.float32):
+    '''Parses the data part of a PSEC4 log file into an event block.
+     <body>  = bytes containing whole lines of event data, no header
+     <dtype> = numpy type to store the voltages as
+    Returns: data, meta
+     <data> = (n_events, 6, 256) array of the channel voltages, in V. A
+            trailing incomplete event is dropped.
+     <meta> = structured array of the decoded 7th column of each event'''
+    n_lines = body.count(b'\n')
+    if body and not body.endswith(b'\n'):
+        n_lines += 1
+    n_events = n_lines // N_CELLS
+
+    # If the file has the usual layout, every value can be parsed in one go
+    #  by numpy and cut up by position, since we know how many there are.
+    if b'#' not in body:
+        partial = n_lines % N_CELLS
+        expected = n_events*EVENT_SIZE + partial*N_CHANNELS + \
+            min(partial, N_META)
+        values, n = parse_values(body, np.empty(expected, dtype=dtype))
+        if n == expected:
+            values = values[:n_events*EVENT_SIZE].reshape(n_events, EVENT_SIZE)
+            data = np.empty((n_events, N_CHANNELS, N_CELLS), dtype=dtype)
+            # The first few lines have 7 columns, the rest have 6
+            head = values[:, :N_META*(N_CHANNELS+1)]
+            head = head.reshape(n_events, N_META, N_CHANNELS+1)
+            tail = values[:, N_META*(N_CHANNELS+1):]
+            tail = tail.reshape(n_events, N_CELLS-N_META, N_CHANNELS)
+            data[:, :, :N_META] = head[:, :, :N_CHANNELS].transpose(0, 2, 1)
+            data[:, :, N_META:] = tail.transpose(0, 2, 1)
+            return data, decode_meta(head[:, :, N_CHANNELS])
+
+    return _parse_lines(body.splitlines(), dtype)
+
+def _load(fname, dtype, cache):
+    # Gets the arrays for a log file, from the cache if we can
+    cache = cache and np.dtype(dtype) == np.float32
+    if cache:
+        cached = cache_PSEC.load(fname)
+        if cached is not None and 'meta' in cached[0]:
+            return cached
+
+    with open(fname, 'rb') as f:
+        # Only what was there when it was stamped, in case it's still growing
+        source = cache_PSEC.stamp(f)
+        header = read_header(f)
+        body = f.read(max(source['size'] - f.tell(), 0))
+    data, meta = parse(body, dtype)
+    arrays = {'data': data, 'meta': meta}
+
+    if cache:
+        cache_PSEC.save(fname, arrays, header, source=source)
+    return arrays, header
+
+def load(fname, dtype=np.float32, cache=True):
+    '''Reads a whole PSEC4 log file into one contiguous array.
+     <fname> = file to open and read
+     <dtype> = numpy type to store the voltages as
+     <cache> = if True, the data are memory mapped from the binary cache
+            next to the log file, and the cache is written if it doesn't
+            exist or is out of date. Only used for float32 data.
+    Returns: data, header
+     <data>   = (n_events, 6, 256) array of the channel voltages, in V
+     <header> = list of the '#' header lines at the top of the file'''
+    arrays, header = _load(fname, dtype, cache)
+    return arrays['data'], header
+
+def load_meta(fname, cache=True):
+    '''Reads the decoded 7th column metadata of every event in a log file.
+    This is stored in the cache alongside the waveforms, so once a file has
+    been loaded it costs next to nothing.
+     <fname> = file to open and read
+     <cache> = as for load()
+    Returns: meta
+     <meta> = structured array with an 'event', 'cell' and 'timestamp' for
+            each event, in the same order as the events from load()'''
+    arrays, header = _load(fname, np.float32, cache)
+    return arrays['meta']
+
+# Roughly how many bytes one event takes up in a log file
+EVENT_BYTES = 16000
+
+def _strip_comments(body):
+    # Drops any '#' lines from the middle of a block of data
+    return b'\n'.join(line for line in body.split(b'\n')
+        if line[:1] != b'#')
+
+def iter_blocks(f, chunk_size):
+    '''Reads a log file as blocks of raw text, each holding whole events.
+     <f>          = log file, opened in binary mode and positioned after
+            the header
+     <chunk_size> = number of events in each block
+    Yields: block
+     <block> = bytes holding the lines of <chunk_size> events. The last block
+            holds whatever is left, including any incomplete event.'''
+    n_lines = chunk_size*N_CELLS
+    buf = b''
+    eof = False
+    while not eof:
+        more = f.read(max(chunk_size*EVENT_BYTES - len(buf), 1 << 16))
+        eof = not more
+        buf += more
+        if b'#' in buf:
+            buf = _strip_comments(buf)
+
+        # Cut off as many blocks of whole events as we have
+        newlines = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+        start = 0
+        for k in range(n_lines - 1, len(newlines), n_lines):
+            stop = newlines[k] + 1
+            yield buf[start:stop]
+            start = stop
+        buf = buf[start:]
+
+    if buf:
+        yield buf
+
+def iter_events(fname, chunk_size=1024, dtype=np.float32, cache=True):
+    '''Goes through a log file a fixed number of events at a time, without
+    ever holding more than that in memory.
+     <fname>      = file to open and read
+     <chunk_size> = number of events to give at a time
+     <dtype>      = numpy type to store the voltages as
+     <cache>      = if True, and the log has an up to date binary cache, the
+            chunks are taken from that rather than parsed again. The cache is
+            never written here, as that would need the whole run in memory.
+    Yields: data, meta
+     <data> = (chunk_size, 6, 256) array of the channel voltages, in V. The
+            last chunk may be shorter.
+     <meta> = structured array of the decoded 7th column of each event'''
+    if cache and np.dtype(dtype) == np.float32:
+        cached = cache_PSEC.load(fname)
+        if cached is not None and 'meta' in cached[0]:
+            arrays, header = cached
+            for i in range(0, len(arrays['data']), chunk_size):
+                yield (arrays['data'][i:i+chunk_size],
+                    arrays['meta'][i:i+chunk_size])
+            return
+
+    with open(fname, 'rb') as f:
+        read_header(f)
+        for block in iter_blocks(f, chunk_size):
+            data, meta = parse(block, dtype)
+            if len(data):
+                yield data, meta
+
+def iter_from(fname, offset=None, chunk_size=1024, dtype=np.float32):
+    '''Goes through the complete events of a log file from a byte offset, e.g.
+    the events added to a log that's still being written since it was last
+    read.
+     <fname>      = file to open and read
+     <offset>     = byte offset to start from, the <stop> of the last chunk
+            read before. None starts after the header.
+     <chunk_size> = most events to give at a time
+     <dtype>      = numpy type to store the voltages as
+    Yields: data, meta, stop
+     <data> = (n, 6, 256) array of the channel voltages, in V
+     <meta> = structured array of the decoded 7th column of each event
+     <stop> = byte offset just past the last event of the chunk, to carry on
+            from. An event, or even a line, that's still being written is
+            left for next time.'''
+    n_lines = chunk_size*N_CELLS
+    with open(fname, 'rb') as f:
+        if offset is None:
+            read_header(f)
+            offset = f.tell()
+        f.seek(offset)
+        buf = b''
+        eof = False
+        while not eof:
+            more = f.read(max(chunk_size*EVENT_BYTES, 1 << 16))
+            eof = not more
+            buf += more
+
+            # Ends of the whole data lines, leaving out any '#' or blank ones
+            cut = buf.rfind(b'\n') + 1
+            chars = np.frombuffer(buf, dtype=np.uint8, count=cut)
+            ends = np.flatnonzero(chars == 10) + 1
+            begins = np.concatenate(([0], ends))[:len(ends)]
+            first = chars[begins]
+            ends = ends[(first != 35) & (first != 10) & (first != 13)]
+
+            # Cut off as many chunks as we have, and at the end of the file,
+            #  whatever whole events are left
+            stops = ends[n_lines - 1::n_lines].tolist()
+            whole = len(ends) - len(ends) % N_CELLS
+            if eof and whole and whole % n_lines:
+                stops.append(int(ends[whole - 1]))
+            start = 0
+            for stop in stops:
+                block = buf[start:stop]
+                if b'#' in block:
+                    block = _strip_comments(block)
+                data, meta = parse(block, dtype)
+                offset += stop - start
+                start = stop
+                yield data, meta, offset
+            buf = buf[start:]
+
+# Extension of the event index that goes next to a log file
+INDEX_EXT = '.psidx'
+# Size of the pieces the log is read in when indexing it
+INDEX_BYTES = 1 << 26
+
+def build_index(fname, save=True):
+    '''Finds where in a log file every event starts and stops, so that single
+    events can be read without parsing the rest of the file.
+     <fname> = log file to index
+     <save>  = if True, the index is written next to the log, as <name>.psidx
+    Returns: starts, stops, header
+     <starts> = (n_events,) array of the byte offset of the first line of each
+            complete event
+     <stops>  = (n_events,) array of the byte offset just past its last line
+     <header> = list of the '#' header lines at the top of the file'''
+    starts = []
+    stops = []
+    # Number of data lines so far
+    n = 0
+    with open(fname, 'rb') as f:
+        # Only index what was there when it was stamped, in case it's still
+        #  growing
+        source = cache_PSEC.stamp(f)
+        header = read_header(f)
+        offset = f.tell()
+        buf = b''
+        eof = False
+        while not eof:
+            more = f.read(max(min(INDEX_BYTES, source['size'] - f.tell()), 0))
+            eof = not more
+            buf += more
+            # Only whole lines, unless that's all there is
+            cut = len(buf) if eof else buf.rfind(b'\n') + 1
+            if cut == 0:
+                continue
+            chars = np.frombuffer(buf, dtype=np.uint8, count=cut)
+            ends = np.flatnonzero(chars == 10) + 1
+            if eof and (len(ends) == 0 or ends[-1] != cut):
+                ends = np.append(ends, cut)
+            begins = np.concatenate(([0], ends[:-1]))
+
+            # Data lines are any that aren't '#' comments, or blank
+            first = chars[begins]
+            data = np.flatnonzero((first != 35) & (first != 10) &
+                (first != 13))
+            line = np.arange(n, n + len(data)) % N_CELLS
+            starts.append(begins[data[line == 0]] + offset)
+            stops.append(ends[data[line == N_CELLS - 1]] + offset)
+            n += len(data)
+            offset += cut
+            buf = buf[cut:]
+
+    starts = np.concatenate(starts + [np.zeros(0, int)]).astype(np.uint64)
+    stops = np.concatenate(stops + [np.zeros(0, int)]).astype(np.uint64)
+    # Leave off a trailing incomplete event, like parse()
+    starts = starts[:len(stops)]
+    if save:
+        cache_PSEC.save(fname, {'starts': starts, 'stops': stops}, header,
+            ext=INDEX_EXT, source=source)
+    return starts, stops, header
+
+def load_index(fname, build=True):
+    '''Gets the event index of a log file, as from build_index(). The index
+    is built and saved if there isn't an up to date one next to the log.
+     <fname> = log file
+     <build> = if False, None is returned rather than building the index
+    Returns: starts, stops, header'''
+    cached = cache_PSEC.load(fname, ext=INDEX_EXT)
+    if cached is not None:
+        arrays, header = cached
+        return arrays['starts'], arrays['stops'], header
+    if not build:
+        return None
+    return build_index(fname)
+
+def get_events(fname, indices, dtype=np.float32, cache=True):
+    '''Reads only some of the events of a log file, using the binary cache if
+    there is one and the event index otherwise. Only the events asked for are
+    read and parsed.
+     <fname>   = log file to read
+     <indices> = event number, or list, array or slice of them, counting from
+            0 at the first event in the file. Negative numbers count from the
+            end.
+     <dtype>   = numpy type to store the voltages as
+     <cache>   = if True, the events are taken from the binary cache, if it's
+            up to date
+    Returns: data, meta
+     <data> = (len(indices), 6, 256) array of the channel voltages, in V, or
+            (6, 256) for a single event
+     <meta> = structured array of the decoded 7th column of each event, or one
+            record for a single event'''
+    if cache and np.dtype(dtype) == np.float32:
+        cached = cache_PSEC.load(fname)
+        if cached is not None and 'meta' in cached[0]:
+            arrays, header = cached
+            select = np.arange(len(arrays['data']))[indices]
+            return np.array(arrays['data'][select]), arrays['meta'][select]
+
+    starts, stops, header = load_index(fname)
+    select = np.arange(len(starts))[indices]
+    single = np.ndim(select) == 0
+    blocks = []
+    with open(fname, 'rb') as f:
+        for i in np.atleast_1d(select):
+            f.seek(int(starts[i]))
+            block = f.read(int(stops[i] - starts[i]))
+            if not block.endswith(b'\n'):
+                block += b'\n'
+            blocks.append(block)
+    data, meta = parse(b''.join(blocks), dtype)
+    if single:
+        return data[0], meta[0]
+    return data, meta
+
+def time_order(meta):
+    '''Returns the indices that put the events in <meta> in timestamp order'''
+    return np.argsort(meta['timestamp'], kind='mergesort')
+
+def unique_events(meta):
+    '''Returns the indices of the first occurrence of each event number in
+    <meta>, so that repeated events can be dropped'''
+    events, first = np.unique(meta['event'], return_index=True)
+    return np.sort(first)
+
+def missing_events(meta):
+    '''Returns the event numbers that were skipped by the event counter in
+    <meta>, between the first and last event recorded'''
+    events = np.unique(meta['event']).astype(np.int64)
+    if len(events) == 0:
+        return events
+    gaps = np.diff(events) - 1
+    # Each gap is filled in with the numbers that should have been there
+    starts = np.repeat(events[:-1] + 1, gaps)
+    steps = np.arange(gaps.sum()) - np.repeat(np.cumsum(gaps) - gaps, gaps)
+    return starts + steps
+
+def event_rate(meta, bins=100):
+    '''Histograms the event rate against time, from the timestamps in <meta>.
+     <meta> = metadata array from load_meta()
+     <bins> = number of time bins, or an array of bin edges
+    Returns: rate, edges
+     <rate>  = events per timestamp tick in each bin
+     <edges> = the bin edges, in timestamp ticks'''
+    counts, edges = np.histogram(meta['timestamp'], bins=bins)
+    return counts / np.diff(edges).astype(float), edges
 
 def read(fname):
-    '''takes a PSEC4 log file, reads it and plots it to a bokeh file. 
+    '''takes a PSEC4 log file, reads it and plots it to a bokeh file.
      <fname> = file to open and read
     Returns: t, samples
      <t> = a numpy array that has the time axis
-     <samples> = A dictionary containing the data samples. Each sample is a 
+     <samples> = A dictionary containing the data samples. Each sample is a
             6x256 numpy array with the data in.'''
 
     if not os.path.isfile(fname):
         print("ERROR: File not found...")
         return [], {}
-    f = open(fname, 'r')
 
-    # Samples is a list, and each sample contains
+    # voltage is stored in Volts, convert to mV.
+    data, header = load(fname, dtype=float)
+    data *= 1000.
+
+    # Samples is a dict, and each sample contains
     #  a set of 6 lists which are the channels readings
     samples = {}
-    channels = np.zeros((6,256))
-    t = [0.0]
-
-    j = 0
-    n = 0
-    vmin = 0.
-    vmax = 0.
-    for line in f:
-        # Skip over headers
-        if line[0] == '#':
-            continue
-        else:
-            # voltage is stored in Volts, convert to mV.
-            line = [float(x)*1000. for x in line.split()]
-            
-            try:
-                # Get the data for each channel into the lists
-                for i in range(6):
-                    channels[i][j%256] = line[i]
-                    if line[i] > vmax:
-                        vmax = float(line[i])
-                    if line[i] < vmin:
-                        vmin = float(line[i])
-                j += 1
-            except:
-                # Catch if the file's line is incomplete
-                print("ERROR: bad line")
-                print(line)
-        # If I detect a header, 
-        if j%256 == 0:
-            samples[str(n)] = channels.copy()
-            channels = np.zeros((6,256))
-            n += 1
-
-    f.close()
+    for n in range(len(data)):
+        samples[str(n)] = data[n]
+    n = len(data)
 
     # Construct a time array as well
     t = np.arange(0.0, 25.6*n, step=0.1)
 
-    return t, samples
\ No newline at end of file
+    return t, samples
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+import os
+import re
+import numpy as np
+import parallel_PSEC as parallel
+
+# Reads the CSV files saved by the oscilloscope. Each channel of each capture
+#  is a file of its own, e.g. CAPTURE_12Wfm_Ch3.csv for channel 3 of capture
+#  12. The first few lines carry the scope's settings in their first three
+#  columns, as "label",value,"unit", and every line has the time (s) and
+#  voltage (V) of a point in its last two.
+
+# <prefix><capture>Wfm_Ch<channel>.csv. A file without the _Ch<channel> is
+#  taken as channel 1.
+NAME = re.compile(r'^(.*?)(\d+)Wfm(?:_Ch(\d+))?\.csv$')
+
+def split_name(fname):
+    '''Splits the name of a capture file into its parts.
+     <fname> = file name, with or without its directory
+    Returns: prefix, capture, channel
+     <prefix>  = everything before the capture number, e.g. 'CAPTURE_'
+     <capture> = the capture number
+     <channel> = the channel number
+     or None if the name isn't like that of a capture file'''
+    match = NAME.match(os.path.basename(fname))
+    if match is None:
+        return None
+    prefix, capture, channel = match.groups()
+    return prefix, int(capture), int(channel or 1)
+
+def _parse_lines(lines):
+    # Goes through the file a line at a time, the same way the original
+    #  reader did. Used for the lines with the settings on, and for files
+    #  that don't have the usual layout.
+    meta = {}
+    values = []
+    for line in lines:
+        line = line.replace('"', '').strip().split(',')
+        if len(line) < 5:
+            continue
+        if line[0] != '':
+            meta[line[0]] = [float(line[1]), line[2]]
+        values.append([float(line[3]), float(line[4])])
+    return np.array(values).reshape(-1, 2), meta
+
+# The settings are all within this many lines of the top of the file
+N_HEADER = 32
+
+def parse(text):
+    '''Parses the text of a scope CSV file.
+     <text> = contents of the file
+    Returns: values, meta
+     <values> = (n_points, 2) array of the time (s) and voltage (V) columns
+     <meta>   = dict of the scope settings, label: [value, unit], as they are
+            in the file'''
+    # Lines with a setting on start with its label, the rest with a comma
+    lines = text.split('\n', N_HEADER)
+    n_head = 0
+    for i, line in enumerate(lines[:N_HEADER]):
+        if line[:1] != ',':
+            n_head = i + 1
+    head, meta = _parse_lines(lines[:n_head])
+
+    # Every other line is ,,,time,volt so with the empty columns gone, numpy
+    #  can read the lot as one long list of numbers
+    body = '\n'.join(lines[n_head:]).replace(',,,', ',').strip()
+    n_lines = body.count('\n') + 1 if body else 0
+    try:
+        values = np.fromstring(body[1:], dtype=float, sep=',')
+    except ValueError:
+        values = None
+    if values is None or len(values) != 2*n_lines:
+        return _parse_lines(text.splitlines())
+    return np.concatenate((head, values.reshape(-1, 2))), meta
+
+def read_csv(fname):
+    '''Reads one channel of a capture.
+     <fname> = CSV file saved by the scope
+    Returns: time, volt, meta
+     <time> = array of the time of each point, from 0 at the first point.
+            In ns, if the scope saved it in s.
+     <volt> = array of the voltages, in mV. NOTE: NO SCALE FOR VOLTAGE IS
+            SUPPLIED! This assumes the file is in V.
+     <meta> = dict of the scope settings, label: [value, unit]. Anything in
+            s is converted to ns.'''
+    with open(fname, 'rb') as f:
+        text = f.read().decode()
+    values, meta = parse(text)
+    time = values[:, 0] - values[0, 0]
+    volt = values[:, 1]*10**3
+
+    # If the data is stored in seconds, convert to nanoseconds
+    if meta.get('Sample Interval', [0, ''])[1].lower() == 's':
+        time *= 10**9
+    for label in meta:
+        if meta[label][1].lower() == 's':
+            meta[label] = [meta[label][0]*10**9, 'ns']
+    return time, volt, meta
+
+def find_captures(path):
+    '''Finds every capture in a directory, and the files of their channels.
+     <path> = directory, or one of the files in it. Given a file, only
+            captures with the same prefix as it are found.
+    Returns: captures, channels, fnames
+     <captures> = sorted list of the capture numbers
+     <channels> = sorted list of the channels any of the captures have
+     <fnames>   = list for each capture of the file of each channel, or None
+            where the capture doesn't have that channel'''
+    prefix = None
+    directory = path
+    if not os.path.isdir(path):
+        directory = os.path.dirname(path) or '.'
+        parts = split_name(path)
+        if parts is None:
+            raise ValueError("%s isn't a capture file" % path)
+        prefix = parts[0]
+
+    found = {}
+    for name in os.listdir(directory):
+        parts = split_name(name)
+        if parts is None or (prefix is not None and parts[0] != prefix):
+            continue
+        found[parts[1:]] = os.path.join(directory, name)
+
+    captures = sorted(set(capture for capture, channel in found))
+    channels = sorted(set(channel for capture, channel in found))
+    fnames = [[found.get((capture, channel)) for channel in channels]
+        for capture in captures]
+    return captures, channels, fnames
+
+def _read_files(fnames):
+    # read_csv() for a list of files, so each worker gets a batch of them
+    return [read_csv(fname) for fname in fnames]
+
+def load_captures(path, workers=1, batch_size=256):
+    '''Reads every channel of every capture in a directory into one array.
+     <path>       = directory, or one of the files in it, as for
+            find_captures()
+     <workers>    = number of processes to read with. None uses every core.
+     <batch_size> = number of files each worker reads at a time
+    Returns: time, volts, meta
+     <time>  = (n_captures, n_points) array of the time axis of each
+            capture, from its first channel
+     <volts> = (n_captures, n_channels, n_points) array of the voltages, in
+            mV. NaN where a capture doesn't have a channel.
+     <meta>  = dict of the scope settings, label: [(n_captures, n_channels)
+            array of values, unit], plus 'captures' and 'channels', the
+            numbers of each, and 'fnames', the file of each, as from
+            find_captures()'''
+    captures, channels, fnames = find_captures(path)
+    files = [(i, j, fname) for i, row in enumerate(fnames)
+        for j, fname in enumerate(row) if fname is not None]
+    if not files:
+        raise IOError("No captures found in %s" % path)
+
+    batches = [[fname for i, j, fname in files[k:k+batch_size]]
+        for k in range(0, len(files), batch_size)]
+    results = [result for batch in parallel.map_files(_read_files, batches,
+        workers) for result in batch]
+
+    n_points = len(results[0][1])
+    time = np.full((len(captures), n_points), np.nan)
+    volts = np.full((len(captures), len(channels), n_points), np.nan)
+    meta = {}
+    for (i, j, fname), (t, v, m) in zip(files, results):
+        if len(v) != n_points:
+            raise ValueError("%s has %d points, not %d like the rest" %
+                (fname, len(v), n_points))
+        if np.isnan(time[i, 0]):
+            time[i] = t
+        volts[i, j] = v
+        for label in m:
+            if label not in meta:
+                meta[label] = [np.full((len(captures), len(channels)),
+                    np.nan), m[label][1]]
+            meta[label][0][i, j] = m[label][0]
+
+    meta['captures'] = np.array(captures)
+    meta['channels'] = np.array(channels)
+    meta['fnames'] = fnames
+    return time, volts, meta
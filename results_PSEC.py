@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import os
+import json
+import numpy as np
+import cache_PSEC
+
+# Binary store for per-event results, so that later stages read them straight
+#  back into arrays rather than parsing text. A results file is:
+#   - a magic line, identifying the file
+#   - one line of JSON with the dtype of the records, padded out to
+#      cache_PSEC.ALIGN bytes
+#   - the records, one after the other, as a numpy structured array
+#
+# New records are only ever added on to the end, so a file can be written a
+#  chunk of events at a time as an analysis goes, and read while it's still
+#  being written. A record cut short by an interrupted write is ignored when
+#  reading, and cut off before anything more is added.
+
+MAGIC = b'PSEC4 RESULTS\n'
+VERSION = 1
+EXT = '.psres'
+
+# The results of fitting and integrating the pulse on one channel of one
+#  event. Times are in ns, positions in m and charges in C.
+RESULTS = np.dtype([
+    ('event', '<u4'),     # event counter, from read_PSEC.decode_meta()
+    ('channel', '<u1'),   # index of the channel, 0-5
+    ('status', '<i1'),    # fit status, see fit_PSEC.CONVERGED
+    ('arrival', '<f4'),   # time of the first pulse
+    ('delta_t', '<f4'),   # time between the direct and reflected pulses
+    ('position', '<f4'),  # where on the strip the pulse came from
+    ('charge', '<f4'),    # integrated charge
+    ('gain', '<f4'),      # gain, assuming a single photoelectron
+    ('chisq', '<f4'),     # reduced chi square of the fit
+    ])
+
+# The maximum signal velocity found in each file of a trial, in m/s, as
+#  statistical_velocities.py and lappd.py velocities save them
+VELOCITIES = np.dtype([('velocity', '<f8')])
+
+def empty(n, dtype=RESULTS):
+    '''Makes an array of <n> records to fill in. Floating point fields start
+    as NaN, and everything else as 0.'''
+    records = np.zeros(n, dtype=dtype)
+    for name in records.dtype.names:
+        if records.dtype.fields[name][0].kind == 'f':
+            records[name] = np.nan
+    return records
+
+def _read_desc(f):
+    # Reads the description at the top of a results file. Returns the dtype
+    #  and the offset of the first record, or None if it isn't one.
+    if f.read(len(MAGIC)) != MAGIC:
+        return None
+    line = f.readline()
+    try:
+        desc = json.loads(line.decode())
+    except ValueError:
+        return None
+    if desc.get('version') != VERSION:
+        return None
+    start = len(MAGIC) + len(line)
+    start += cache_PSEC._pad(start)
+    return cache_PSEC._dtype_from_json(desc['dtype']), start
+
+def is_results(fname):
+    '''Whether <fname> is a results file'''
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class Writer(object):
+    '''Adds records on to the end of a results file, making it if it doesn't
+    exist. Use it in a with block, or call close() when done.
+     <fname> = results file
+     <dtype> = dtype of the records. An existing file has to have the same.
+     <keep>  = if given, only this many records already in the file are kept,
+            e.g. to go back to a checkpoint'''
+    def __init__(self, fname, dtype=RESULTS, keep=None):
+        self.fname = fname
+        self.dtype = np.dtype(dtype)
+        # Number of records in the file
+        self.n = 0
+        if os.path.isfile(fname) and os.path.getsize(fname) > 0:
+            with open(fname, 'rb') as f:
+                desc = _read_desc(f)
+            if desc is None:
+                raise IOError("%s isn't a results file" % fname)
+            if desc[0] != self.dtype:
+                raise ValueError("%s holds records of a different dtype" %
+                    fname)
+            start = desc[1]
+            # Cut off a record from an interrupted write
+            size = os.path.getsize(fname)
+            self.n = (size - start) // self.dtype.itemsize
+            if keep is not None:
+                self.n = min(self.n, keep)
+            if start + self.n*self.dtype.itemsize != size:
+                with open(fname, 'r+b') as f:
+                    f.truncate(start + self.n*self.dtype.itemsize)
+            self._f = open(fname, 'ab')
+        else:
+            text = MAGIC + json.dumps({'version': VERSION,
+                'dtype': cache_PSEC._dtype_to_json(self.dtype)}).encode() + \
+                b'\n'
+            self._f = open(fname, 'wb')
+            self._f.write(text + b' '*cache_PSEC._pad(len(text)))
+
+    def append(self, records):
+        '''Adds records to the end of the file.
+         <records> = structured array of the records, with the file's dtype'''
+        records = np.asarray(records)
+        if records.dtype != self.dtype:
+            raise ValueError("records have the wrong dtype for %s" %
+                self.fname)
+        self._f.write(np.ascontiguousarray(records).tobytes())
+        self.n += len(records)
+
+    def flush(self):
+        '''Makes sure everything appended so far is in the file'''
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def write(fname, records):
+    '''Writes records to a new results file, replacing anything already in
+    <fname>.'''
+    if os.path.isfile(fname):
+        os.remove(fname)
+    records = np.asarray(records)
+    with Writer(fname, records.dtype) as w:
+        w.append(records)
+
+def read(fname, mmap=True):
+    '''Reads every whole record in a results file.
+     <fname> = results file
+     <mmap>  = if True, the records are memory mapped copy-on-write, so
+            nothing is read until it's used
+    Returns: records
+     <records> = structured array of the records'''
+    with open(fname, 'rb') as f:
+        desc = _read_desc(f)
+    if desc is None:
+        raise IOError("%s isn't a results file" % fname)
+    dtype, start = desc
+    n = max(os.path.getsize(fname) - start, 0) // dtype.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    if mmap:
+        return np.memmap(fname, dtype=dtype, mode='c', offset=start,
+            shape=(n,))
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        return np.fromfile(f, dtype=dtype, count=n)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+import numpy as np
+import charge_PSEC
+
+# Noise spectra of PSEC4 (or scope) waveforms, and notch filters for any
+#  pickup lines in them. Spectra are averaged over every event, with one
+#  batched rfft over each block of events, and the sums from each block can
+#  be added together, so a whole run goes through parallel_PSEC.map_events().
+#  Lines are the bins that stand well above the running median of the
+#  spectrum around them.
+#
+# A Notch fits sines and cosines at, and just either side of, each line to
+#  every trace by least squares, and takes them off. A trace is only 256
+#  samples, which a filter in the frequency domain rings at both ends of,
+#  whereas this takes out the lines evenly along the whole trace, and only a
+#  few degrees of freedom for each, so pulses are hardly touched. It's
+#  linear, so it's worked out once as a matrix, kept, and applied to a whole
+#  block of events as one matrix multiplication:
+#
+#   freqs, power = spectrum_PSEC.average(*spectrum_PSEC.spectrum_sum(data))
+#   lines, strength = spectrum_PSEC.find_lines(freqs, power[ch])
+#   filtered = spectrum_PSEC.Notch(lines).apply(data)
+
+def _window(n):
+    # Hann window, and what it does to the power
+    w = np.hanning(n)
+    return w, np.sum(w*w)
+
+def power_spectrum(data, dt=charge_PSEC.DT):
+    '''Gets the one-sided power spectral density of every trace.
+     <data> = array with the samples along the last axis, in V, e.g.
+            (n_events, 6, 256) or a single scope trace
+     <dt>   = time between samples, in s
+    Returns: freqs, power
+     <freqs> = array of the frequency of each bin, in Hz
+     <power> = array of the power in each bin, in V^2/Hz, the shape of
+            <data> with the samples replaced by the bins'''
+    data = np.asarray(data)
+    n = data.shape[-1]
+    w, norm = _window(n)
+    # Take off the mean, so the window doesn't spread it into the low bins
+    data = data - np.mean(data, axis=-1, keepdims=True)
+    spectrum = np.fft.rfft(data*w.astype(data.dtype), axis=-1)
+    power = np.square(np.abs(spectrum), dtype=np.float64)*(2*dt/norm)
+    # DC and Nyquist only appear once
+    power[..., 0] /= 2
+    if n % 2 == 0:
+        power[..., -1] /= 2
+    return np.fft.rfftfreq(n, dt), power
+
+def spectrum_sum(data, meta=None, dt=charge_PSEC.DT):
+    '''Adds up the power spectra of a block of events. The sums from several
+    blocks can be added together.
+     <data> = (n_events, 6, 256) array of voltages, in V
+     <meta> = their metadata. Not used, but there for
+            parallel_PSEC.map_events().
+     <dt>   = time between samples, in s
+    Returns: freqs, total, n
+     <freqs> = array of the frequency of each bin, in Hz
+     <total> = (6, n_bins) array of the summed power of each channel
+     <n>     = number of events summed'''
+    freqs, power = power_spectrum(data, dt)
+    return freqs, np.sum(power, axis=0), len(power)
+
+def average(freqs, total, n):
+    '''Turns the sums from spectrum_sum() into the mean power spectrum.
+    Returns: freqs, power'''
+    if n == 0:
+        raise ValueError("No events to average the spectrum over")
+    return freqs, total/n
+
+def find_lines(freqs, power, factor=4., width=9, min_freq=0.):
+    '''Finds pickup lines in a spectrum.
+     <freqs>    = array of the frequency of each bin, in Hz
+     <power>    = array of the power in each bin
+     <factor>   = a line has to be this many times the running median
+     <width>    = number of bins the running median is taken over
+     <min_freq> = ignore anything below this, in Hz
+    Returns: lines, strength
+     <lines>    = array of the frequency of each line, in Hz
+     <strength> = array of how many times the running median each one is'''
+    power = np.asarray(power, dtype=np.float64)
+    half = width//2
+    padded = np.pad(power, half, mode='reflect')
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2*half + 1)
+    background = np.median(windows, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(background > 0, power/background, 0.)
+
+    # Local maxima over the factor, leaving out DC
+    peak = np.zeros(len(power), dtype=bool)
+    peak[1:-1] = (ratio[1:-1] >= ratio[:-2]) & (ratio[1:-1] > ratio[2:])
+    if len(power) > 1:
+        peak[-1] = ratio[-1] > ratio[-2]
+    peak &= (ratio > factor) & (freqs > max(min_freq, 0.))
+
+    # Between the bins, from a parabola through the log of the power around
+    #  each, which the Hann window makes about the right shape
+    index = np.nonzero(peak)[0]
+    inner = np.clip(index, 1, len(power) - 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p0, p1, p2 = [np.log(power[inner + k]) for k in (-1, 0, 1)]
+        step = 0.5*(p0 - p2)/(p0 - 2*p1 + p2)
+    step = np.where((index == inner) & np.isfinite(step),
+        np.clip(step, -0.5, 0.5), 0.)
+    return freqs[index] + step*(freqs[1] - freqs[0]), ratio[peak]
+
+class Notch(object):
+    '''Filter that takes out narrow lines.
+     <lines> = array of the frequencies to take out, in Hz. Lines closer
+            together than half the width, e.g. the same line found on
+            several channels, are taken out as one.
+     <width> = width of the band taken out around each, in Hz. One bin of a
+            256 sample trace, at 10 GS/s, if None.
+     <dt>    = time between samples, in s'''
+    def __init__(self, lines, width=None, dt=charge_PSEC.DT):
+        self.width = 1./(256*dt) if width is None else width
+        lines = np.sort(np.atleast_1d(np.asarray(lines, dtype=np.float64)))
+        group = np.cumsum(np.diff(lines, prepend=-np.inf) > self.width/2) - 1
+        self.lines = np.bincount(group, lines)/np.bincount(group) \
+            if len(lines) else lines
+        self.dt = dt
+        # Matrix of the filter for each length of trace, once it's been made
+        self._matrices = {}
+
+    def matrix(self, n):
+        '''Gets the filter as an (n, n) matrix, for traces of <n> samples.
+        filtered = np.dot(trace, matrix).'''
+        if n not in self._matrices:
+            # Sines and cosines at each line and either side of it, made
+            #  orthonormal, and projected out
+            t = np.arange(n)*self.dt
+            freqs = (self.lines[:, np.newaxis] +
+                np.array([-0.25, 0., 0.25])*self.width).ravel()
+            phase = 2*np.pi*freqs*t[:, np.newaxis]
+            waves = np.concatenate((np.sin(phase), np.cos(phase)), axis=1)
+            matrix = np.eye(n)
+            if len(freqs):
+                q, r = np.linalg.qr(waves)
+                # Leave out any that are the same as others, e.g. at DC
+                q = q[:, np.abs(np.diag(r)) > 1e-9*np.sqrt(n)]
+                matrix -= np.dot(q, q.T)
+            self._matrices[n] = matrix
+        return self._matrices[n]
+
+    def apply(self, data):
+        '''Filters every trace in a block of events.
+         <data> = array with the samples along the last axis, e.g.
+                (n_events, 6, 256)
+        Returns: filtered
+         <filtered> = array of the filtered traces, the same shape and, for
+                floating point data, type'''
+        data = np.asarray(data)
+        dtype = data.dtype if data.dtype.kind == 'f' else np.float64
+        n = data.shape[-1]
+        matrix = self.matrix(n).astype(dtype)
+        # As one 2D product, which is far quicker than np.dot() of a 3D array
+        traces = data.reshape(-1, n).astype(dtype, copy=False)
+        return np.dot(traces, matrix).reshape(data.shape)
+
+    def __getstate__(self):
+        # Workers make their own matrices
+        return {'lines': self.lines, 'width': self.width, 'dt': self.dt}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+def save(fname, notch):
+    '''Writes a notch filter to a .npz file'''
+    with open(fname, 'wb') as f:
+        np.savez(f, lines=notch.lines, width=notch.width, dt=notch.dt)
+
+def load(fname):
+    '''Reads a notch filter written by save()'''
+    with np.load(fname) as arrays:
+        return Notch(arrays['lines'], float(arrays['width']),
+            float(arrays['dt']))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import charge_PSEC
+import read_PSEC as psec
+import timing_PSEC as timing
+
+# Matched filtering of single photoelectron pulses. A template of the pulse
+#  shape is averaged from clean pulses, each lined up on its constant fraction
+#  time and scaled to a height of 1, on a grid <oversample> times finer than
+#  the samples. Every channel of every event is then fitted with
+#
+#   y = amplitude*template(t - time) + offset
+#
+#  which is linear in the amplitude and offset for each time, so rather than
+#  fitting, each trace is compared against the template at every step of
+#  the fine grid within a few samples of where its pulse is, in one matrix
+#  multiplication for the whole block, and the time with the least squares
+#  wins. A parabola through the chi square either side of it gets the time
+#  to a fraction of a step. This uses every sample of the pulse, weighted by
+#  the shape, so it holds up far better in the noise than adding up whatever
+#  is below a threshold, and costs about the same.
+#
+# Where the pulse is to start with is the lowest few samples of the trace.
+#  Times are in ns, from the first sample, like timing_PSEC.
+
+# Template grid steps per sample
+OVERSAMPLE = 10
+# Samples before and after the constant fraction time the template covers
+BEFORE = 10
+AFTER = 30
+# Samples either side of the starting guess that the time is searched over
+SEARCH = 4
+# Samples in each bin the trace is summed into for the starting guess
+SMOOTH = 4
+
+# The fit of the template to one channel of one event
+TEMPLATE_RESULTS = np.dtype([
+    ('event', '<u4'),     # event counter, from read_PSEC.decode_meta()
+    ('channel', '<u1'),   # index of the channel, 0-5
+    ('amplitude', '<f4'), # height of the pulse, in V. Positive.
+    ('time', '<f4'),      # constant fraction time of the pulse, in ns
+    ('charge', '<f4'),    # charge under the fitted template, in C. Negative.
+    ('chisq', '<f4'),     # reduced chi square, in V^2
+    ])
+
+class Template(object):
+    '''The average shape of a pulse.
+     <shape>      = array of the pulse, with its lowest point at -1, on a grid
+            of <oversample> steps per sample starting <before> samples before
+            its constant fraction time
+     <before>     = samples before the constant fraction time
+     <oversample> = grid steps per sample
+     <n>          = number of pulses it's the average of'''
+    def __init__(self, shape, before=BEFORE, oversample=OVERSAMPLE, n=0):
+        self.shape = np.asarray(shape, dtype=np.float64)
+        self.before = before
+        self.oversample = oversample
+        self.n = n
+
+    @property
+    def length(self):
+        '''Number of whole samples the template covers'''
+        return (len(self.shape) - 1)//self.oversample
+
+    @property
+    def peak(self):
+        '''Samples from the constant fraction time to the lowest point'''
+        return np.argmin(self.shape)/float(self.oversample) - self.before
+
+    def area(self, dt=charge_PSEC.DT):
+        '''Integral of the template, in s per V of amplitude'''
+        return np.sum(self.shape)*dt/self.oversample
+
+    def at(self, samples):
+        '''Gets the template at times relative to its constant fraction time.
+         <samples> = array of the times, in samples
+        Returns: values
+         <values> = array of the template there, 0 outside of it'''
+        grid = np.arange(len(self.shape))/float(self.oversample) - self.before
+        return np.interp(samples, grid, self.shape, left=0., right=0.)
+
+    def bases(self, search=SEARCH):
+        '''Gets the template at every grid step it's searched over.
+         <search> = samples either side of the starting guess to search
+        Returns: bases
+         <bases> = (2*search*oversample + 1, length + 2*search) array. Row q
+                is the template with its constant fraction time at sample
+                before + q/oversample of the window.'''
+        window = np.arange(self.length + 2*search)
+        shifts = self.before + np.arange(2*search*self.oversample + 1) / \
+            float(self.oversample)
+        return self.at(window - shifts[:, np.newaxis])
+
+def aligned_sum(data, meta=None, channels=None, fraction=0.3, min_height=0.005,
+        max_height=0.5, before=BEFORE, after=AFTER, oversample=OVERSAMPLE):
+    '''Lines up the clean pulses in a block of events on their constant
+    fraction times, scaled to a height of 1, and adds them up. Clean means a
+    height between <min_height> and <max_height>, the whole template window in
+    the trace, and nothing outside the window reaching <fraction> of the
+    height. The sums of several blocks can be added together.
+     <data>       = (n_events, 6, 256) array of voltages, in V
+     <meta>       = their metadata. Not used, but there for
+            parallel_PSEC.map_events().
+     <channels>   = indices of the channels to take pulses from. All of them
+            if None.
+     <fraction>   = constant fraction to line them up at
+     <min_height>, <max_height> = range of pulse heights to take, in V
+     <before>, <after> = samples before and after the constant fraction time
+            to keep
+     <oversample> = grid steps per sample
+    Returns: total, n
+     <total> = array of the sum of the lined up pulses
+     <n>     = number of pulses in it'''
+    data = np.asarray(data)
+    if channels is not None:
+        data = data[:, channels]
+    traces = data.reshape(-1, data.shape[-1]).astype(np.float64)
+    n_samples = traces.shape[-1]
+    base = timing.baseline(traces)
+    traces = traces - base[:, np.newaxis]
+    height = -np.min(traces, axis=-1)
+    cfd = timing.constant_fraction(traces, fraction, np.zeros(len(traces)),
+        ts=np.arange(n_samples, dtype=np.float64))
+
+    good = ((height >= min_height) & (height <= max_height) &
+        (cfd >= before) & (cfd < n_samples - after - 1))
+    traces, height, cfd = traces[good], height[good], cfd[good]
+
+    # Nothing else big in the trace
+    i = np.arange(n_samples)
+    outside = ((i < np.floor(cfd - before)[:, np.newaxis]) |
+        (i > np.ceil(cfd + after)[:, np.newaxis]))
+    quiet = np.all(~outside | (traces > -fraction*height[:, np.newaxis]),
+        axis=-1)
+    traces, height, cfd = traces[quiet], height[quiet], cfd[quiet]
+
+    # Resample each onto the template grid, by linear interpolation
+    grid = np.arange((before + after)*oversample + 1)/float(oversample) - \
+        before
+    at = cfd[:, np.newaxis] + grid
+    index = np.minimum(np.floor(at).astype(np.intp), n_samples - 2)
+    frac = at - index
+    lined_up = (np.take_along_axis(traces, index, axis=-1)*(1 - frac) +
+        np.take_along_axis(traces, index + 1, axis=-1)*frac)
+    lined_up /= height[:, np.newaxis]
+    return lined_up.sum(axis=0), len(lined_up)
+
+def from_sum(total, n, before=BEFORE, oversample=OVERSAMPLE):
+    '''Makes the template from the sums from aligned_sum().
+     <total>, <n> = summed over however many blocks
+     <before>, <oversample> = as given to aligned_sum()
+    Returns: template
+     <template> = Template'''
+    if n == 0:
+        raise ValueError("No clean pulses to make a template from")
+    shape = np.asarray(total, dtype=np.float64)/n
+    shape /= -np.min(shape)
+    return Template(shape, before, oversample, n)
+
+def build(data, channels=None, **kwargs):
+    '''Makes a template from the clean pulses in a block of events.
+     <data>     = (n_events, 6, 256) array of voltages, in V
+     <channels> = indices of the channels to take pulses from
+     <kwargs>   = anything else to give aligned_sum()
+    Returns: template
+     <template> = Template'''
+    total, n = aligned_sum(data, None, channels, **kwargs)
+    return from_sum(total, n, kwargs.get('before', BEFORE),
+        kwargs.get('oversample', OVERSAMPLE))
+
+def save(fname, template):
+    '''Writes a template to a .npz file'''
+    with open(fname, 'wb') as f:
+        np.savez(f, shape=template.shape, before=template.before,
+            oversample=template.oversample, n=template.n)
+
+def load(fname):
+    '''Reads a template written by save()'''
+    with np.load(fname) as arrays:
+        return Template(arrays['shape'], float(arrays['before']),
+            int(arrays['oversample']), int(arrays['n']))
+
+def match(data, template, search=SEARCH, smooth=SMOOTH, ts=timing.TS):
+    '''Fits the template to every channel of every event.
+     <data>     = (n_events, 6, 256) array of voltages, in V, or any array
+            with the samples along the last axis
+     <template> = Template
+     <search>   = samples either side of the starting guess to search over
+     <smooth>   = samples to smooth over for the starting guess
+     <ts>       = time of each sample, in ns. Evenly spaced.
+    Returns: amplitude, time, chisq
+     <amplitude> = array of the height of each pulse, in V, the shape of
+            <data> without its last axis. Positive for a negative going pulse.
+     <time>      = array of their constant fraction times, in ns
+     <chisq>     = array of the reduced chi square of each fit, in V^2'''
+    data = np.asarray(data)
+    shape = data.shape[:-1]
+    n_samples = data.shape[-1]
+    traces = np.asarray(data.reshape(-1, n_samples), dtype=np.float32)
+
+    # Starting guess: the lowest bin of <smooth> samples. Whole bins are
+    #  quicker to add up than a sliding sum, and the search is wide enough
+    #  to make up for the pulse straddling two.
+    n_bins = n_samples//smooth
+    binned = traces[:, 0:n_bins*smooth:smooth].copy()
+    for i in range(1, smooth):
+        binned += traces[:, i:n_bins*smooth:smooth]
+    lowest = np.argmin(binned, axis=-1)*smooth + (smooth - 1)/2.
+
+    # Window of samples that covers the template at any time searched over
+    bases = template.bases(search).astype(np.float32)
+    n_window = bases.shape[1]
+    start = np.round(lowest - template.peak - template.before - search)
+    start = np.clip(start, 0, n_samples - n_window).astype(np.intp)
+    window = sliding_window_view(traces, n_window, axis=-1)[
+        np.arange(len(traces)), start]
+
+    # Least squares of amplitude and offset at every time at once. With the
+    #  means of the window and the template taken off, the offset drops out,
+    #  and with the template scaled to a length of 1, the chi square is the
+    #  sum of squares less score^2, with score = y.t. So the best time is
+    #  just the highest score, which also only lets positive amplitudes,
+    #  negative going pulses, win.
+    mean = np.mean(window, axis=1, dtype=np.float64)
+    window -= mean.astype(np.float32)[:, np.newaxis]
+    bases -= np.mean(bases, axis=1)[:, np.newaxis]
+    norm = np.sqrt(np.sum(bases*bases, axis=1))
+    bases /= norm[:, np.newaxis]
+    score = np.dot(window, bases.T)
+    best = np.argmax(score, axis=1)
+
+    # Parabola through the chi square at the best and either side of it
+    rows = np.arange(len(best))
+    inner = np.clip(best, 1, score.shape[1] - 2)
+    s0 = np.square(score[rows, inner - 1], dtype=np.float64)
+    s1 = np.square(score[rows, inner], dtype=np.float64)
+    s2 = np.square(score[rows, inner + 1], dtype=np.float64)
+    curve = 2*s1 - s0 - s2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        step = np.where(curve > 0, 0.5*(s2 - s0)/curve, 0.)
+    step = np.where(best == inner, np.clip(step, -0.5, 0.5), 0.)
+
+    top = score[rows, best].astype(np.float64)
+    amplitude = top/norm[best]
+    yy = np.sum(window*window, axis=1, dtype=np.float64)
+    chisq = np.maximum(yy - top*top, 0.)/max(n_window - 2, 1)
+
+    sample = start + template.before + (best + step)/template.oversample
+    time = ts[0] + sample*(ts[1] - ts[0])
+    return (amplitude.reshape(shape), time.reshape(shape),
+        chisq.reshape(shape))
+
+def template_results(data, meta, template, channels=None, search=SEARCH,
+        dt=charge_PSEC.DT, resistance=charge_PSEC.RESISTANCE):
+    '''Fits the template to a block of events, as records for results_PSEC.
+     <data>, <meta> = voltages and metadata of the events
+     <template>     = Template
+     <channels>     = indices of the channels to fit. All of them if None.
+     <search>       = as for match()
+     <dt>           = time between samples, in s
+     <resistance>   = termination resistance, in Ohms
+    Returns: records
+     <records> = TEMPLATE_RESULTS array, a record for every channel of every
+            event'''
+    if channels is None:
+        channels = np.arange(psec.N_CHANNELS)
+    channels = np.asarray(channels)
+    amplitude, time, chisq = match(np.asarray(data)[:, channels], template,
+        search)
+    records = np.zeros(amplitude.size, dtype=TEMPLATE_RESULTS)
+    records['event'] = np.repeat(meta['event'], len(channels))
+    records['channel'] = np.tile(channels, len(amplitude))
+    records['amplitude'] = amplitude.ravel()
+    records['time'] = time.ravel()
+    records['charge'] = amplitude.ravel()*template.area(dt)/resistance
+    records['chisq'] = chisq.ravel()
+    return records
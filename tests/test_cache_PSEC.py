@@ -0,0 +1,79 @@
+import os
+import shutil
+import numpy as np
+import cache_PSEC
+import read_PSEC as psec
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'sample.txt')
+
+def _log(tmp_path):
+    # A copy of the sample log that can be changed
+    fname = str(tmp_path / 'log.txt')
+    shutil.copy(SAMPLE, fname)
+    return fname
+
+def _events(fname):
+    # The data lines of a log, without its header
+    with open(fname, 'rb') as f:
+        psec.read_header(f)
+        return f.read()
+
+def test_round_trip(tmp_path):
+    fname = _log(tmp_path)
+    arrays = {'data': np.arange(24, dtype=np.float32).reshape(2, 3, 4),
+        'meta': np.zeros(2, dtype=psec.META_DTYPE),
+        'empty': np.zeros((0, 6))}
+    assert cache_PSEC.save(fname, arrays, ['# a header']) is not None
+    loaded, header = cache_PSEC.load(fname)
+    assert header == ['# a header']
+    assert sorted(loaded) == sorted(arrays)
+    for name in arrays:
+        assert loaded[name].dtype == arrays[name].dtype
+        np.testing.assert_array_equal(loaded[name], arrays[name])
+
+def test_stale_when_log_changes(tmp_path):
+    fname = _log(tmp_path)
+    cache_PSEC.save(fname, {'x': np.zeros(3)}, [])
+    assert cache_PSEC.load(fname) is not None
+    with open(fname, 'ab') as f:
+        f.write(b'0.000000\n')
+    assert cache_PSEC.load(fname) is None
+
+def test_stale_when_touched(tmp_path):
+    fname = _log(tmp_path)
+    cache_PSEC.save(fname, {'x': np.zeros(3)}, [])
+    st = os.stat(fname)
+    os.utime(fname, (st.st_atime, st.st_mtime + 10))
+    assert cache_PSEC.load(fname) is None
+
+def test_stale_when_log_grows_while_read(tmp_path, monkeypatch):
+    '''A log that grows while it's being read mustn't be cached as up to
+    date, or the new events would never be read'''
+    fname = _log(tmp_path)
+    more = _events(fname)
+    n_events = len(psec.parse(more)[0])
+    parse = psec.parse
+
+    def growing(body, dtype=np.float32):
+        # LogData adds more events after the log has been read
+        with open(fname, 'ab') as f:
+            f.write(more)
+        return parse(body, dtype)
+    monkeypatch.setattr(psec, 'parse', growing)
+    data = psec.load(fname)[0]
+    monkeypatch.setattr(psec, 'parse', parse)
+
+    assert len(data) == n_events
+    assert cache_PSEC.load(fname) is None
+    assert len(psec.load(fname)[0]) == 2*n_events
+    assert cache_PSEC.load(fname) is not None
+
+def test_index_stale_when_log_grows(tmp_path):
+    fname = _log(tmp_path)
+    starts, stops, header = psec.build_index(fname)
+    assert psec.load_index(fname, build=False) is not None
+    with open(fname, 'ab') as f:
+        f.write(_events(fname))
+    assert psec.load_index(fname, build=False) is None
+    assert len(psec.load_index(fname)[0]) == 2*len(starts)
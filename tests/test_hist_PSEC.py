@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import hist_PSEC as hist
+
+def _values(seed, n=1000):
+    rng = np.random.RandomState(seed)
+    x = rng.normal(0.5, 0.4, size=n)
+    # Values right on the edges, and a NaN
+    x[:4] = [0., 1., 0.1, np.nan]
+    return x
+
+def test_fill_matches_numpy():
+    x = _values(1)
+    h = hist.Histogram(10, (0., 1.))
+    h.fill(x)
+    good = x[~np.isnan(x)]
+    counts, edges = np.histogram(good, bins=10, range=(0., 1.))
+    np.testing.assert_array_equal(h.counts, counts)
+    assert h.underflow == np.sum(good < 0.)
+    assert h.overflow == np.sum(good > 1.)
+
+def test_fill_one_at_a_time():
+    x = _values(2, 200)
+    whole = hist.Histogram(10, (0., 1.))
+    whole.fill(x)
+    one = hist.Histogram(10, (0., 1.))
+    for value in x:
+        one.fill(value)
+    np.testing.assert_array_equal(one.counts, whole.counts)
+    np.testing.assert_allclose(one.sums, whole.sums)
+    assert (one.underflow, one.overflow) == (whole.underflow, whole.overflow)
+
+def test_merge_matches_one_fill():
+    '''Histograms filled by separate workers add up to one filled with
+    everything'''
+    x = _values(3)
+    whole = hist.Histogram(20, (0., 1.))
+    whole.fill(x, weights=2*x)
+    parts = []
+    for chunk in np.array_split(x, 3):
+        h = hist.Histogram(20, (0., 1.))
+        h.fill(chunk, weights=2*chunk)
+        parts.append(h)
+    total = hist.merge(parts)
+    np.testing.assert_array_equal(total.counts, whole.counts)
+    np.testing.assert_allclose(total.sums, whole.sums)
+    np.testing.assert_allclose(total.sums2, whole.sums2)
+    assert (total.underflow, total.overflow) == (whole.underflow,
+        whole.overflow)
+    # Merging doesn't change the parts
+    assert parts[0].n < total.n
+    assert hist.merge([]) is None
+
+def test_different_bins_dont_add():
+    with pytest.raises(ValueError):
+        hist.Histogram(10, (0., 1.)) + hist.Histogram(10, (0., 2.))
+
+def test_save_and_state(tmp_path):
+    h = hist.Histogram(10, (0., 1.))
+    h.fill(_values(4))
+    fname = str(tmp_path / 'hists.npz')
+    hist.save(fname, {'a': h})
+    for other in (hist.load(fname)['a'], hist.from_state(h.state())):
+        np.testing.assert_array_equal(other.edges, h.edges)
+        np.testing.assert_array_equal(other.counts, h.counts)
+        np.testing.assert_allclose(other.sums2, h.sums2)
+        assert (other.underflow, other.overflow) == (h.underflow,
+            h.overflow)
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import charge_PSEC
+import hits_PSEC
+import read_PSEC as psec
+
+def _brute_force(data, threshold, release, min_width, channels=None):
+    # The hits found by walking along every trace one sample at a time
+    threshold = np.broadcast_to(threshold, data.shape)
+    release = np.broadcast_to(release, data.shape)
+    hits = []
+    for i in range(data.shape[0]):
+        for ch in range(data.shape[1]):
+            if channels is not None and ch not in channels:
+                continue
+            v = data[i, ch]
+            inside = (v < release[i, ch]) | (v < threshold[i, ch])
+            j = 0
+            while j < len(v):
+                if not inside[j]:
+                    j += 1
+                    continue
+                start = j
+                while j < len(v) and inside[j]:
+                    j += 1
+                run = v[start:j]
+                if (j - start >= min_width and
+                        np.any(run < threshold[i, ch, start:j])):
+                    hits.append((i, ch, start, start + np.argmin(run), j,
+                        run.min(), run.astype(np.float64).sum()))
+    return hits
+
+def _check(hits, expected, meta=None):
+    assert len(hits) == len(expected)
+    for hit, (i, ch, start, peak, end, amplitude, total) in zip(hits,
+            expected):
+        assert (hit['index'], hit['channel'], hit['start'], hit['peak'],
+            hit['end']) == (i, ch, start, peak, end)
+        assert hit['event'] == (i if meta is None else meta['event'][i])
+        assert hit['amplitude'] == np.float32(amplitude)
+        assert hit['charge'] == pytest.approx(
+            total*charge_PSEC.DT/charge_PSEC.RESISTANCE, rel=1e-5)
+
+@pytest.mark.parametrize('min_width', [1, 2, 4])
+def test_runs_match_brute_force(min_width):
+    rng = np.random.RandomState(min_width)
+    data = rng.normal(0, 0.01, size=(20, psec.N_CHANNELS, psec.N_CELLS))
+    data = data.astype(np.float32)
+    # Some runs right up against either end of the traces
+    data[::3, :, :3] = -0.05
+    data[1::3, :, -3:] = -0.05
+    hits = hits_PSEC.find_hits(data, -0.015, -0.005, min_width=min_width)
+    _check(hits, _brute_force(data, -0.015, -0.005, min_width))
+
+def test_thresholds_per_event_and_sample():
+    rng = np.random.RandomState(7)
+    data = rng.normal(0, 0.01, size=(10, psec.N_CHANNELS, psec.N_CELLS))
+    data = data.astype(np.float32)
+    threshold = rng.uniform(-0.03, -0.01, size=(10, 1, 1))
+    release = rng.uniform(-0.01, 0., size=(psec.N_CHANNELS, psec.N_CELLS))
+    meta = np.zeros(10, dtype=psec.META_DTYPE)
+    meta['event'] = np.arange(100, 110)
+    hits = hits_PSEC.find_hits(data, threshold, release, meta=meta,
+        channels=[0, 2, 3])
+    _check(hits, _brute_force(data, threshold, release, 2, [0, 2, 3]), meta)
+    assert set(hits['channel']) <= set([0, 2, 3])
+
+def test_no_hits():
+    data = np.zeros((3, psec.N_CHANNELS, psec.N_CELLS), dtype=np.float32)
+    hits = hits_PSEC.find_hits(data, -0.01)
+    assert len(hits) == 0
+    assert hits.dtype == hits_PSEC.HITS
+    assert len(hits_PSEC.find_hits(data[:0], -0.01)) == 0
@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import pytest
+import read_PSEC as psec
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'sample.txt')
+
+def _log_lines(rng, n_lines):
+    # Lines like LogData's: six '%f' voltages, and a seventh column of
+    #  metadata on some of them
+    volts = rng.uniform(-9.9, 9.9, size=(n_lines, psec.N_CHANNELS))
+    volts[rng.uniform(size=volts.shape) < 0.5] *= 1e-2
+    lines = []
+    for i, row in enumerate(volts):
+        line = '\t'.join('%f' % v for v in row)
+        if i % psec.N_CELLS < psec.N_META:
+            line += '\t%d' % rng.randint(0, 1 << 16)
+        lines.append(line + '\n')
+    return ''.join(lines).encode()
+
+def test_parse_fixed_matches_float():
+    '''The fast path has to give exactly what float() does'''
+    rng = np.random.RandomState(1)
+    chunk = _log_lines(rng, 3*psec.N_CELLS)
+    values = psec._parse_fixed(chunk)
+    assert values is not None
+    np.testing.assert_array_equal(values, [float(x) for x in chunk.split()])
+
+@pytest.mark.parametrize('text', [
+    b'0.000000 -0.000000 9.999999 -9.999999\n',
+    b'123.456789 -12.345678 1.5 -2e-3 7\n',
+    b'0.1234567 -0.000001 1.000000\r\n-3.141593\t2.718282 65535\n',
+    ])
+def test_parse_fixed_odd_tokens(text):
+    '''Tokens that aren't '[-]d.dddddd' still have to come out right'''
+    # Pad it out to more than the 16 bytes _parse_fixed needs
+    chunk = text*4
+    values = psec._parse_fixed(chunk)
+    if values is not None:
+        np.testing.assert_array_equal(values,
+            [float(x) for x in chunk.split()])
+    values, n = psec.parse_values(chunk, dtype=np.float64)
+    np.testing.assert_array_equal(values, [float(x) for x in chunk.split()])
+
+def test_parse_fixed_rejects_text():
+    '''Anything that isn't numbers is left to the slow path'''
+    assert psec._parse_fixed(b'0.100000 0.200000 abc 0.300000\n'*4) is None
+
+def test_parse_matches_line_parser():
+    '''The bulk parser gives the same events as the one line at a time'''
+    with open(SAMPLE, 'rb') as f:
+        psec.read_header(f)
+        body = f.read()
+    data, meta = psec.parse(body)
+    slow_data, slow_meta = psec._parse_lines(body.splitlines(), np.float32)
+    np.testing.assert_array_equal(data, slow_data)
+    np.testing.assert_array_equal(meta, slow_meta)
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pytest
+import results_PSEC as results
+
+def _records(n, first=0):
+    records = results.empty(n)
+    records['event'] = np.arange(first, first + n)
+    records['channel'] = 3
+    # Structured arrays with NaNs in don't compare equal
+    for name in ('arrival', 'delta_t', 'position', 'charge', 'gain',
+            'chisq'):
+        records[name] = 0.25*records['event']
+    return records
+
+def test_empty():
+    records = results.empty(2)
+    assert np.all(np.isnan(records['position']))
+    assert np.all(records['event'] == 0)
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_write_and_read(tmp_path, mmap):
+    fname = str(tmp_path / 'a.psres')
+    results.write(fname, _records(5))
+    assert results.is_results(fname)
+    back = results.read(fname, mmap=mmap)
+    assert back.dtype == results.RESULTS
+    np.testing.assert_array_equal(back, _records(5))
+
+def test_append(tmp_path):
+    '''Records written a chunk at a time, across runs, all come back'''
+    fname = str(tmp_path / 'a.psres')
+    with results.Writer(fname) as w:
+        w.append(_records(3))
+        w.flush()
+        np.testing.assert_array_equal(results.read(fname), _records(3))
+        w.append(_records(0))
+    with results.Writer(fname) as w:
+        assert w.n == 3
+        w.append(_records(4, first=3))
+    np.testing.assert_array_equal(results.read(fname), _records(7))
+
+def test_interrupted_write(tmp_path):
+    '''A record cut short is left out when reading, and cut off before
+    anything more is added'''
+    fname = str(tmp_path / 'a.psres')
+    results.write(fname, _records(3))
+    with open(fname, 'ab') as f:
+        f.write(_records(1, first=3).tobytes()[:5])
+    np.testing.assert_array_equal(results.read(fname), _records(3))
+    with results.Writer(fname) as w:
+        w.append(_records(2, first=3))
+    np.testing.assert_array_equal(results.read(fname), _records(5))
+
+def test_keep(tmp_path):
+    fname = str(tmp_path / 'a.psres')
+    results.write(fname, _records(5))
+    with results.Writer(fname, keep=2) as w:
+        w.append(_records(1, first=2))
+    np.testing.assert_array_equal(results.read(fname), _records(3))
+
+def test_other_dtypes(tmp_path):
+    fname = str(tmp_path / 'v.psres')
+    records = results.empty(2, results.VELOCITIES)
+    records['velocity'] = [1e8, 2e8]
+    results.write(fname, records)
+    np.testing.assert_array_equal(results.read(fname), records)
+    with pytest.raises(ValueError):
+        results.Writer(fname)
+    with open(str(tmp_path / 'b.psres'), 'wb') as f:
+        f.write(b'not a results file\n')
+    with pytest.raises(IOError):
+        results.read(str(tmp_path / 'b.psres'))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+import math
+import numpy as np
+
+# Flags the pulses in a trace with the z-score algorithm from
+#  https://stackoverflow.com/questions/22583391/peak-signal-detection-in-realtime-timeseries-data
+#  A sample is a signal if it's more than <threshold> standard deviations
+#  from the mean of the <lag> samples before it. A signal is only let into
+#  the mean and standard deviation after it with weight <influence>, the
+#  rest of its weight going to the filtered sample before it.
+#
+# The mean and standard deviation are running sums that are slid along the
+#  trace, rather than worked out again from the whole window at every
+#  sample, so a trace takes O(n) rather than O(n*lag). Most of it is done
+#  with numpy, by guessing and then finding where the guess went wrong: from
+#  the end of a pulse it's taken that nothing is a signal, and from the
+#  start of one that everything is. With influence 0, the filtered trace is
+#  just held at the value before the pulse, so the whole pulse can be done at
+#  once. Otherwise each sample of a pulse changes the window of the next, so
+#  they are stepped through one at a time.
+
+EPS = np.finfo(float).eps
+
+def _window_stats(filtered, start, stop, lag):
+    # Mean and standard deviation of filtered[i-lag:i] for every i from
+    #  <start> to <stop>. The first sample is taken off them all, so the
+    #  running sums don't lose precision.
+    ref = filtered[start-lag]
+    x = filtered[start-lag:stop-1] - ref
+    sums = np.zeros((2, len(x) + 1))
+    np.cumsum(x, out=sums[0, 1:])
+    np.cumsum(x*x, out=sums[1, 1:])
+    mean, var = (sums[:, lag:] - sums[:, :-lag])/lag
+    var -= mean*mean
+    mean += ref
+
+    # Where the window is (nearly) flat, the variance is lost in the rounding
+    #  of the sums, and a sample the same as the whole window mightn't quite
+    #  be the same as the mean. Those windows are worked out properly.
+    flat = var < 64*EPS*sums[1, -1]/lag
+    if flat.any():
+        flat = np.nonzero(flat)[0]
+        windows = filtered[start-lag:stop-1][flat[:, np.newaxis] +
+            np.arange(lag)]
+        mean[flat] = np.mean(windows, axis=1)
+        var[flat] = np.var(windows, axis=1)
+    return mean, np.sqrt(np.maximum(var, 0.))
+
+def _hits(y, avg, std, start, stop, threshold):
+    # Whether samples <start> to <stop> are outside the threshold of the
+    #  window before them
+    return (np.abs(y[start:stop] - avg[start-1:stop-1]) >
+        threshold*std[start-1:stop-1])
+
+def _hold(y, filtered, signals, avg, std, i, lag, threshold):
+    # A pulse from sample <i>, with no influence. Returns the first sample
+    #  that isn't a signal, or the length of the trace.
+    n = len(y)
+    first = i
+    held = filtered[i-1]
+    while i < n:
+        # Take it that the pulse goes on for another half a window, and find
+        #  where it didn't. Going past a window would overwrite ones after the
+        #  pulse that don't get worked out again, and a whole window held
+        #  flat is slower to work out.
+        stop = min(i + max(lag//2, 1), n)
+        filtered[i:stop] = held
+        end = min(stop + 1, n)
+        avg[i+1:end], std[i+1:end] = _window_stats(filtered, i+1, end, lag)
+        hits = _hits(y, avg, std, i+1, end, threshold)
+        k = np.argmin(hits) if len(hits) else 0
+        if len(hits) and not hits[k]:
+            i += 1 + k
+            filtered[i:stop] = y[i:stop]
+            break
+        i = stop
+    signals[first:i] = np.where(y[first:i] > avg[first-1:i-1], 1, -1)
+    return i
+
+def _step(y, filtered, signals, avg, std, i, lag, threshold, influence):
+    # A pulse from sample <i>, stepped through a sample at a time with
+    #  Welford's update for the window. This is done with memoryviews, as
+    #  getting at numpy arrays an element at a time is slow. Returns the first
+    #  sample that isn't a signal, or the length of the trace.
+    n = len(y)
+    values = memoryview(y)
+    fvalues = memoryview(filtered)
+    first = i
+    flags = []
+    means = [float(avg[i])]
+    stds = [float(std[i])]
+    mean = means[0]
+    m2 = stds[0]**2 * lag
+    last_mean = float(avg[i-1])
+    last_std = float(std[i-1])
+    last = fvalues[i-1]
+    # Largest the sum of squares of the window has been, which the rounding
+    #  in the updates is relative to
+    scale = m2 + lag*mean*mean
+    while abs(values[i] - last_mean) > threshold * last_std:
+        if values[i] > last_mean:
+            flags.append(1)
+        else:
+            flags.append(-1)
+        last = influence * values[i] + (1 - influence) * last
+        fvalues[i] = last
+        i += 1
+        if i == n:
+            break
+
+        # One sample into the window, and one out
+        old = fvalues[i-1-lag]
+        delta = last - old
+        last_mean, last_std = mean, stds[-1]
+        mean += delta/lag
+        m2 = max(m2 + delta*(last - mean + old - last_mean), 0.)
+        scale = max(scale, m2 + lag*mean*mean)
+        if m2 < 16*lag*EPS*scale:
+            # The window's gone flat, and what's left is rounding. Work it
+            #  out properly.
+            window = filtered[i-lag:i]
+            mean = float(np.mean(window))
+            m2 = float(np.var(window))*lag
+            scale = m2 + lag*mean*mean
+        means.append(mean)
+        stds.append(math.sqrt(m2/lag))
+
+    signals[first:first+len(flags)] = flags
+    avg[first:first+len(means)] = means
+    std[first:first+len(stds)] = stds
+    return i
+
+def _detect(y, filtered, signals, avg, std, start, lag, threshold, influence):
+    # Fills in <signals>, <filtered>, <avg> and <std> from <start> on. They
+    #  have to be done already for the <lag> samples before <start>, and
+    #  filtered[start:] has to be a copy of y[start:].
+    n = len(y)
+    if start >= n:
+        return
+
+    # Take it that nothing from <start> on is a signal. That's right up to
+    #  the first sample that is, and again from a window after each pulse.
+    avg[start:], std[start:] = _window_stats(filtered, start, n, lag)
+    if start == lag:
+        # The very first window is also the one before the first sample
+        avg[lag - 1], std[lag - 1] = avg[lag], std[lag]
+    hits = _hits(y, avg, std, start, n, threshold)
+    if influence == 1:
+        # Signals go into the window as they are, so it's right everywhere
+        signals[start:] = np.where(y[start:] > avg[start-1:-1], 1, -1)*hits
+        return
+    candidates = np.nonzero(hits)[0] + start
+
+    c = 0
+    while c < len(candidates):
+        i = candidates[c]
+        while True:
+            if influence == 0:
+                i = _hold(y, filtered, signals, avg, std, i, lag, threshold)
+            else:
+                i = _step(y, filtered, signals, avg, std, i, lag, threshold,
+                    influence)
+
+            # Sample <i> ended the pulse, and its window is done. The windows
+            #  after it still have some of the pulse in for <lag> samples, so
+            #  those are worked out again, and whether they're signals.
+            i += 1
+            stop = min(i + lag, n)
+            if i >= stop:
+                return
+            avg[i:stop], std[i:stop] = _window_stats(filtered, i, stop, lag)
+            end = min(stop + 1, n)
+            again = _hits(y, avg, std, i, end, threshold)
+            k = np.argmax(again)
+            if not again[k]:
+                break
+            i += k
+        c = np.searchsorted(candidates, end)
+
+def thresholding_algo(y, lag, threshold, influence):
+    '''Flags the samples of a trace that stand out from the ones before them.
+     <y>         = array of the trace
+     <lag>       = number of samples in the window the mean and standard
+            deviation are taken over
+     <threshold> = how many standard deviations from the mean a sample has to
+            be to be a signal
+     <influence> = weight signals have in the window, between 0 and 1
+    Returns: dict of
+     <signals>   = array of flags: 1 for a positive signal, -1 for a negative
+            one, and 0 for no signal
+     <avgFilter> = array of the mean of the window before each sample. 0 for
+            the first <lag>-1 samples.
+     <stdFilter> = array of the standard deviation of the same windows'''
+    y = np.ascontiguousarray(y, dtype=float)
+    n = len(y)
+    if lag < 1 or lag > n:
+        raise ValueError("lag has to be between 1 and the length of the trace")
+    signals = np.zeros(n)
+    filteredY = np.array(y, dtype=float)
+    avgFilter = np.zeros(n)
+    stdFilter = np.zeros(n)
+    if n == lag:
+        avgFilter[lag - 1] = np.mean(y)
+        stdFilter[lag - 1] = np.std(y)
+    _detect(y, filteredY, signals, avgFilter, stdFilter, lag, lag, threshold,
+        influence)
+
+    return dict(signals = signals,
+                avgFilter = avgFilter,
+                stdFilter = stdFilter)
+
+class Thresholder(object):
+    '''thresholding_algo() for a trace that arrives a few samples at a time,
+    e.g. from a live readout. Giving it a trace in pieces gets the same flags
+    as giving thresholding_algo() the whole thing. Only the last <lag>
+    samples are kept.
+     <lag>, <threshold>, <influence> = as for thresholding_algo()'''
+    def __init__(self, lag, threshold, influence):
+        if lag < 1:
+            raise ValueError("lag has to be at least 1")
+        self.lag = lag
+        self.threshold = threshold
+        self.influence = influence
+        # Number of samples seen so far
+        self.n = 0
+        self._y = np.zeros(0)
+        self._filtered = np.zeros(0)
+        self._avg = np.zeros(0)
+        self._std = np.zeros(0)
+
+    def update(self, y):
+        '''Adds samples on to the end of the trace.
+         <y> = array of the new samples
+        Returns: dict of
+         <signals>, <avgFilter>, <stdFilter> = as from thresholding_algo(),
+                for just the new samples'''
+        y = np.asarray(y, dtype=float)
+        lag = self.lag
+        m = len(self._y)
+        ys = np.concatenate((self._y, y))
+        filtered = np.concatenate((self._filtered, y))
+        signals = np.zeros(len(ys))
+        avg = np.concatenate((self._avg, np.zeros(len(y))))
+        std = np.concatenate((self._std, np.zeros(len(y))))
+
+        # Until there are <lag> samples nothing is thrown away, so the
+        #  indices here are the same as in the whole trace
+        start = m
+        if self.n < lag:
+            start = lag
+            if len(ys) == lag:
+                avg[lag - 1] = np.mean(ys)
+                std[lag - 1] = np.std(ys)
+        _detect(ys, filtered, signals, avg, std, start, lag, self.threshold,
+            self.influence)
+
+        self.n += len(y)
+        keep = slice(max(len(ys) - lag - 1, 0), None)
+        self._y = ys[keep]
+        self._filtered = filtered[keep]
+        self._avg = avg[keep]
+        self._std = std[keep]
+        return dict(signals = signals[m:],
+                    avgFilter = avg[m:],
+                    stdFilter = std[m:])
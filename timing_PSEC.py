@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import numpy as np
+
+# Times the pulses on every channel of a block of PSEC4 events at once,
+#  without fitting them. Crossings are linearly interpolated between the two
+#  samples either side, so the times aren't stuck on the 100ps sample grid.
+#  Pulses are negative going. Where a channel has no crossing its time is
+#  NaN, rather than the 0 that np.argmax() gives, so use np.isnan() to find
+#  them.
+
+# Time axis of a single sample, in ns
+TS = np.arange(0.0, 25.6, 0.1)
+
+def _first(mask):
+    # Index of the first True along the last axis, and whether there was one
+    index = np.argmax(mask, axis=-1)
+    return index, np.any(mask, axis=-1)
+
+def _last(mask):
+    # Index of the last True along the last axis, and whether there was one
+    n = mask.shape[-1]
+    index = n - 1 - np.argmax(mask[..., ::-1], axis=-1)
+    return index, np.any(mask, axis=-1)
+
+def _take(values, index):
+    # values[..., index] for an index for every row
+    return np.take_along_axis(values, index[..., np.newaxis], axis=-1)[..., 0]
+
+def _interpolate(values, index, level, ts, found):
+    # Time <values> crosses <level> between samples <index> and <index>+1
+    index = np.minimum(index, values.shape[-1] - 2)
+    v0 = _take(values, index)
+    v1 = _take(values, index + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(v1 != v0, (level - v0)/(v1 - v0), 0.)
+    dt = ts[index + 1] - ts[index]
+    return np.where(found, ts[index] + np.clip(frac, 0., 1.)*dt, np.nan)
+
+def baseline(data, n_samples=20):
+    '''Gets the baseline of every channel of every event, from the mean of its
+    first few samples.
+     <data>      = (..., 256) array of voltages
+     <n_samples> = how many samples at the start to average
+    Returns: base
+     <base> = array of the baselines, the shape of <data> without its last
+            axis'''
+    return np.mean(data[..., :n_samples], axis=-1, dtype=np.float64)
+
+def leading_edge(data, threshold, ts=TS):
+    '''Times when each channel first goes below a threshold.
+     <data>      = (n_events, 6, 256) array of voltages, or any array with
+            the samples along the last axis
+     <threshold> = voltage to cross. Either one number, or an array that
+            broadcasts against data[..., 0], e.g. a threshold per event from
+            charge_PSEC.noise_level()[:, np.newaxis]
+     <ts>        = time of each sample, in ns
+    Returns: times
+     <times> = (n_events, 6) array of the interpolated crossing times, in ns.
+            NaN where the channel never crosses, or is already below the
+            threshold at the first sample.'''
+    data = np.asarray(data)
+    threshold = np.broadcast_to(np.asarray(threshold, dtype=np.float64),
+        data.shape[:-1])
+    below = data < threshold[..., np.newaxis].astype(data.dtype)
+    index, found = _first(below)
+    found &= index > 0
+    return _interpolate(data, index - 1, threshold, ts, found)
+
+def constant_fraction(data, fraction=0.3, base=None, ts=TS):
+    '''Times when each pulse reaches a fraction of its own height, on its
+    leading edge. Unlike leading_edge() this doesn't walk with the size of the
+    pulse.
+     <data>     = (n_events, 6, 256) array of voltages, or any array with the
+            samples along the last axis
+     <fraction> = fraction of the pulse height to time at
+     <base>     = baselines, as from baseline(), which is used if this is None
+     <ts>       = time of each sample, in ns
+    Returns: times
+     <times> = (n_events, 6) array of the interpolated times, in ns. NaN where
+            there's no pulse, or it has no leading edge in the sample.'''
+    data = np.asarray(data)
+    if base is None:
+        base = baseline(data)
+    peak = np.argmin(data, axis=-1)
+    height = _take(data, peak) - base
+    level = base + fraction*height
+
+    # Last sample before the peak still above the level
+    before = np.arange(data.shape[-1]) < peak[..., np.newaxis]
+    above = (data > level[..., np.newaxis]) & before
+    index, found = _last(above)
+    found &= height < 0
+    return _interpolate(data, index, level, ts, found)
+
+def zero_crossing(data, fraction=0.3, delay=3, arm=None, ts=TS):
+    '''Times each pulse like an analogue constant fraction discriminator. The
+    pulse is delayed and has an attenuated, inverted copy of itself added,
+    and the time is where that crosses zero.
+     <data>     = (n_events, 6, 256) array of voltages, or any array with the
+            samples along the last axis
+     <fraction> = attenuation of the inverted copy
+     <delay>    = delay, in samples, at least 1. About the rise time of the
+            pulses works best.
+     <arm>      = only time pulses that go below this voltage, relative to
+            the baseline. None times every channel.
+     <ts>       = time of each sample, in ns
+    Returns: times
+     <times> = (n_events, 6) array of the interpolated times, in ns. NaN where
+            the channel has no zero crossing, or didn't arm.'''
+    data = np.asarray(data)
+    if not 1 <= delay < data.shape[-1]:
+        raise ValueError("The delay has to be at least 1 sample, and less "
+            "than the %d in a trace, not %r" % (data.shape[-1], delay))
+    data = data - baseline(data)[..., np.newaxis].astype(data.dtype)
+    shaped = np.empty(data.shape, dtype=data.dtype)
+    shaped[..., delay:] = data[..., :-delay] - fraction*data[..., delay:]
+    shaped[..., :delay] = -fraction*data[..., :delay]
+
+    # The last crossing from positive to negative before the delayed peak
+    stop = np.argmin(data, axis=-1) + delay
+    i = np.arange(data.shape[-1] - 1)
+    cross = ((shaped[..., :-1] >= 0) & (shaped[..., 1:] < 0) &
+        (i < stop[..., np.newaxis]))
+    index, found = _last(cross)
+    if arm is not None:
+        found &= np.amin(data, axis=-1) < arm
+    return _interpolate(shaped, index, 0., ts, found)